@@ -10,6 +10,9 @@ LOG_FORMAT = "%(asctime)-20s %(levelname)-9s [%(name)s] %(message)s"
 LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 DEFAULT_LOGLEVEL = logging.INFO
 DAYS_TO_KEEP_LOGS = 14
+# Records from the same line of code allowed on each interval (sec), the others are counted and suppressed
+LOG_RATE_LIMIT_BURST = 10
+LOG_RATE_LIMIT_INTERVAL = 60
 
 # Defaults
 DEFAULT_ENELX_SERVER = "juicenet-udp-prod3-usa.enelx.com"
@@ -22,10 +25,38 @@ DEFAULT_MQTT_DISCOVERY_PREFIX = "homeassistant"
 DEFAULT_DEVICE_NAME = "JuiceBox"
 DEFAULT_TELNET_PORT = "2000"
 DEFAULT_TELNET_TIMEOUT = "30"
+DEFAULT_METRICS_HOST = "127.0.0.1"
+# 0 disables the metrics endpoint
+DEFAULT_METRICS_PORT = "0"
+# 0 disables the history store
+DEFAULT_HISTORY_DAYS = "0"
+# 0 disables tracing, otherwise traces kept of the last and of the slowest datagrams
+DEFAULT_TRACE_BUFFER = "0"
 
-# How many times to fully restart JPP before exiting
+# How many times a component can be restarted within ERROR_LOOKBACK_MIN minutes before exiting
 MAX_JPP_LOOP = 10
 
+# A failed component is restarted after SUPERVISOR_RESTART_DELAY seconds, doubling on each
+# failure up to SUPERVISOR_MAX_RESTART_DELAY. The delay goes back to the start once the
+# component ran for SUPERVISOR_HEALTHY_TIME seconds.
+SUPERVISOR_RESTART_DELAY = 1
+SUPERVISOR_MAX_RESTART_DELAY = 60
+SUPERVISOR_HEALTHY_TIME = 300
+
+# Event loop monitor: the loop is pinged every LOOP_MONITOR_INTERVAL seconds, a ping waiting
+# more than DEFAULT_SLOW_CALLBACK_MS is a blocked loop and the running code is sampled.
+# A summary is logged every LOOP_REPORT_INTERVAL seconds, last LOOP_SLOW_EVENTS are kept.
+DEFAULT_SLOW_CALLBACK_MS = "100"
+LOOP_MONITOR_INTERVAL = 0.5
+LOOP_REPORT_INTERVAL = 60 * 60
+LOOP_SLOW_EVENTS = 20
+
+# On demand profile (SIGUSR1, MQTT button or /profile): seconds profiled, most seconds
+# that can be asked on /profile and stack sampling interval
+PROFILE_DURATION = 30
+PROFILE_MAX_DURATION = 10 * 60
+PROFILE_SAMPLE_INTERVAL = 0.005
+
 # Will stop JuiceboxMITM or JuiceboxUDPC Updater if there are more than MAX_ERROR_COUNT handled exceptions within ERROR_LOOKBACK_MIN minutes.
 MAX_ERROR_COUNT = 10
 ERROR_LOOKBACK_MIN = 60
@@ -33,16 +64,114 @@ ERROR_LOOKBACK_MIN = 60
 # How many times to retry connections or sending attempts before failing
 MAX_RETRY_ATTEMPT = 3
 
-# How many seconds before timing out a UDPC Update
-UDPC_UPDATE_CHECK_TIMEOUT = 60
+# Circuit breakers stop calling a failing dependency (EnelX, broker, telnet, socket) for
+# BREAKER_RESET_TIMEOUT seconds, doubling on each failed trial up to BREAKER_MAX_RESET_TIMEOUT.
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_MAX_RESET_TIMEOUT = 600
 
-# How many seconds before timing out handling a MITM Message
-MITM_HANDLER_TIMEOUT = 10
+# History store of decoded status messages
+HISTORY_DB = "juicepassproxy_history.db"
+# Pending samples are written every HISTORY_FLUSH_INTERVAL seconds or when HISTORY_BATCH_SIZE samples are queued
+HISTORY_FLUSH_INTERVAL = 60
+HISTORY_BATCH_SIZE = 500
+# How many seconds between removal of samples older than the retention
+HISTORY_PRUNE_INTERVAL = 60 * 60
 
-# How many seconds to wait to receive a MITM Message before timing out
-MITM_RECV_TIMEOUT = 120
+# Daily energy profile rebuilt from the 96 x 15 minutes interval memory of the device
+INTERVAL_DB = "juicepassproxy_intervals.json"
+INTERVAL_SLOTS = 96
+# How many seconds between saves of the interval slots
+INTERVAL_SAVE_INTERVAL = 15 * 60
+
+# Last status, command counter, protocol and setpoints of each device are saved on STATE_DB
+# every STATE_SAVE_INTERVAL seconds. Status and command older than STATE_MAX_AGE seconds are not restored
+STATE_DB = "juicepassproxy_state.json"
+STATE_SAVE_INTERVAL = 60
+STATE_MAX_AGE = 24 * 60 * 60
+
+# How many seconds a telnet snapshot (get all and UDPC list) answers lookups without asking the device again
+TELNET_SNAPSHOT_TTL = 30
+
+# UDPC is only checked over telnet when no datagram came from the JuiceBox for
+# UDPC_TRAFFIC_GAP_FACTOR report intervals (at least UDPC_TRAFFIC_GAP_MIN seconds),
+# while there is no traffic checks are repeated with backoff up to UDPC_CHECK_MAX_INTERVAL seconds
+UDPC_TRAFFIC_GAP_FACTOR = 3
+UDPC_TRAFFIC_GAP_MIN = 20
+UDPC_CHECK_MAX_INTERVAL = 30 * 60
+
+# Fleet UDPC manager: concurrent telnet workers, seconds between checks of each
+# JuiceBox (never less than UDPC_FLEET_MIN_HOST_INTERVAL) and +/- jitter fraction
+UDPC_FLEET_WORKERS = 16
+UDPC_FLEET_CHECK_INTERVAL = 5 * 60
+UDPC_FLEET_MIN_HOST_INTERVAL = 30
+UDPC_FLEET_JITTER = 0.1
+
+# The timeouts below are learned from what is observed (JuiceboxAdaptiveTimeout):
+# ADAPTIVE_TIMEOUT_MULTIPLIER times the moving average, at least the average plus
+# 4 deviations, between the *_MIN_TIMEOUT and *_MAX_TIMEOUT seconds. The fixed
+# value is used until ADAPTIVE_TIMEOUT_MIN_SAMPLES samples were seen
+ADAPTIVE_TIMEOUT_MULTIPLIER = 3
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 4
+
+# How many seconds before timing out a UDPC Update, from the time of the checks.
+# Never less than the telnet timeout of one command
+UDPC_UPDATE_CHECK_TIMEOUT = 60
+UDPC_UPDATE_CHECK_MIN_TIMEOUT = int(DEFAULT_TELNET_TIMEOUT)
 
 # How many seconds before timing out sending a MITM Message
 MITM_SEND_DATA_TIMEOUT = 10
 
+# How many seconds before timing out handling a MITM Message, from the time of the handler.
+# Never less than one send, up to all the send attempts
+MITM_HANDLER_TIMEOUT = 10
+MITM_HANDLER_MIN_TIMEOUT = MITM_SEND_DATA_TIMEOUT
+MITM_HANDLER_MAX_TIMEOUT = MAX_RETRY_ATTEMPT * MITM_SEND_DATA_TIMEOUT
+
+# How many seconds without a MITM Message before the JuiceBox is reported offline,
+# from the time between datagrams and the report time (t) of the device
+MITM_RECV_TIMEOUT = 120
+MITM_RECV_MIN_TIMEOUT = 15
+MITM_RECV_MAX_TIMEOUT = 15 * 60
+
 EXTERNAL_DNS = "1.1.1.1"
+
+# EnelX DNS answers are refreshed at ENELX_DNS_REFRESH_FACTOR of their TTL, between
+# ENELX_DNS_MIN_REFRESH and ENELX_DNS_MAX_REFRESH seconds. Failed lookups keep the
+# last addresses and are retried with backoff from ENELX_DNS_RETRY seconds
+ENELX_DNS_REFRESH_FACTOR = 0.8
+ENELX_DNS_MIN_REFRESH = 60
+ENELX_DNS_MAX_REFRESH = 6 * 60 * 60
+ENELX_DNS_RETRY = 30
+ENELX_DNS_TIMEOUT = 5
+
+# Switch to the next EnelX address after this many datagrams forwarded without any answer
+ENELX_FAILOVER_UNANSWERED = 5
+
+# Startup budgets in seconds, checked by test_importtime: importing juicepassproxy
+# and a start with --juicebox_id and --enelx_ip until the MITM is listening
+STARTUP_IMPORT_BUDGET = 0.5
+STARTUP_LISTEN_BUDGET = 3
+
+# Status datagrams with a serial, counter and CRC seen in the last DUPLICATE_WINDOW
+# counters of the device are forwarded without being decoded and published again
+DUPLICATE_WINDOW = 64
+
+# Link quality: a status counter at most LINK_REORDER_WINDOW behind the last one is
+# a late datagram, a jump back further or forward over LINK_MAX_GAP is a reboot.
+# Loss and EnelX response ratios are averaged over about LINK_QUALITY_SAMPLES
+# datagrams, the diagnostic entities are published every LINK_QUALITY_REPORT_INTERVAL seconds
+LINK_REORDER_WINDOW = 8
+LINK_MAX_GAP = 100
+LINK_QUALITY_SAMPLES = 32
+LINK_QUALITY_REPORT_INTERVAL = 60
+
+# Ingress filter of the datagrams not from EnelX, before decoding: bigger than
+# INGRESS_MAX_DATAGRAM bytes, without a "<serial>:" prefix or over INGRESS_RATE
+# datagrams per second (bursts of INGRESS_BURST) from a source are dropped. Sources
+# other than the known JuiceBox share INGRESS_UNKNOWN_RATE, the buckets of at most
+# INGRESS_MAX_SOURCES sources are kept
+INGRESS_MAX_DATAGRAM = 1024
+INGRESS_RATE = 10
+INGRESS_BURST = 20
+INGRESS_UNKNOWN_RATE = 2
+INGRESS_MAX_SOURCES = 256
@@ -72,6 +72,26 @@ if [[ ! -z "${TELNET_TIMEOUT}" ]]; then
   logger INFO "TELNET_TIMEOUT: ${TELNET_TIMEOUT}"
   JPP_STRING+=" --telnet_timeout ${TELNET_TIMEOUT}"
 fi
+if [[ ! -z "${METRICS_PORT}" ]]; then
+  logger INFO "METRICS_PORT: ${METRICS_PORT}"
+  JPP_STRING+=" --metrics_port ${METRICS_PORT}"
+fi
+if [[ ! -z "${METRICS_HOST}" ]]; then
+  logger INFO "METRICS_HOST: ${METRICS_HOST}"
+  JPP_STRING+=" --metrics_host ${METRICS_HOST}"
+fi
+if [[ ! -z "${HISTORY_DAYS}" ]]; then
+  logger INFO "HISTORY_DAYS: ${HISTORY_DAYS}"
+  JPP_STRING+=" --history_days ${HISTORY_DAYS}"
+fi
+if [[ ! -z "${TRACE_BUFFER}" ]]; then
+  logger INFO "TRACE_BUFFER: ${TRACE_BUFFER}"
+  JPP_STRING+=" --trace_buffer ${TRACE_BUFFER}"
+fi
+if [[ ! -z "${SLOW_CALLBACK_MS}" ]]; then
+  logger INFO "SLOW_CALLBACK_MS: ${SLOW_CALLBACK_MS}"
+  JPP_STRING+=" --slow_callback_ms ${SLOW_CALLBACK_MS}"
+fi
 JPP_STRING+=" --config_loc /config"
 if [[ -v LOG_LOC ]]; then
   logger INFO "LOG_LOC: ${LOG_LOC}"
@@ -95,6 +115,12 @@ if [[ -v IGNORE_ENELX ]] && $IGNORE_ENELX; then
 else
   logger INFO "IGNORE_ENELX: false"
 fi
+if [[ -v COLD_START ]] && $COLD_START; then
+  JPP_STRING+=" --cold_start"
+  logger INFO "COLD_START: true"
+else
+  logger INFO "COLD_START: false"
+fi
 if [[ -v EXPERIMENTAL ]] && $EXPERIMENTAL; then
   JPP_STRING+=" --experimental"
   logger INFO "EXPERIMENTAL: true"
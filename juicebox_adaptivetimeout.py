@@ -0,0 +1,89 @@
+from const import ADAPTIVE_TIMEOUT_MIN_SAMPLES, ADAPTIVE_TIMEOUT_MULTIPLIER
+from juicebox_metrics import METRICS
+
+_TIMEOUT = METRICS.gauge(
+    "juicepassproxy_timeout_seconds",
+    "Current adaptive timeouts",
+    ("timeout",),
+)
+
+# Gains of the retransmission timeout of RFC 6298
+_AVERAGE_GAIN = 1 / 8
+_DEVIATION_GAIN = 1 / 4
+
+
+class JuiceboxAdaptiveTimeout:
+    """
+    Timeout learned from samples of how long something takes (a handler, a
+    check) or how long between datagrams.
+
+    The timeout is multiplier times the moving average of the samples, never
+    less than the average plus 4 mean deviations like the TCP retransmission
+    timeout (RFC 6298), between minimum and maximum. An expected interval (the
+    report time of the device) is used as average while it is higher. initial
+    is used until min_samples were seen. Each expiry doubles the timeout until
+    the next sample, so a long outage is not reported again at every timeout.
+    """
+
+    __slots__ = (
+        "initial",
+        "minimum",
+        "maximum",
+        "multiplier",
+        "min_samples",
+        "average",
+        "deviation",
+        "expected",
+        "samples",
+        "backoff",
+    )
+
+    def __init__(
+        self,
+        initial,
+        minimum,
+        maximum=None,
+        multiplier=ADAPTIVE_TIMEOUT_MULTIPLIER,
+        min_samples=ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+        name=None,
+    ):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = initial if maximum is None else maximum
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.average = None
+        self.deviation = 0.0
+        self.expected = None
+        self.samples = 0
+        self.backoff = 1
+        if name is not None:
+            _TIMEOUT.labels(name).set_function(self.get)
+
+    def observe(self, sample):
+        if self.average is None:
+            self.average = sample
+            self.deviation = sample / 2
+        else:
+            self.deviation += _DEVIATION_GAIN * (abs(sample - self.average) - self.deviation)
+            self.average += _AVERAGE_GAIN * (sample - self.average)
+        self.samples += 1
+        self.backoff = 1
+
+    def set_expected(self, interval):
+        self.expected = interval or None
+
+    def expired(self):
+        self.backoff *= 2
+
+    def get(self):
+        if self.samples < self.min_samples and self.expected is None:
+            timeout = self.initial
+        else:
+            average = max(self.average or 0, self.expected or 0)
+            timeout = max(
+                self.multiplier * average,
+                (self.average or 0) + 4 * self.deviation,
+                self.minimum,
+            )
+        return min(timeout * self.backoff, self.maximum)
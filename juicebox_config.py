@@ -1,5 +1,5 @@
-import yaml
 from pathlib import Path
+import asyncio
 import logging
 
 from const import (
@@ -22,6 +22,8 @@ class JuiceboxConfig:
 
 
     async def load(self):
+        import yaml
+
         config = {}
         try:
             _LOGGER.info(f"Reading config from {self.config_loc}")
@@ -33,12 +35,24 @@ class JuiceboxConfig:
             config = {}
         self._config = config
         
-    async def write(self):
+    async def write(self, in_thread=False):
+        # in_thread keeps the file I/O off the loop, for writes on the datagram path
+        self._changed = False
+        if in_thread:
+            written = await asyncio.to_thread(self._write, dict(self._config))
+        else:
+            written = self._write(self._config)
+        if not written:
+            self._changed = True
+        return written
+
+    def _write(self, config):
+        import yaml
+
         try:
             _LOGGER.info(f"Writing config to {self.config_loc}")
             with open(self.config_loc, "w") as file:
-                yaml.dump(self._config, file)
-            self._changed = False
+                yaml.dump(config, file)
             return True
         except Exception as e:
             _LOGGER.warning(
@@ -47,9 +61,9 @@ class JuiceboxConfig:
         return False
 
 
-    async def write_if_changed(self):
+    async def write_if_changed(self, in_thread=False):
         if self._changed:
-            return await self.write()
+            return await self.write(in_thread)
         return True
         
     def get(self, key, default):
@@ -0,0 +1,90 @@
+import logging
+
+from const import DUPLICATE_WINDOW
+from juicebox_metrics import METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+_DUPLICATES = METRICS.counter(
+    "juicepassproxy_duplicates_total",
+    "Status datagrams from the JuiceBox already processed, forwarded without decoding",
+)
+
+
+def duplicate_key(data: bytes):
+    """
+    (serial, counter, crc) of a status datagram
+    "<serial>:<version>,s<counter>,...!<crc>:" without decoding it, None for
+    other datagrams.
+    """
+    colon = data.find(b":")
+    crc_start = data.rfind(b"!")
+    if colon <= 0 or crc_start < colon:
+        return None
+    counter_start = data.find(b",s", colon, crc_start)
+    if counter_start < 0:
+        return None
+    counter_end = data.find(b",", counter_start + 2, crc_start)
+    counter = data[counter_start + 2:counter_end if counter_end >= 0 else crc_start]
+    if not counter.isdigit():
+        return None
+    return data[:colon], int(counter), data[crc_start + 1:crc_start + 4]
+
+
+class JuiceboxDuplicateWindow:
+    """
+    Counters seen of one device in the last size counters: bit n of bitmap is
+    top - n, with the CRC of each counter in a ring. A counter far behind top
+    (device rebooted or counter wrapped) starts a new window.
+    """
+
+    __slots__ = ("size", "top", "bitmap", "crcs")
+
+    def __init__(self, size):
+        self.size = size
+        self.top = None
+        self.bitmap = 0
+        self.crcs = [None] * size
+
+    def seen(self, counter, crc):
+        """True if counter and crc were already seen, records them otherwise"""
+        slot = counter % self.size
+        if self.top is None or counter - self.top >= self.size or self.top - counter >= self.size:
+            self.top = counter
+            self.bitmap = 1
+        elif counter > self.top:
+            self.bitmap = ((self.bitmap << (counter - self.top)) | 1) & ((1 << self.size) - 1)
+            self.top = counter
+        else:
+            bit = 1 << (self.top - counter)
+            if self.bitmap & bit and self.crcs[slot] == crc:
+                return True
+            self.bitmap |= bit
+        self.crcs[slot] = crc
+        return False
+
+
+class JuiceboxDuplicateFilter:
+    """
+    Detects retransmissions (or reflections) of status datagrams already
+    processed, keyed on serial, counter (s) and CRC with a recent window of
+    counters per device.
+    """
+
+    def __init__(self, window=DUPLICATE_WINDOW, loglevel=None):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._window = window
+        self._devices = {}
+
+    def is_duplicate(self, data: bytes):
+        if (key := duplicate_key(data)) is None:
+            return False
+        serial, counter, crc = key
+        if (device := self._devices.get(serial, None)) is None:
+            device = self._devices[serial] = JuiceboxDuplicateWindow(self._window)
+        if device.seen(counter, crc):
+            _DUPLICATES.inc()
+            _LOGGER.debug("Duplicate of counter %s from %s", counter, serial)
+            return True
+        return False
@@ -0,0 +1,138 @@
+import asyncio
+import ipaddress
+import logging
+import time
+
+import dns.asyncresolver
+import dns.exception
+from const import (
+    ENELX_DNS_MAX_REFRESH,
+    ENELX_DNS_MIN_REFRESH,
+    ENELX_DNS_REFRESH_FACTOR,
+    ENELX_DNS_RETRY,
+    ENELX_DNS_TIMEOUT,
+    EXTERNAL_DNS,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class JuiceboxEnelXResolver:
+    """
+    Keeps the addresses of the EnelX server up to date.
+
+    Answers are cached on JuiceboxConfig with their expiry and refreshed in
+    background before the TTL ends, so forwarding never waits for DNS. All A
+    records are kept: the MITM uses one of them and failover() moves to the
+    next one when EnelX stops answering.
+    """
+
+    def __init__(
+        self,
+        hostname,
+        port,
+        config,
+        nameserver=EXTERNAL_DNS,
+        nameserver_port=53,
+        clock=time.time,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._hostname = hostname
+        self._port = int(port)
+        self._config = config
+        self._clock = clock
+        self._resolver = dns.asyncresolver.Resolver(configure=False)
+        self._resolver.nameservers = [nameserver]
+        self._resolver.port = nameserver_port
+        self._mitm_handler = None
+        self._addresses = list(config.get("ENELX_IPS", None) or [])
+        self._expires = config.get("ENELX_DNS_EXPIRES", None) or 0
+        # Address the MITM is using
+        self._current = config.get("ENELX_IP", None)
+        self._retry = ENELX_DNS_RETRY
+
+    @property
+    def addresses(self):
+        return list(self._addresses)
+
+    async def set_mitm_handler(self, mitm_handler):
+        self._mitm_handler = mitm_handler
+        if self._current is not None:
+            await mitm_handler.set_enelx_addr((self._current, self._port))
+
+    async def start(self):
+        _LOGGER.info(f"Starting JuiceboxEnelXResolver for {self._hostname}")
+        while True:
+            await asyncio.sleep(self._time_until_refresh())
+            if await self.refresh():
+                self._retry = ENELX_DNS_RETRY
+            else:
+                # Keep the last addresses until EnelX DNS answers again
+                self._expires = self._clock() + self._retry
+                self._retry = min(self._retry * 2, ENELX_DNS_MAX_REFRESH)
+
+    def _time_until_refresh(self):
+        return max(self._expires - self._clock(), 0)
+
+    async def lookup(self):
+        """Returns (addresses, ttl) or (None, None)"""
+        try:
+            answers = await self._resolver.resolve(
+                self._hostname,
+                rdtype="A",
+                raise_on_no_answer=True,
+                lifetime=ENELX_DNS_TIMEOUT,
+            )
+        except (dns.exception.DNSException, OSError) as e:
+            _LOGGER.warning(
+                f"Unable to resolve {self._hostname}. ({e.__class__.__qualname__}: {e})"
+            )
+            return None, None
+        # Sorted so round robin answers don't look like a change
+        addresses = sorted(
+            (answer.address for answer in answers), key=ipaddress.ip_address
+        )
+        return addresses, answers.rrset.ttl
+
+    async def refresh(self):
+        addresses, ttl = await self.lookup()
+        if not addresses:
+            return False
+        refresh = min(
+            max(ttl * ENELX_DNS_REFRESH_FACTOR, ENELX_DNS_MIN_REFRESH),
+            ENELX_DNS_MAX_REFRESH,
+        )
+        self._expires = self._clock() + refresh
+        if addresses != self._addresses:
+            _LOGGER.info(f"{self._hostname}: {addresses} (ttl {ttl})")
+        self._addresses = addresses
+        self._config.update_value("ENELX_IPS", addresses)
+        self._config.update_value("ENELX_DNS_EXPIRES", round(self._expires))
+        # Stay on the address in use while it is still announced
+        if self._current not in addresses:
+            await self._use(addresses[0])
+        await self._config.write_if_changed(in_thread=True)
+        return True
+
+    async def failover(self):
+        """Moves to the next known address, returns it or None if there is no other one"""
+        if len(self._addresses) < 2:
+            return None
+        try:
+            next_index = (self._addresses.index(self._current) + 1) % len(self._addresses)
+        except ValueError:
+            next_index = 0
+        _LOGGER.warning(
+            f"EnelX {self._current} is not answering, trying {self._addresses[next_index]}"
+        )
+        await self._use(self._addresses[next_index])
+        await self._config.write_if_changed(in_thread=True)
+        return self._current
+
+    async def _use(self, address):
+        self._current = address
+        self._config.update_value("ENELX_IP", address)
+        if self._mitm_handler is not None:
+            await self._mitm_handler.set_enelx_addr((address, self._port))
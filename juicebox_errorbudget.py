@@ -0,0 +1,204 @@
+import logging
+import time
+
+from const import (
+    BREAKER_MAX_RESET_TIMEOUT,
+    BREAKER_RESET_TIMEOUT,
+    ERROR_LOOKBACK_MIN,
+    MAX_ERROR_COUNT,
+    MAX_RETRY_ATTEMPT,
+)
+from juicebox_metrics import METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+BREAKER_CLOSED = "closed"
+BREAKER_HALF_OPEN = "half_open"
+BREAKER_OPEN = "open"
+
+# Numeric value exported on the state gauge
+BREAKER_STATE_VALUES = {BREAKER_CLOSED: 0, BREAKER_HALF_OPEN: 1, BREAKER_OPEN: 2}
+
+_ERROR_COUNT = METRICS.gauge(
+    "juicepassproxy_errors_in_window",
+    "Handled errors inside the error lookback window",
+    ("component",),
+)
+_BREAKER_STATE = METRICS.gauge(
+    "juicepassproxy_circuit_breaker_state",
+    "Circuit breaker state per dependency (0=closed, 1=half_open, 2=open)",
+    ("dependency",),
+)
+_BREAKER_REJECTED = METRICS.counter(
+    "juicepassproxy_circuit_breaker_rejected_total",
+    "Calls not attempted because the circuit breaker was open",
+    ("dependency",),
+)
+_BREAKER_OPENED = METRICS.counter(
+    "juicepassproxy_circuit_breaker_opened_total",
+    "Times the circuit breaker changed to open",
+    ("dependency",),
+)
+
+
+class JuiceboxErrorBudget:
+    """
+    Count of errors in a sliding window.
+
+    The window is split in a ring of fixed time buckets and a running total is
+    kept, add() and count() are O(1) (clearing expired buckets is bounded by
+    the number of buckets, not by the number of errors).
+    """
+
+    def __init__(
+        self,
+        name,
+        max_errors=MAX_ERROR_COUNT,
+        window=ERROR_LOOKBACK_MIN * 60,
+        bucket_count=60,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self.max_errors = max_errors
+        self.window = window
+        self._clock = clock
+        self._bucket_seconds = window / bucket_count
+        self._buckets = [0] * bucket_count
+        self._total = 0
+        self._current = int(clock() // self._bucket_seconds)
+        _ERROR_COUNT.labels(name).set_function(self.count)
+
+    def _advance(self):
+        bucket = int(self._clock() // self._bucket_seconds)
+        if bucket <= self._current:
+            return
+        size = len(self._buckets)
+        for step in range(1, min(bucket - self._current, size) + 1):
+            slot = (self._current + step) % size
+            self._total -= self._buckets[slot]
+            self._buckets[slot] = 0
+        self._current = bucket
+
+    def add(self, count=1):
+        self._advance()
+        self._buckets[self._current % len(self._buckets)] += count
+        self._total += count
+        _LOGGER.debug(f"{self.name} errors in last {self.window / 60:g} min: {self._total}")
+        return self._total
+
+    def count(self):
+        self._advance()
+        return self._total
+
+    def exhausted(self):
+        return self.count() >= self.max_errors
+
+    def reset(self):
+        self._buckets = [0] * len(self._buckets)
+        self._total = 0
+
+
+class JuiceboxCircuitBreaker:
+    """
+    Circuit breaker for one external dependency (EnelX, broker, telnet, socket).
+
+    closed: calls are allowed, consecutive failures are counted.
+    open: calls are rejected until reset_timeout elapsed.
+    half_open: a single trial call is allowed, success closes the breaker and a
+    failure opens it again doubling the timeout up to max_reset_timeout. A trial
+    without an outcome after reset_timeout (e.g. a datagram never answered)
+    allows a new trial.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=MAX_RETRY_ATTEMPT,
+        reset_timeout=BREAKER_RESET_TIMEOUT,
+        max_reset_timeout=BREAKER_MAX_RESET_TIMEOUT,
+        clock=time.monotonic,
+    ):
+        self.name = name
+        self._failure_threshold = failure_threshold
+        self._base_reset_timeout = reset_timeout
+        self._reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._clock = clock
+        self._state = BREAKER_CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._trial_started = None
+        self._rejected = _BREAKER_REJECTED.labels(name)
+        self._opened = _BREAKER_OPENED.labels(name)
+        _BREAKER_STATE.labels(name).set_function(
+            lambda: BREAKER_STATE_VALUES[self.state]
+        )
+
+    @property
+    def state(self):
+        if (
+            self._state == BREAKER_OPEN
+            and self._clock() - self._opened_at >= self._reset_timeout
+        ):
+            self._state = BREAKER_HALF_OPEN
+            self._trial_running = False
+        elif (
+            self._state == BREAKER_HALF_OPEN
+            and self._trial_running
+            and self._clock() - self._trial_started >= self._reset_timeout
+        ):
+            self._trial_running = False
+        return self._state
+
+    def allow(self):
+        state = self.state
+        if state == BREAKER_CLOSED:
+            return True
+        if state == BREAKER_HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            self._trial_started = self._clock()
+            return True
+        self._rejected.inc()
+        return False
+
+    def retry_in(self):
+        """Seconds until the breaker will allow a trial call"""
+        if self.state != BREAKER_OPEN:
+            return 0
+        return max(0, self._reset_timeout - (self._clock() - self._opened_at))
+
+    def record_success(self):
+        if self._state != BREAKER_CLOSED:
+            _LOGGER.info(f"Circuit breaker {self.name} closed")
+        self._state = BREAKER_CLOSED
+        self._failures = 0
+        self._trial_running = False
+        self._reset_timeout = self._base_reset_timeout
+
+    def record_failure(self):
+        self._failures += 1
+        state = self.state
+        if state == BREAKER_HALF_OPEN:
+            self._reset_timeout = min(self._reset_timeout * 2, self._max_reset_timeout)
+            self._open()
+        elif state == BREAKER_CLOSED and self._failures >= self._failure_threshold:
+            self._open()
+
+    def _open(self):
+        self._state = BREAKER_OPEN
+        self._opened_at = self._clock()
+        self._trial_running = False
+        self._opened.inc()
+        _LOGGER.warning(
+            f"Circuit breaker {self.name} open for {self._reset_timeout} sec "
+            f"after {self._failures} failures"
+        )
+
+    def inspect(self):
+        return {
+            "name": self.name,
+            "state": self.state,
+            "failures": self._failures,
+            "retry_in": round(self.retry_in(), 1),
+        }
@@ -0,0 +1,485 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from const import (
+    HISTORY_BATCH_SIZE,
+    HISTORY_DB,
+    HISTORY_FLUSH_INTERVAL,
+    HISTORY_PRUNE_INTERVAL,
+)
+from juicebox_metrics import METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+# Values from JuiceboxStatusMessage stored on each sample, in column order
+HISTORY_FIELDS = (
+    "status",
+    "current",
+    "voltage",
+    "power",
+    "power_factor",
+    "temperature",
+    "frequency",
+    "energy_session",
+    "energy_lifetime",
+)
+# Fields that are counters, downsampling keeps the highest value instead of the mean
+# (the last one unless the counter was reset during the step)
+HISTORY_COUNTER_FIELDS = ("energy_session", "energy_lifetime")
+# Fields with min/max/mean kept on the rollup tables
+ROLLUP_FIELDS = ("current", "voltage", "temperature", "power_factor", "power")
+ROLLUP_HOUR = "hour"
+ROLLUP_DAY = "day"
+ROLLUP_MONTH = "month"
+ROLLUP_LEVELS = (ROLLUP_HOUR, ROLLUP_DAY, ROLLUP_MONTH)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS status_history (
+    device TEXT NOT NULL,
+    ts REAL NOT NULL,
+    status TEXT,
+    current REAL,
+    voltage REAL,
+    power REAL,
+    power_factor REAL,
+    temperature REAL,
+    frequency REAL,
+    energy_session INTEGER,
+    energy_lifetime INTEGER,
+    PRIMARY KEY (device, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS status_rollup (
+    device TEXT NOT NULL,
+    level TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    %s,
+    energy INTEGER,
+    PRIMARY KEY (device, level, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_state (
+    device TEXT PRIMARY KEY,
+    ts REAL NOT NULL
+);
+""" % ",\n    ".join(
+    f"{field}_min REAL, {field}_max REAL, {field}_sum REAL, {field}_count INTEGER"
+    for field in ROLLUP_FIELDS
+)
+
+_INSERT = (
+    f"INSERT OR REPLACE INTO status_history (device, ts, {', '.join(HISTORY_FIELDS)}) "
+    f"VALUES ({', '.join('?' * (len(HISTORY_FIELDS) + 2))})"
+)
+
+_ROLLUP_COLUMNS = ["samples"] + [
+    f"{field}_{agg}" for field in ROLLUP_FIELDS for agg in ("min", "max", "sum", "count")
+] + ["energy"]
+_ROLLUP_INSERT = (
+    f"INSERT OR REPLACE INTO status_rollup (device, level, ts, {', '.join(_ROLLUP_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * (len(_ROLLUP_COLUMNS) + 3))})"
+)
+# Hour rollup from raw samples, energy is the sum of positive energy_lifetime
+# steps starting from the last sample before the hour so counter resets and
+# lost datagrams don't create negative or missing energy. Means are divided by
+# the per field count, fields can be missing from some messages
+_ROLLUP_HOUR_SELECT = (
+    "SELECT COUNT(*), "
+    + ", ".join(f"MIN({f}), MAX({f}), TOTAL({f}), COUNT({f})" for f in ROLLUP_FIELDS)
+    + ", TOTAL(CASE WHEN energy_lifetime >= prev THEN energy_lifetime - prev ELSE 0 END) "
+    "FROM (SELECT *, LAG(energy_lifetime) OVER (ORDER BY ts) AS prev "
+    "FROM status_history WHERE device = ? AND ts < ? AND ts >= COALESCE("
+    "(SELECT MAX(ts) FROM status_history WHERE device = ? AND ts < ?), ?)) "
+    "WHERE ts >= ?"
+)
+# Day and month rollups are built from the level below
+_ROLLUP_MERGE_SELECT = (
+    "SELECT TOTAL(samples), "
+    + ", ".join(f"MIN({f}_min), MAX({f}_max), TOTAL({f}_sum), TOTAL({f}_count)"
+        for f in ROLLUP_FIELDS)
+    + ", TOTAL(energy) FROM status_rollup WHERE device = ? AND level = ? AND ts >= ? AND ts < ?"
+)
+
+
+def _hour_start(ts):
+    # local hours, zones with a half hour offset don't start hours at UTC ones
+    t = time.localtime(ts)
+    return int(ts) - t.tm_min * 60 - t.tm_sec
+
+
+def _next_hour_start(hour):
+    return _hour_start(hour + 60 * 60)
+
+
+def _day_start(ts):
+    t = time.localtime(ts)
+    return int(time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+
+def _next_day_start(day):
+    # 26 hours is always inside the next day, even with DST changes
+    return _day_start(day + 26 * 60 * 60)
+
+
+def _month_start(ts):
+    t = time.localtime(ts)
+    return int(time.mktime((t.tm_year, t.tm_mon, 1, 0, 0, 0, 0, 0, -1)))
+
+
+def _next_month_start(month):
+    return _month_start(month + 32 * 24 * 60 * 60)
+
+
+_HISTORY_PENDING = METRICS.gauge(
+    "juicepassproxy_queue_depth",
+    "Operations waiting in internal queues",
+    ("queue",),
+).labels("history")
+_HISTORY_WRITE_TIME = METRICS.histogram(
+    "juicepassproxy_history_write_seconds",
+    "Time spent writing one batch of samples to the history store",
+)
+
+
+def status_message_to_row(message, timestamp):
+    """Build the history row of a decoded JuiceboxStatusMessage"""
+    row = [message.get_value("serial"), timestamp]
+    for field in HISTORY_FIELDS:
+        try:
+            row.append(message.get_processed_value(field))
+        except (KeyError, TypeError, ValueError):
+            row.append(None)
+    return tuple(row)
+
+
+class JuiceboxHistory:
+    """
+    Embedded history of decoded status messages.
+
+    Samples are stored on SQLite (WAL mode), the event loop only appends to an
+    in memory batch that is written by a single worker thread every
+    HISTORY_FLUSH_INTERVAL seconds or when HISTORY_BATCH_SIZE samples are pending.
+    """
+
+    def __init__(
+        self,
+        history_loc,
+        retention_days,
+        filename=HISTORY_DB,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        batch_size=HISTORY_BATCH_SIZE,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._db_loc = Path(history_loc)
+        self._db_loc.mkdir(parents=True, exist_ok=True)
+        self._db_loc = self._db_loc.joinpath(filename)
+        self._retention = retention_days * 24 * 60 * 60
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._pending = []
+        self._db = None
+        # sqlite connection is only used from this thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self._flush_task = None
+        self._flush_event = None
+        self._last_prune = 0
+        _HISTORY_PENDING.set_function(lambda: len(self._pending))
+
+    async def start(self):
+        _LOGGER.info(f"Starting JuiceboxHistory at {self._db_loc}")
+        await self._run(self._open)
+        self._flush_event = asyncio.Event()
+        self._flush_task = asyncio.create_task(self._flush_loop(), name="history_flush")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self._run(self._close_db)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    # Worker thread side
+
+    def _open(self):
+        self._db = sqlite3.connect(self._db_loc, check_same_thread=False)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        columns = [
+            row[1] for row in self._db.execute("PRAGMA table_info(status_rollup)")
+        ]
+        if columns and columns != ["device", "level", "ts"] + _ROLLUP_COLUMNS:
+            # rollups from an older layout are rebuilt from the raw samples
+            _LOGGER.info("Dropping history rollups with an old layout")
+            self._db.executescript(
+                "DROP TABLE status_rollup; DROP TABLE IF EXISTS rollup_state;"
+            )
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._rebuild_rollups()
+
+    def _close_db(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _write(self, rows):
+        start = time.perf_counter()
+        dirty = {}
+        last = {}
+        hour = next_hour = 0
+        for row in rows:
+            device, ts = row[0], row[1]
+            if not hour <= ts < next_hour:
+                hour = _hour_start(ts)
+                next_hour = _next_hour_start(hour)
+            # next hour energy starts from the last sample of this one
+            dirty.setdefault(device, set()).update((hour, next_hour))
+            last[device] = max(last.get(device, ts), ts)
+        with self._db:
+            self._db.executemany(_INSERT, rows)
+            for device, hours in dirty.items():
+                self._rollup(device, hours)
+            self._db.executemany(
+                "INSERT INTO rollup_state (device, ts) VALUES (?, ?) "
+                "ON CONFLICT(device) DO UPDATE SET ts = MAX(ts, excluded.ts)",
+                list(last.items()),
+            )
+        _HISTORY_WRITE_TIME.observe(time.perf_counter() - start)
+
+    def _rollup(self, device, hours):
+        """Rebuild the hour rollups of device and the days/months containing them"""
+        days = set()
+        for hour in hours:
+            self._store_rollup(
+                device,
+                ROLLUP_HOUR,
+                hour,
+                self._db.execute(
+                    _ROLLUP_HOUR_SELECT,
+                    (device, _next_hour_start(hour), device, hour, hour, hour),
+                ).fetchone(),
+            )
+            days.add(_day_start(hour))
+        months = set()
+        for day in days:
+            self._store_rollup(
+                device,
+                ROLLUP_DAY,
+                day,
+                self._db.execute(
+                    _ROLLUP_MERGE_SELECT,
+                    (device, ROLLUP_HOUR, day, _next_day_start(day)),
+                ).fetchone(),
+            )
+            months.add(_month_start(day))
+        for month in months:
+            self._store_rollup(
+                device,
+                ROLLUP_MONTH,
+                month,
+                self._db.execute(
+                    _ROLLUP_MERGE_SELECT,
+                    (device, ROLLUP_DAY, month, _next_month_start(month)),
+                ).fetchone(),
+            )
+
+    def _store_rollup(self, device, level, ts, values):
+        if not values[0]:
+            self._db.execute(
+                "DELETE FROM status_rollup WHERE device = ? AND level = ? AND ts = ?",
+                (device, level, ts),
+            )
+        else:
+            self._db.execute(_ROLLUP_INSERT, (device, level, ts) + tuple(values))
+
+    def _rebuild_rollups(self):
+        """
+        Roll up raw samples newer than the watermark of each device, this
+        catches up after a crash or when a database without rollups is opened.
+        """
+        devices = self._db.execute(
+            "SELECT h.device, MIN(h.ts), MAX(h.ts) FROM status_history h "
+            "LEFT JOIN rollup_state r ON r.device = h.device "
+            "WHERE h.ts > COALESCE(r.ts, 0) GROUP BY h.device"
+        ).fetchall()
+        for device, first, last in devices:
+            _LOGGER.info(f"Rebuilding history rollups of {device}")
+            # quarter hours cover every UTC offset, local hours are found from them
+            hours = set(
+                _hour_start(row[0])
+                for row in self._db.execute(
+                    "SELECT DISTINCT CAST(ts / 900 AS INTEGER) * 900 FROM status_history "
+                    "WHERE device = ? AND ts >= ?",
+                    (device, first),
+                )
+            )
+            hours.update(_next_hour_start(hour) for hour in list(hours))
+            with self._db:
+                self._rollup(device, hours)
+                self._db.execute(
+                    "INSERT OR REPLACE INTO rollup_state (device, ts) VALUES (?, ?)",
+                    (device, last),
+                )
+
+    def _prune(self, cutoff):
+        with self._db:
+            deleted = self._db.execute(
+                "DELETE FROM status_history WHERE ts < ?", (cutoff,)
+            ).rowcount
+        if deleted:
+            _LOGGER.info(f"Removed {deleted} history samples older than retention")
+            self._db.execute("PRAGMA incremental_vacuum")
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def _select(self, sql, args):
+        cursor = self._db.execute(sql, args)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # Event loop side
+
+    def add(self, message, timestamp=None):
+        """Queue a decoded status message, O(1) and never blocks the event loop"""
+        self._pending.append(
+            status_message_to_row(message, time.time() if timestamp is None else timestamp)
+        )
+        if len(self._pending) >= self._batch_size and self._flush_event is not None:
+            self._flush_event.set()
+
+    async def status_listener(self, message):
+        self.add(message)
+
+    async def flush(self):
+        if not self._pending or self._db is None:
+            return
+        rows, self._pending = self._pending, []
+        try:
+            await self._run(self._write, rows)
+        except sqlite3.Error as e:
+            _LOGGER.warning(
+                f"Unable to write {len(rows)} samples to history. "
+                f"({e.__class__.__qualname__}: {e})"
+            )
+
+    async def prune(self, now=None):
+        cutoff = (time.time() if now is None else now) - self._retention
+        return await self._run(self._prune, cutoff)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                async with asyncio.timeout(self._flush_interval):
+                    await self._flush_event.wait()
+            except TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+            if time.time() - self._last_prune > HISTORY_PRUNE_INTERVAL:
+                self._last_prune = time.time()
+                try:
+                    await self.prune()
+                except sqlite3.Error as e:
+                    _LOGGER.warning(
+                        f"Unable to prune history. ({e.__class__.__qualname__}: {e})"
+                    )
+
+    async def devices(self):
+        rows = await self._run(
+            self._select, "SELECT DISTINCT device FROM status_history", ()
+        )
+        return [row["device"] for row in rows]
+
+    async def query_range(self, device, start, end, fields=HISTORY_FIELDS):
+        """Raw samples of device with start <= ts < end"""
+        fields = [field for field in fields if field in HISTORY_FIELDS]
+        sql = (
+            f"SELECT ts, {', '.join(fields)} FROM status_history "
+            "WHERE device = ? AND ts >= ? AND ts < ? ORDER BY ts"
+        )
+        return await self._run(self._select, sql, (device, start, end))
+
+    async def query_downsampled(
+        self, device, start, end, step, fields=HISTORY_FIELDS
+    ):
+        """
+        One row per step seconds with the mean of each numeric field (highest
+        value for counters) plus min/max of current and power.
+        """
+        columns = []
+        for field in fields:
+            if field not in HISTORY_FIELDS or field == "status":
+                continue
+            if field in HISTORY_COUNTER_FIELDS:
+                columns.append(f"MAX({field}) AS {field}")
+            else:
+                columns.append(f"AVG({field}) AS {field}")
+        columns.append("MIN(current) AS current_min, MAX(current) AS current_max")
+        columns.append("MAX(power) AS power_max")
+        sql = (
+            f"SELECT CAST(ts / ? AS INTEGER) * ? AS ts, COUNT(*) AS samples, "
+            f"{', '.join(columns)} FROM status_history "
+            "WHERE device = ? AND ts >= ? AND ts < ? "
+            "GROUP BY CAST(ts / ? AS INTEGER) ORDER BY 1"
+        )
+        return await self._run(
+            self._select, sql, (step, step, device, start, end, step)
+        )
+
+    async def query_rollup(self, device, level, start, end):
+        """
+        Rollup rows (hour, day or month) of device with start <= ts < end.
+
+        Each row has min/max/mean of ROLLUP_FIELDS (None when the field was
+        missing from every sample) and the energy (Wh) from energy_lifetime
+        deltas, a year of daily rows is only 365 rows.
+        """
+        if level not in ROLLUP_LEVELS:
+            raise ValueError(f"Invalid rollup level {level}")
+        rows = await self._run(
+            self._select,
+            f"SELECT ts, {', '.join(_ROLLUP_COLUMNS)} FROM status_rollup "
+            "WHERE device = ? AND level = ? AND ts >= ? AND ts < ? ORDER BY ts",
+            (device, level, start, end),
+        )
+        for row in rows:
+            for field in ROLLUP_FIELDS:
+                total = row.pop(f"{field}_sum")
+                count = row.pop(f"{field}_count")
+                row[f"{field}_mean"] = total / count if count else None
+        return rows
+
+    async def http_route(self, query):
+        """
+        /history?device=SERIAL&start=EPOCH&end=EPOCH&step=SECONDS&level=hour|day|month
+
+        Defaults to the last day of the first device, raw samples when step is 0,
+        level selects the rollup tables instead of raw samples. Raises
+        ValueError (400 Bad Request) when start, end or step are not numbers.
+        """
+        device = query.get("device", None)
+        if device is None:
+            devices = await self.devices()
+            device = devices[0] if devices else ""
+        end = float(query.get("end", time.time()))
+        start = float(query.get("start", end - 24 * 60 * 60))
+        step = int(query.get("step", 0))
+        if query.get("level", None) in ROLLUP_LEVELS:
+            rows = await self.query_rollup(device, query["level"], start, end)
+        elif step > 0:
+            rows = await self.query_downsampled(device, start, end, step)
+        else:
+            rows = await self.query_range(device, start, end)
+        return "application/json", json.dumps({"device": device, "samples": rows})
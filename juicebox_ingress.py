@@ -0,0 +1,142 @@
+import ipaddress
+import logging
+import time
+
+from const import (
+    INGRESS_BURST,
+    INGRESS_MAX_DATAGRAM,
+    INGRESS_MAX_SOURCES,
+    INGRESS_RATE,
+    INGRESS_UNKNOWN_RATE,
+)
+from juicebox_metrics import METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+INGRESS_SIZE = "size"
+INGRESS_RATE_LIMITED = "rate"
+INGRESS_PREFIX = "prefix"
+INGRESS_SOURCE = "source"
+
+_DROPPED = METRICS.counter(
+    "juicepassproxy_ingress_dropped_total",
+    "Datagrams dropped before decoding by reason",
+    ("reason",),
+)
+_DROPPED_REASONS = {
+    reason: _DROPPED.labels(reason)
+    for reason in (INGRESS_SIZE, INGRESS_RATE_LIMITED, INGRESS_PREFIX, INGRESS_SOURCE)
+}
+
+# The serial goes before the first colon, 28 digits on known devices
+_MAX_PREFIX = 64
+
+
+class JuiceboxTokenBucket:
+    """rate tokens per second up to burst, one token per datagram"""
+
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class JuiceboxIngressFilter:
+    """
+    Cheap checks of the datagrams that are not from EnelX before they are
+    decoded or allowed to change the JuiceBox address.
+
+    Datagrams over max_size bytes, over rate per second from one source
+    (token bucket of burst datagrams) or without a "<serial>:" prefix are
+    dropped. Once the JuiceBox is known (juicebox_host or a status message
+    with a valid CRC) other sources share a slower bucket and are only
+    learned with a status message of the same serial (juicebox_id or the
+    first one seen), e.g. when DHCP gives the JuiceBox a new address.
+    """
+
+    def __init__(
+        self,
+        juicebox_host=None,
+        juicebox_id=None,
+        max_size=INGRESS_MAX_DATAGRAM,
+        rate=INGRESS_RATE,
+        burst=INGRESS_BURST,
+        unknown_rate=INGRESS_UNKNOWN_RATE,
+        max_sources=INGRESS_MAX_SOURCES,
+        clock=time.monotonic,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._max_size = max_size
+        self._rate = rate
+        self._burst = burst
+        self._max_sources = max_sources
+        self._clock = clock
+        self._serial = juicebox_id or None
+        self._sources = set()
+        if juicebox_host:
+            try:
+                self._sources.add(str(ipaddress.ip_address(juicebox_host)))
+            except ValueError:
+                # A hostname, the address is learned from its status messages
+                pass
+        self._buckets = {}
+        self._unknown_bucket = JuiceboxTokenBucket(unknown_rate, burst, clock())
+
+    def allowed(self, source):
+        """True when source can be the JuiceBox without a status message"""
+        return not self._sources or source in self._sources
+
+    def check(self, data: bytes, source):
+        """None when the datagram can be decoded, the reason to drop it otherwise"""
+        if len(data) > self._max_size:
+            return self._drop(INGRESS_SIZE, source)
+        now = self._clock()
+        if (bucket := self._buckets.get(source, None)) is None:
+            if len(self._buckets) >= self._max_sources:
+                # Forget the oldest source
+                del self._buckets[next(iter(self._buckets))]
+            bucket = self._buckets[source] = JuiceboxTokenBucket(self._rate, self._burst, now)
+        if not bucket.take(now) or (
+            not self.allowed(source) and not self._unknown_bucket.take(now)
+        ):
+            return self._drop(INGRESS_RATE_LIMITED, source)
+        colon = data.find(b":", 0, _MAX_PREFIX)
+        if colon <= 0 or not data[:colon].isdigit():
+            return self._drop(INGRESS_PREFIX, source)
+        return None
+
+    def learn(self, source, serial):
+        """
+        Called with the source and serial of each valid status message,
+        False when the serial is not the one of the JuiceBox.
+        """
+        if self._serial is None:
+            self._serial = serial
+        elif serial != self._serial:
+            return False
+        if source not in self._sources:
+            _LOGGER.info(f"JuiceBox {serial} at {source}")
+            self._sources = {source}
+        return True
+
+    def reject(self, source):
+        """A source that is not the JuiceBox tried to become it"""
+        return self._drop(INGRESS_SOURCE, source)
+
+    def _drop(self, reason, source):
+        _DROPPED_REASONS[reason].inc()
+        _LOGGER.debug("Dropped datagram from %s: %s", source, reason)
+        return reason
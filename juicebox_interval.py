@@ -0,0 +1,175 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+from pathlib import Path
+
+from const import INTERVAL_DB, INTERVAL_SAVE_INTERVAL, INTERVAL_SLOTS
+
+_LOGGER = logging.getLogger(__name__)
+
+SLOT_SECONDS = 24 * 60 * 60 // INTERVAL_SLOTS
+
+
+class JuiceboxDeviceIntervals:
+    """
+    Copy of the 96 slots (15 minutes each) energy memory of one device.
+
+    The device memory is a rolling 24 hours window, each slot keeps the day it
+    belongs to: slots up to the current one are from today, later slots are
+    still from yesterday.
+    """
+
+    __slots__ = ("values", "days", "day")
+
+    def __init__(self, day=0, values=None, days=None):
+        self.values = values or [None] * INTERVAL_SLOTS
+        self.days = days or [0] * INTERVAL_SLOTS
+        self.day = day
+
+    def profile(self, day):
+        intervals = [
+            value if slot_day == day else None
+            for value, slot_day in zip(self.values, self.days)
+        ]
+        return {
+            "date": datetime.date.fromordinal(day).isoformat() if day else None,
+            "intervals": intervals,
+            "total": sum(value for value in intervals if value is not None),
+            "complete": all(value is not None for value in intervals),
+        }
+
+    def to_dict(self):
+        return {"day": self.day, "values": self.values, "days": self.days}
+
+
+class JuiceboxIntervalProfile:
+    """
+    Rebuilds the daily 15 minutes energy profile of each device from the
+    interval (i) field and the energy value (e) sent after it on status messages.
+
+    Each message updates one slot in O(1). When the local day changes the
+    profile of the finished day is published as attributes of the
+    energy_profile entity. Slots are saved to INTERVAL_DB on config_loc so a
+    restart doesn't lose the day.
+    """
+
+    def __init__(self, config_loc, filename=INTERVAL_DB, clock=time.time, loglevel=None):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._file = Path(config_loc)
+        self._file.mkdir(parents=True, exist_ok=True)
+        self._file = self._file.joinpath(filename)
+        self._clock = clock
+        self._devices = {}
+        self._mqtt_handler = None
+        self._changed = False
+        self._last_save = clock()
+        self._load()
+
+    def _load(self):
+        if not self._file.exists():
+            return
+        try:
+            with open(self._file, "r") as file:
+                data = json.load(file)
+            for serial, state in data.items():
+                if (
+                    len(state.get("values", ())) == INTERVAL_SLOTS
+                    and len(state.get("days", ())) == INTERVAL_SLOTS
+                ):
+                    self._devices[serial] = JuiceboxDeviceIntervals(
+                        state["day"], state["values"], state["days"]
+                    )
+            _LOGGER.info(f"Loaded interval profiles of {len(self._devices)} devices")
+        except Exception as e:
+            _LOGGER.warning(
+                f"Can't load {self._file}. ({e.__class__.__qualname__}: {e})"
+            )
+
+    def _write(self, data):
+        tmp_file = self._file.with_suffix(".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(data, file)
+        tmp_file.replace(self._file)
+
+    async def save(self):
+        if not self._changed:
+            return
+        self._changed = False
+        self._last_save = self._clock()
+        data = {serial: device.to_dict() for serial, device in self._devices.items()}
+        try:
+            await asyncio.to_thread(self._write, data)
+        except OSError as e:
+            _LOGGER.warning(
+                f"Can't write to {self._file}. ({e.__class__.__qualname__}: {e})"
+            )
+
+    async def close(self):
+        await self.save()
+
+    async def set_mqtt_handler(self, mqtt_handler):
+        self._mqtt_handler = mqtt_handler
+
+    def update(self, serial, interval, value, timestamp=None):
+        """
+        Store value on slot interval, returns the profile of the previous day
+        when the local day changed or None.
+        """
+        now = datetime.datetime.fromtimestamp(
+            self._clock() if timestamp is None else timestamp
+        )
+        today = now.toordinal()
+        now_slot = (now.hour * 3600 + now.minute * 60 + now.second) // SLOT_SECONDS
+        device = self._devices.get(serial, None)
+        if device is None:
+            device = JuiceboxDeviceIntervals(today)
+            self._devices[serial] = device
+
+        finished = None
+        if today > device.day:
+            if device.day:
+                finished = device.profile(device.day)
+            device.day = today
+
+        if 0 <= interval < INTERVAL_SLOTS:
+            # Slots after the current one still hold yesterday values
+            device.values[interval] = value
+            device.days[interval] = today if interval <= now_slot else today - 1
+            self._changed = True
+        return finished
+
+    def profile(self, serial, day=None):
+        device = self._devices.get(serial, None)
+        if device is None:
+            return None
+        return device.profile(device.day if day is None else day)
+
+    async def status_listener(self, message):
+        if not (message.has_value("interval") and message.has_value("e")):
+            return
+        try:
+            interval = message.get_processed_value("interval")
+            value = int(message.get_value("e"))
+        except (TypeError, ValueError) as e:
+            _LOGGER.debug(f"Invalid interval data. ({e.__class__.__qualname__}: {e})")
+            return
+        serial = message.get_value("serial")
+        finished = self.update(serial, interval, value)
+        if finished is not None:
+            _LOGGER.info(
+                f"Energy profile of {serial} for {finished['date']}: {finished['total']}"
+            )
+            await self._publish(finished)
+            await self.save()
+        elif self._clock() - self._last_save > INTERVAL_SAVE_INTERVAL:
+            await self.save()
+
+    async def _publish(self, profile):
+        if self._mqtt_handler is None:
+            return
+        entity = self._mqtt_handler.get_entity("energy_profile")
+        await entity.set_attributes(profile)
+        await entity.set_state(profile["total"])
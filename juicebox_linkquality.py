@@ -0,0 +1,221 @@
+import json
+import logging
+import time
+
+from const import (
+    LINK_MAX_GAP,
+    LINK_QUALITY_REPORT_INTERVAL,
+    LINK_QUALITY_SAMPLES,
+    LINK_REORDER_WINDOW,
+)
+from juicebox_metrics import METRICS
+from juicebox_mitm import ENELX_ANSWER, ENELX_SENT
+
+_LOGGER = logging.getLogger(__name__)
+
+_LOST = METRICS.counter(
+    "juicepassproxy_link_lost_total",
+    "Status counters skipped between datagrams of the JuiceBox, late ones are counted in juicepassproxy_link_reordered_total too",
+    ("device",),
+)
+_REORDERED = METRICS.counter(
+    "juicepassproxy_link_reordered_total",
+    "Status datagrams of the JuiceBox received after a later counter",
+    ("device",),
+)
+_LOSS = METRICS.gauge(
+    "juicepassproxy_link_loss_ratio",
+    "Recent ratio of status datagrams of the JuiceBox lost on the way to the proxy",
+    ("device",),
+)
+_JITTER = METRICS.gauge(
+    "juicepassproxy_link_jitter_seconds",
+    "Inter-arrival jitter of the status datagrams of the JuiceBox against their report time (t)",
+    ("device",),
+)
+_ENELX_RESPONSE = METRICS.gauge(
+    "juicepassproxy_enelx_response_ratio",
+    "Recent ratio of datagrams forwarded to EnelX that got an answer",
+)
+_ENELX_RTT = METRICS.histogram(
+    "juicepassproxy_enelx_rtt_seconds",
+    "Time from a datagram forwarded to EnelX to its answer",
+)
+
+# Jitter gain of RFC 3550
+_JITTER_GAIN = 1 / 16
+# Smoothed RTT gain of RFC 6298
+_RTT_GAIN = 1 / 8
+
+
+def _average(average, sample, gain):
+    if average is None:
+        return sample
+    return average + gain * (sample - average)
+
+
+class JuiceboxDeviceLink:
+    """O(1) link state of one device from the counter (s) of its status messages"""
+
+    __slots__ = (
+        "counter",
+        "arrival",
+        "received",
+        "lost",
+        "reordered",
+        "resets",
+        "loss",
+        "jitter",
+        "reported",
+    )
+
+    def __init__(self, counter, arrival):
+        self.counter = counter
+        self.arrival = arrival
+        self.received = 1
+        self.lost = 0
+        self.reordered = 0
+        self.resets = 0
+        self.loss = 0.0
+        self.jitter = 0.0
+        self.reported = None
+
+    def to_dict(self):
+        return {
+            "received": self.received,
+            "lost": self.lost,
+            "reordered": self.reordered,
+            "resets": self.resets,
+            "loss": round(self.loss, 4),
+            "jitter": round(self.jitter, 4),
+        }
+
+
+class JuiceboxLinkQuality:
+    """
+    Streaming link quality of the JuiceBox -> proxy and proxy -> EnelX hops.
+
+    Gaps on the status counter (s) are datagrams lost on the JuiceBox Wi-Fi,
+    counters a little behind the last one are late (reordered) datagrams that
+    were counted as lost. The inter-arrival time is compared with the report
+    time (t) the device advertises for jitter like RFC 3550. Datagrams
+    forwarded to EnelX without an answer before the next one lower the
+    response ratio, the answered ones give the RTT. Losses or jitter with good
+    EnelX answers point to the Wi-Fi, slow answers to the Internet side.
+
+    Every update is O(1), loss and response ratios are moving averages over
+    about samples datagrams.
+    """
+
+    def __init__(
+        self,
+        samples=LINK_QUALITY_SAMPLES,
+        report_interval=LINK_QUALITY_REPORT_INTERVAL,
+        clock=time.monotonic,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._gain = 1 / samples
+        self._report_interval = report_interval
+        self._clock = clock
+        self._devices = {}
+        self._mqtt_handler = None
+        # Time of the last datagram forwarded to EnelX while not answered
+        self._enelx_sent = None
+        self._enelx_response = None
+        self._enelx_srtt = None
+        _ENELX_RESPONSE.set_function(lambda: self._enelx_response or 0)
+
+    async def set_mqtt_handler(self, mqtt_handler):
+        self._mqtt_handler = mqtt_handler
+
+    def process(self, serial, counter, report_time=None, arrival=None):
+        """Updates the link of serial with a status counter, returns its JuiceboxDeviceLink"""
+        if arrival is None:
+            arrival = self._clock()
+        link = self._devices.get(serial, None)
+        if link is None:
+            link = self._devices[serial] = JuiceboxDeviceLink(counter, arrival)
+            _LOSS.labels(serial).set_function(lambda: link.loss)
+            _JITTER.labels(serial).set_function(lambda: link.jitter)
+            return link
+
+        gap = counter - link.counter
+        if 0 < gap <= LINK_MAX_GAP:
+            if gap > 1:
+                link.lost += gap - 1
+                _LOST.labels(serial).inc(gap - 1)
+                _LOGGER.debug("Lost %s datagrams from %s before counter %s", gap - 1, serial, counter)
+                # Same as gap - 1 samples of 1
+                link.loss = 1 - (1 - link.loss) * (1 - self._gain) ** (gap - 1)
+            link.loss -= self._gain * link.loss
+            if report_time:
+                transit = (arrival - link.arrival) - report_time * gap
+                link.jitter += _JITTER_GAIN * (abs(transit) - link.jitter)
+            link.counter = counter
+            link.arrival = arrival
+        elif -LINK_REORDER_WINDOW < gap < 0:
+            # Arrived late, it was counted as lost
+            link.reordered += 1
+            link.lost = max(0, link.lost - 1)
+            link.loss = max(0.0, link.loss - self._gain)
+            _REORDERED.labels(serial).inc()
+            _LOGGER.debug("Late datagram from %s with counter %s after %s", serial, counter, link.counter)
+        elif gap != 0:
+            # Device rebooted or counter wrapped
+            link.resets += 1
+            link.counter = counter
+            link.arrival = arrival
+        link.received += 1
+        return link
+
+    def enelx_listener(self, event):
+        """Called by JuiceboxMITM with ENELX_SENT and ENELX_ANSWER"""
+        now = self._clock()
+        if event == ENELX_SENT:
+            if self._enelx_sent is not None:
+                # The previous datagram was not answered
+                self._enelx_response = _average(self._enelx_response, 0.0, self._gain)
+            self._enelx_sent = now
+        elif event == ENELX_ANSWER and self._enelx_sent is not None:
+            rtt = now - self._enelx_sent
+            self._enelx_sent = None
+            self._enelx_response = _average(self._enelx_response, 1.0, self._gain)
+            self._enelx_srtt = _average(self._enelx_srtt, rtt, _RTT_GAIN)
+            _ENELX_RTT.observe(rtt)
+
+    def enelx(self):
+        return {
+            "response": None if self._enelx_response is None else round(self._enelx_response, 4),
+            "rtt": None if self._enelx_srtt is None else round(self._enelx_srtt, 4),
+        }
+
+    async def status_listener(self, message):
+        try:
+            counter = int(message.get_value("counter"))
+            report_time = int(message.get_value("report_time") or 0)
+        except (TypeError, ValueError):
+            return
+        link = self.process(message.get_value("serial"), counter, report_time)
+        if self._mqtt_handler is None:
+            return
+        if link.reported is not None and link.arrival - link.reported < self._report_interval:
+            return
+        link.reported = link.arrival
+        enelx = self.enelx()
+        await self._mqtt_handler.get_entity("link_loss").set_state(round(link.loss * 100, 1))
+        await self._mqtt_handler.get_entity("link_jitter").set_state(round(link.jitter * 1000))
+        if enelx["response"] is not None:
+            await self._mqtt_handler.get_entity("enelx_response").set_state(round(enelx["response"] * 100, 1))
+        if enelx["rtt"] is not None:
+            await self._mqtt_handler.get_entity("enelx_rtt").set_state(round(enelx["rtt"] * 1000))
+
+    async def http_route(self, query):
+        """/link link quality of each device and of EnelX"""
+        return "application/json", json.dumps(
+            {
+                "devices": {serial: link.to_dict() for serial, link in self._devices.items()},
+                "enelx": self.enelx(),
+            }
+        )
@@ -0,0 +1,155 @@
+import gzip
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+from const import (
+    DAYS_TO_KEEP_LOGS,
+    LOG_DATE_FORMAT,
+    LOG_FORMAT,
+    LOG_RATE_LIMIT_BURST,
+    LOG_RATE_LIMIT_INTERVAL,
+)
+
+
+class JuiceboxRateLimitFilter(logging.Filter):
+    """
+    Lets at most burst records of each call site (file and line) pass every
+    interval seconds, the next record passing from that call site tells how
+    many were suppressed. flush() gives the counts of call sites that went
+    silent, the listener writes them so they are not lost.
+    """
+
+    def __init__(
+        self,
+        burst=LOG_RATE_LIMIT_BURST,
+        interval=LOG_RATE_LIMIT_INTERVAL,
+        clock=time.monotonic,
+    ):
+        super().__init__()
+        self._burst = burst
+        self._interval = interval
+        self._clock = clock
+        # call site -> [window start, records in window, suppressed, last suppressed record]
+        self._sites = {}
+        self._next_flush = clock() + interval
+        # flush() runs on the listener thread
+        self._lock = threading.Lock()
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def filter(self, record):
+        now = self._clock()
+        with self._lock:
+            site = self._sites.get((record.pathname, record.lineno), None)
+            if site is None or now - site[0] >= self._interval:
+                suppressed = site[2] if site is not None else 0
+                self._sites[(record.pathname, record.lineno)] = [now, 1, 0, None]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} (suppressed {suppressed} similar)"
+                    record.args = None
+                return True
+            if site[1] < self._burst:
+                site[1] += 1
+                return True
+            site[2] += 1
+            site[3] = record
+            return False
+
+    def flush(self, force=False):
+        """
+        Last suppressed record of each call site whose interval is over (all
+        with force), telling how many others were suppressed. Call sites are
+        only walked once every interval unless forced.
+        """
+        now = self._clock()
+        if not force and now < self._next_flush:
+            return []
+        self._next_flush = now + self._interval
+        records = []
+        with self._lock:
+            for site in self._sites.values():
+                if site[2] and (force or now - site[0] >= self._interval):
+                    record = logging.makeLogRecord(site[3].__dict__)
+                    record.msg = record.getMessage()
+                    record.args = None
+                    if site[2] > 1:
+                        record.msg += f" (suppressed {site[2] - 1} similar)"
+                    records.append(record)
+                    site[2] = 0
+                    site[3] = None
+        return records
+
+
+class JuiceboxQueueListener(QueueListener):
+    """
+    QueueListener that also writes the suppressed counts of the rate limit,
+    at least every interval while running and all of them on stop().
+    """
+
+    def __init__(self, queue, *handlers, rate_limit, respect_handler_level=False):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self._rate_limit = rate_limit
+
+    def dequeue(self, block):
+        while True:
+            self._flush_suppressed()
+            try:
+                return self.queue.get(block, timeout=self._rate_limit.interval)
+            except queue.Empty:
+                pass
+
+    def stop(self):
+        super().stop()
+        self._flush_suppressed(force=True)
+
+    def _flush_suppressed(self, force=False):
+        for record in self._rate_limit.flush(force):
+            self.handle(record)
+
+
+def gzip_namer(name):
+    return name + ".gz"
+
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as source_file, gzip.open(dest, "wb") as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+def rotating_file_handler(log_file, backup_count=DAYS_TO_KEEP_LOGS):
+    """Daily log file, old days are kept compressed"""
+    handler = TimedRotatingFileHandler(log_file, when="midnight", backupCount=backup_count)
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    return handler
+
+
+def setup_logging(handlers, level, rate_limit=None):
+    """
+    Root logger only puts records on a queue, handlers (console and file)
+    write them from the QueueListener thread. Returns the started listener,
+    stop() it before exiting to flush the queue and the suppressed counts.
+    """
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    # Only the message is formatted before the queue
+    queue_handler.setFormatter(logging.Formatter("%(message)s"))
+    if rate_limit is None:
+        rate_limit = JuiceboxRateLimitFilter()
+    queue_handler.addFilter(rate_limit)
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
+    listener = JuiceboxQueueListener(
+        queue_handler.queue, *handlers, rate_limit=rate_limit, respect_handler_level=True
+    )
+    listener.start()
+    return listener
@@ -0,0 +1,156 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from const import (
+    LOOP_MONITOR_INTERVAL,
+    LOOP_REPORT_INTERVAL,
+    LOOP_SLOW_EVENTS,
+)
+from juicebox_metrics import METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+_LOOP_LAG = METRICS.histogram(
+    "juicepassproxy_loop_lag_seconds",
+    "Delay of the event loop running a callback scheduled by the loop monitor",
+)
+_LOOP_BLOCKED = METRICS.counter(
+    "juicepassproxy_loop_blocked_total",
+    "Times the event loop was blocked longer than the slow callback threshold",
+)
+_LOOP_BLOCKED_SECONDS = METRICS.counter(
+    "juicepassproxy_loop_blocked_seconds_total",
+    "Time the event loop was blocked longer than the slow callback threshold",
+)
+
+_SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class JuiceboxLoopMonitor:
+    """
+    A watchdog thread schedules a heartbeat on the event loop every interval
+    seconds and measures how long the loop takes to run it. When it waits more
+    than threshold seconds the loop is blocked: the stack of the loop thread
+    and the running task are sampled to tell which code is blocking.
+    """
+
+    def __init__(
+        self,
+        threshold,
+        interval=LOOP_MONITOR_INTERVAL,
+        report_interval=LOOP_REPORT_INTERVAL,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._threshold = threshold
+        self._interval = interval
+        self._report_interval = report_interval
+        self._loop = None
+        self._loop_thread_id = None
+        self._thread = None
+        self._stop = threading.Event()
+        # Last blocking events, appended by the watchdog thread
+        self._events = collections.deque(maxlen=LOOP_SLOW_EVENTS)
+        self._report_events = []
+        self._max_lag = 0
+
+    async def start(self):
+        _LOGGER.info(f"Starting JuiceboxLoopMonitor (threshold {self._threshold * 1000:.0f} ms)")
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._watchdog, name="JuiceboxLoopMonitor", daemon=True
+        )
+        self._thread.start()
+        while True:
+            await asyncio.sleep(self._report_interval)
+            self.report()
+
+    async def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    def _watchdog(self):
+        while not self._stop.is_set():
+            heartbeat = threading.Event()
+            sent = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(heartbeat.set)
+            except RuntimeError:
+                # Loop closed
+                return
+            if not heartbeat.wait(self._threshold):
+                sample = self._sample()
+                while not heartbeat.wait(self._interval):
+                    if self._stop.is_set():
+                        return
+                self._blocked(time.monotonic() - sent, *sample)
+            lag = time.monotonic() - sent
+            _LOOP_LAG.observe(lag)
+            self._max_lag = max(self._max_lag, lag)
+            self._stop.wait(self._interval)
+
+    def _sample(self):
+        """Running task and stack of the loop thread while blocked"""
+        task = asyncio.current_task(self._loop)
+        frame = sys._current_frames().get(self._loop_thread_id, None)
+        stack = traceback.extract_stack(frame) if frame is not None else []
+        # The innermost frame of JuicePass Proxy code, not of the libraries it calls
+        where = next(
+            (f for f in reversed(stack) if f.filename.startswith(_SOURCE_DIR)),
+            stack[-1] if stack else None,
+        )
+        return (
+            task.get_name() if task is not None else None,
+            f"{os.path.basename(where.filename)}:{where.lineno} {where.name}" if where else None,
+            traceback.format_list(stack[-10:]),
+        )
+
+    def _blocked(self, duration, task, where, stack):
+        _LOOP_BLOCKED.inc()
+        _LOOP_BLOCKED_SECONDS.inc(duration)
+        event = {
+            "time": time.time(),
+            "duration_ms": round(duration * 1000, 1),
+            "task": task,
+            "where": where,
+            "stack": stack,
+        }
+        self._events.append(event)
+        self._report_events.append(event)
+        _LOGGER.warning(
+            f"Event loop blocked for {duration * 1000:.0f} ms by task {task} at {where}"
+        )
+
+    def events(self):
+        return list(self._events)
+
+    def report(self):
+        """Logs a summary of the blocking events since the last report"""
+        events, self._report_events = self._report_events, []
+        max_lag, self._max_lag = self._max_lag, 0
+        if not events:
+            _LOGGER.debug(f"Event loop not blocked, max lag {max_lag * 1000:.1f} ms")
+            return None
+        culprits = collections.Counter(event["where"] for event in events)
+        summary = (
+            f"Event loop blocked {len(events)} times, max lag {max_lag * 1000:.0f} ms, "
+            "most at: " + ", ".join(f"{where} ({count})" for where, count in culprits.most_common(3))
+        )
+        _LOGGER.warning(summary)
+        return summary
+
+    async def http_route(self, query):
+        """/loop last blocking events with their stack samples"""
+        return "application/json", json.dumps({"events": self.events()})
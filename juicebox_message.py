@@ -233,7 +233,7 @@ class JuiceboxMessage:
 
     def parse_values(self):
         # Nothing to do here now
-        _LOGGER.debug(f"No values conversion on base JuiceboxMessage : {self.values}")
+        _LOGGER.debug("No values conversion on base JuiceboxMessage : %s", self.values)
 
     def store_value(self, values, type, value):
         if not type in values:
@@ -250,7 +250,7 @@ class JuiceboxMessage:
                 _LOGGER.error(f"Unable to store duplicate type {type}={value} other_values={values}")
         
     def from_string(self, string: str) -> 'JuiceboxMessage':
-        _LOGGER.info(f"from_string {string}")
+        _LOGGER.debug("from_string %s", string)
         msg = re.search(PAYLOAD_CRC_PATTERN, string)
 
         if msg is None:
@@ -500,7 +500,7 @@ class JuiceboxCommand(JuiceboxMessage):
             self.counter = int(self.values["S"])
             self.values.pop("S")
             
-        _LOGGER.info(f"parse_values values {self.values}")
+        _LOGGER.debug("parse_values values %s", self.values)
 
 
 #
@@ -515,7 +515,7 @@ class JuiceboxDebugMessage(JuiceboxMessage):
         super().__init__(has_crc=False)
 
     def from_string(self, string: str) -> 'JuiceboxMessage':
-        _LOGGER.info(f"from_string {string}")
+        _LOGGER.debug("from_string %s", string)
         #TODO use better regex to remove this end_char on pattern match
         if string.endswith(self.end_char):
             string = string[:-1]
@@ -0,0 +1,341 @@
+import asyncio
+import bisect
+import logging
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bounds (seconds) used by latency histograms, the last bucket is always +Inf
+DEFAULT_LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+METRIC_TYPE_COUNTER = "counter"
+METRIC_TYPE_GAUGE = "gauge"
+METRIC_TYPE_HISTOGRAM = "histogram"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class JuiceboxCounter:
+    """Monotonic counter, the hot path only does one integer addition."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class JuiceboxGauge:
+    """Gauge that holds a value or reads it from a function at collect time."""
+
+    __slots__ = ("value", "_function")
+
+    def __init__(self):
+        self.value = 0
+        self._function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                _LOGGER.debug(f"Unable to collect gauge. ({e.__class__.__qualname__}: {e})")
+                return float("nan")
+        return self.value
+
+    def samples(self, name, labels):
+        yield name, labels, self.get()
+
+
+class JuiceboxHistogram:
+    """
+    Fixed bucket histogram.
+
+    Bucket bounds and counters are allocated when the histogram is created,
+    observe() only does a bisect over a small tuple and increments a list slot.
+    """
+
+    __slots__ = ("_bounds", "_counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self._bounds = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self._bounds + (float("inf"),), self._counts):
+            cumulative += count
+            yield f"{name}_bucket", labels + (("le", _format_value(bound)),), cumulative
+        yield f"{name}_sum", labels, self.sum
+        yield f"{name}_count", labels, self.count
+
+
+class JuiceboxMetricFamily:
+    """
+    A named metric with optional labels.
+
+    Children are created once by labels() and should be kept by the caller so
+    the hot path never has to do a label lookup.
+    """
+
+    def __init__(self, name, documentation, metric_type, labelnames=(), **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        if self.metric_type == METRIC_TYPE_COUNTER:
+            return JuiceboxCounter()
+        if self.metric_type == METRIC_TYPE_HISTOGRAM:
+            return JuiceboxHistogram(**self._kwargs)
+        return JuiceboxGauge()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {values}"
+            )
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key, None)
+        if child is None:
+            child = self._new_child()
+            self._children[key] = child
+        return child
+
+    def remove(self, *values):
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        for key, child in list(self._children.items()):
+            labels = tuple(zip(self.labelnames, key))
+            for sample_name, sample_labels, value in child.samples(self.name, labels):
+                if sample_labels:
+                    label_str = ",".join(
+                        f'{k}="{_escape_label(v)}"' for k, v in sample_labels
+                    )
+                    lines.append(f"{sample_name}{{{label_str}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{sample_name} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class JuiceboxMetricsRegistry:
+    def __init__(self):
+        self._families = {}
+
+    def _register(self, name, documentation, metric_type, labelnames, **kwargs):
+        family = self._families.get(name, None)
+        if family is not None:
+            if family.metric_type != metric_type or family.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} already registered with other definition")
+            return family
+        family = JuiceboxMetricFamily(
+            name, documentation, metric_type, labelnames, **kwargs
+        )
+        self._families[name] = family
+        return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(name, documentation, METRIC_TYPE_COUNTER, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(name, documentation, METRIC_TYPE_GAUGE, labelnames)
+
+    def histogram(
+        self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS
+    ):
+        return self._register(
+            name, documentation, METRIC_TYPE_HISTOGRAM, labelnames, buckets=buckets
+        )
+
+    def get(self, name):
+        return self._families.get(name, None)
+
+    def render(self):
+        return "\n".join(family.render() for family in self._families.values()) + "\n"
+
+
+# Process wide registry used by all JuicePass Proxy components
+METRICS = JuiceboxMetricsRegistry()
+
+
+class JuiceboxMetricsServer:
+    """
+    Very small HTTP server exposing the registry in Prometheus text format.
+
+    Other components can publish extra diagnostic pages with add_route().
+    """
+
+    def __init__(self, host, port, registry=METRICS, loglevel=None):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._host = host
+        self._port = port
+        self._registry = registry
+        self._server = None
+        self._routes = {"/metrics": self._metrics_route}
+
+    @property
+    def port(self):
+        if self._server is not None and self._server.sockets:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    def add_route(self, path, handler):
+        """
+        handler(query: dict) -> (content_type, body) and can be a coroutine.
+        ValueError raised for bad query values is answered with 400 Bad Request.
+        """
+        self._routes[path] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_client, self._host, self._port
+        )
+        _LOGGER.info(f"Metrics endpoint listening at http://{self._host}:{self.port}/metrics")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _metrics_route(self, query):
+        return PROMETHEUS_CONTENT_TYPE, self._registry.render()
+
+    async def _handle_client(self, reader, writer):
+        try:
+            async with asyncio.timeout(5):
+                request_line = await reader.readline()
+                # Discard headers
+                while await reader.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET":
+                await self._respond(writer, 405, "text/plain", "Method Not Allowed\n")
+                return
+            path, _, query_str = parts[1].partition("?")
+            query = {}
+            for item in query_str.split("&"):
+                if "=" in item:
+                    key, value = item.split("=", 1)
+                    query[key] = value
+            handler = self._routes.get(path, None)
+            if handler is None:
+                await self._respond(writer, 404, "text/plain", "Not Found\n")
+                return
+            try:
+                result = handler(query)
+                if asyncio.iscoroutine(result):
+                    result = await result
+            except ValueError as e:
+                await self._respond(writer, 400, "text/plain", f"Bad Request: {e}\n")
+                return
+            except Exception as e:
+                _LOGGER.warning(
+                    f"Metrics endpoint {path} failed. ({e.__class__.__qualname__}: {e})"
+                )
+                await self._respond(writer, 500, "text/plain", "Internal Server Error\n")
+                return
+            content_type, body = result
+            await self._respond(writer, 200, content_type, body)
+        except Exception as e:
+            _LOGGER.warning(
+                f"Metrics endpoint request failed. ({e.__class__.__qualname__}: {e})"
+            )
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, content_type, body):
+        reason = {
+            200: "OK",
+            400: "Bad Request",
+            404: "Not Found",
+            405: "Method Not Allowed",
+            500: "Internal Server Error",
+        }.get(status, "Error")
+        payload = body.encode("utf-8") if isinstance(body, str) else body
+        writer.write(
+            (
+                f"HTTP/1.0 {status} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("latin-1")
+            + payload
+        )
+        await writer.drain()
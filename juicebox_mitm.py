@@ -5,19 +5,72 @@ import time
 
 import asyncio_dgram
 from const import (
+    ENELX_FAILOVER_UNANSWERED,
     ERROR_LOOKBACK_MIN,
-    MAX_ERROR_COUNT,
     MAX_RETRY_ATTEMPT,
+    MITM_HANDLER_MAX_TIMEOUT,
+    MITM_HANDLER_MIN_TIMEOUT,
     MITM_HANDLER_TIMEOUT,
+    MITM_RECV_MAX_TIMEOUT,
+    MITM_RECV_MIN_TIMEOUT,
     MITM_RECV_TIMEOUT,
     MITM_SEND_DATA_TIMEOUT,
 )
+from juicebox_adaptivetimeout import JuiceboxAdaptiveTimeout
+from juicebox_dedup import JuiceboxDuplicateFilter
+from juicebox_errorbudget import BREAKER_OPEN, JuiceboxCircuitBreaker, JuiceboxErrorBudget
+from juicebox_ingress import JuiceboxIngressFilter
 from juicebox_message import JuiceboxCommand, JuiceboxStatusMessage, JuiceboxEncryptedMessage, JuiceboxDebugMessage, juicebox_message_from_bytes
+from juicebox_metrics import METRICS
+from juicebox_tracing import TRACER, trace_mark
 
 # Began with https://github.com/rsc-dev/pyproxy and rewrote when moving to async.
 
 _LOGGER = logging.getLogger(__name__)
 
+_FORWARD_LATENCY = METRICS.histogram(
+    "juicepassproxy_udp_forward_seconds",
+    "Time from UDP receive until the datagram is forwarded",
+    ("direction",),
+)
+_FORWARD_TO_ENELX = _FORWARD_LATENCY.labels("to_enelx")
+_FORWARD_TO_JUICEBOX = _FORWARD_LATENCY.labels("to_juicebox")
+_DECODE_TIME = METRICS.histogram(
+    "juicepassproxy_decode_seconds",
+    "Time spent decoding a datagram in juicebox_message_from_bytes",
+)
+_COMMAND_TIME = METRICS.histogram(
+    "juicepassproxy_command_seconds",
+    "Time spent building and sending a command to the JuiceBox",
+    ("stage",),
+)
+_COMMAND_BUILD_TIME = _COMMAND_TIME.labels("build")
+_COMMAND_SEND_TIME = _COMMAND_TIME.labels("send")
+_MESSAGES = METRICS.counter(
+    "juicepassproxy_messages_total",
+    "Messages received by type",
+    ("type",),
+)
+_MESSAGES_STATUS = _MESSAGES.labels("status")
+_MESSAGES_DEBUG = _MESSAGES.labels("debug")
+_MESSAGES_ENCRYPTED = _MESSAGES.labels("encrypted")
+_MESSAGES_INVALID = _MESSAGES.labels("invalid")
+_MESSAGES_CMD = _MESSAGES.labels("cmd")
+_QUEUE_DEPTH = METRICS.gauge(
+    "juicepassproxy_queue_depth",
+    "Operations waiting in internal queues",
+    ("queue",),
+)
+_SEND_QUEUE_DEPTH = _QUEUE_DEPTH.labels("udp_send")
+_OUTAGES = METRICS.counter(
+    "juicepassproxy_juicebox_outages_total",
+    "Times the JuiceBox stopped sending for longer than the receive timeout",
+)
+
+# Events given to the EnelX listeners
+ENELX_SENT = "sent"
+ENELX_ANSWER = "answer"
+
 
 class JuiceboxMITM:
 
@@ -31,12 +84,19 @@ class JuiceboxMITM:
         mqtt_handler=None,
         loglevel=None,
         reuse_port=True,
+        juicebox_host=None,
+        juicebox_id=None,
     ):
         if loglevel is not None:
             _LOGGER.setLevel(loglevel)
         self._jpp_addr = jpp_addr
         self._enelx_addr = enelx_addr
         self._juicebox_addr = None
+        # EnelX addresses used before a change, late answers from them are not the JuiceBox
+        self._old_enelx_ips = set()
+        # Datagrams forwarded to EnelX since its last answer
+        self._enelx_unanswered = 0
+        self._enelx_failover_handler = None
         self._ignore_enelx = ignore_enelx
         self._local_mitm_handler = local_mitm_handler
         self._remote_mitm_handler = remote_mitm_handler
@@ -46,18 +106,43 @@ class JuiceboxMITM:
         self._mitm_loop_task: asyncio.Task = None
         self._sending_lock = asyncio.Lock()
         self._dgram = None
-        self._error_count = 0
-        self._error_timestamp_list = []
+        self._errors = JuiceboxErrorBudget("mitm")
+        self._enelx_breaker = JuiceboxCircuitBreaker("enelx")
+        self._socket_breaker = JuiceboxCircuitBreaker("socket")
+        self._duplicates = JuiceboxDuplicateFilter(loglevel=loglevel)
+        # Checked before decoding the datagrams not from EnelX
+        self._ingress = JuiceboxIngressFilter(juicebox_host, juicebox_id, loglevel=loglevel)
+        # Learned from the time between datagrams of the JuiceBox and its report time
+        self._recv_timeout = JuiceboxAdaptiveTimeout(
+            MITM_RECV_TIMEOUT, MITM_RECV_MIN_TIMEOUT, MITM_RECV_MAX_TIMEOUT, name="mitm_recv"
+        )
+        self._handler_timeout = JuiceboxAdaptiveTimeout(
+            MITM_HANDLER_TIMEOUT,
+            MITM_HANDLER_MIN_TIMEOUT,
+            MITM_HANDLER_MAX_TIMEOUT,
+            name="mitm_handler",
+        )
+        self._last_juicebox_recv = None
+        # Time the JuiceBox was reported offline
+        self._outage_start = None
         # Last command sent to juicebox device
         self._last_command = None
         # Last message received from juicebox device
         self._last_status_message = None
         self._first_status_message_timestamp = None
         self._boot_timestamp = None
+        # Coroutines called with every decoded JuiceboxStatusMessage
+        self._status_listeners = []
+        # Functions called with the address of every datagram from the JuiceBox, must not block
+        self._traffic_listeners = []
+        # Functions called with ENELX_SENT or ENELX_ANSWER for the datagrams to and from EnelX, must not block
+        self._enelx_listeners = []
 
     async def start(self) -> None:
         _LOGGER.info(f"Starting JuiceboxMITM at {self._jpp_addr[0]}:{self._jpp_addr[1]} reuse_port={self._reuse_port}")
         _LOGGER.debug(f"EnelX: {self._enelx_addr[0]}:{self._enelx_addr[1]}")
+        # Errors before a restart by the supervisor are already counted there
+        self._errors.reset()
 
         await self._connect()
 
@@ -69,16 +154,16 @@ class JuiceboxMITM:
 
     async def _connect(self):
         connect_attempt = 1
-        while (
-            self._dgram is None
-            and connect_attempt <= MAX_RETRY_ATTEMPT
-            and self._error_count < MAX_ERROR_COUNT
-        ):
-            if connect_attempt != 1:
+        while self._dgram is None and not self._errors.exhausted():
+            if not self._socket_breaker.allow():
+                retry_in = max(self._socket_breaker.retry_in(), 1)
                 _LOGGER.debug(
-                    "Retrying UDP Server Startup. Attempt "
-                    f"{connect_attempt} of {MAX_RETRY_ATTEMPT}"
+                    f"UDP Server Startup circuit open. Retrying in {retry_in:.0f} sec"
                 )
+                await asyncio.sleep(retry_in)
+                continue
+            if connect_attempt != 1:
+                _LOGGER.debug(f"Retrying UDP Server Startup. Attempt {connect_attempt}")
             connect_attempt += 1
             try:
                 if self._sending_lock.locked():
@@ -90,17 +175,19 @@ class JuiceboxMITM:
                         self._dgram = await asyncio_dgram.bind(
                             self._jpp_addr, reuse_port=self._reuse_port
                         )
+                self._socket_breaker.record_success()
             except OSError as e:
                 _LOGGER.warning(
                     "JuiceboxMITM UDP Server Startup Error. Reconnecting. "
                     f"({e.__class__.__qualname__}: {e})"
                 )
                 await self._add_error()
+                self._socket_breaker.record_failure()
                 self._dgram = None
-                pass
-            await asyncio.sleep(5)
+                await asyncio.sleep(5)
         if self._dgram is None:
             raise ChildProcessError("JuiceboxMITM: Unable to start MITM UDP Server.")
+        _LOGGER.info(f"JuiceboxMITM listening at {self._jpp_addr[0]}:{self._jpp_addr[1]}")
         if self._mitm_loop_task is None or self._mitm_loop_task.done():
             self._mitm_loop_task = await self._mitm_loop()
             self._loop.create_task(self._mitm_loop_task)
@@ -108,58 +195,109 @@ class JuiceboxMITM:
 
     async def _mitm_loop(self) -> None:
         _LOGGER.debug("Starting JuiceboxMITM Loop")
-        while self._error_count < MAX_ERROR_COUNT:
+        while not self._errors.exhausted():
             if self._dgram is None:
                 _LOGGER.warning("JuiceboxMITM Reconnecting.")
                 await self._add_error()
                 await self._connect()
                 continue
             # _LOGGER.debug("Listening")
+            recv_timeout = self._recv_timeout.get()
             try:
-                async with asyncio.timeout(MITM_RECV_TIMEOUT):
+                async with asyncio.timeout(recv_timeout):
                     data, remote_addr = await self._dgram.recv()
+                recv_time = time.perf_counter()
             except asyncio_dgram.TransportClosed:
                 _LOGGER.warning("JuiceboxMITM Connection Lost.")
                 await self._add_error()
+                self._socket_breaker.record_failure()
                 self._dgram = None
                 continue
-            except TimeoutError as e:
+            except TimeoutError:
+                # A silent JuiceBox is not a socket problem, keep listening
+                if self._outage_start is None:
+                    self._outage_start = self._last_juicebox_recv or time.perf_counter() - recv_timeout
+                    _OUTAGES.inc()
                 _LOGGER.warning(
-                    f"No Message Received after {MITM_RECV_TIMEOUT} sec. "
-                    f"({e.__class__.__qualname__}: {e})"
+                    f"No Message Received after {time.perf_counter() - self._outage_start:.0f} sec. "
+                    "JuiceBox offline?"
                 )
-                await self._add_error()
-                self._dgram = None
+                self._recv_timeout.expired()
                 continue
+            trace = TRACER.start(recv_time)
+            handler_timeout = self._handler_timeout.get()
             try:
-                async with asyncio.timeout(MITM_HANDLER_TIMEOUT):
-                    await self._main_mitm_handler(data, remote_addr)
+                async with asyncio.timeout(handler_timeout):
+                    await self._main_mitm_handler(data, remote_addr, recv_time)
+                self._handler_timeout.observe(time.perf_counter() - recv_time)
             except TimeoutError as e:
                 _LOGGER.warning(
-                    f"MITM Handler timeout after {MITM_HANDLER_TIMEOUT} sec. "
+                    f"MITM Handler timeout after {handler_timeout:.1f} sec. "
                     f"({e.__class__.__qualname__}: {e})"
                 )
                 await self._add_error()
-                self._dgram = None
+                self._handler_timeout.expired()
+            finally:
+                if trace is not None:
+                    TRACER.finish(trace)
         raise ChildProcessError(
-            f"JuiceboxMITM: More than {self._error_count} errors in the last "
+            f"JuiceboxMITM: More than {self._errors.count()} errors in the last "
             f"{ERROR_LOOKBACK_MIN} min."
         )
 
 
+    def _observe_juicebox_recv(self, recv_time):
+        if self._outage_start is not None:
+            _LOGGER.info(f"JuiceBox back after {recv_time - self._outage_start:.0f} sec.")
+            self._outage_start = None
+            self._recv_timeout.backoff = 1
+        elif self._last_juicebox_recv is not None:
+            # The gap of an outage is not a report interval
+            self._recv_timeout.observe(recv_time - self._last_juicebox_recv)
+        self._last_juicebox_recv = recv_time
+
+    def _decode_juicebox_status(self, data, source):
+        """
+        The decoded message when data from a new source is a status message with
+        a valid CRC and the serial of the JuiceBox, None otherwise.
+        """
+        decode_start = time.perf_counter()
+        try:
+            message = juicebox_message_from_bytes(data)
+        except Exception:
+            return None
+        finally:
+            _DECODE_TIME.observe(time.perf_counter() - decode_start)
+        if isinstance(message, JuiceboxStatusMessage) and self._ingress.learn(
+            source, message.get_value("serial")
+        ):
+            return message
+        return None
+
     def _booted_in_less_than(self, seconds):
         return self._boot_timestamp and ((time.time() - self._boot_timestamp) < seconds)
             
-    async def _message_decode(self, data : bytes):
-        decoded_message = None
+    async def _message_decode(self, data : bytes, decoded_message=None):
+        # decoded_message is given when data was already decoded by the ingress checks
         try:
-            decoded_message = juicebox_message_from_bytes(data)
+            if decoded_message is None:
+                decode_start = time.perf_counter()
+                try:
+                    decoded_message = juicebox_message_from_bytes(data)
+                finally:
+                    _DECODE_TIME.observe(time.perf_counter() - decode_start)
             if isinstance(decoded_message, JuiceboxEncryptedMessage):
+                _MESSAGES_ENCRYPTED.inc()
                 # encrypted are not supported now
                 # directory server can set the encripted mode, to disable the JuiceBox must be blocked to access the Directory Server
                 _LOGGER.error("Encrypted messages are not supported yet, please restart yout Juicebox device without internet connection to be able to use unencrypted messages")
             elif isinstance(decoded_message, JuiceboxStatusMessage):
+                _MESSAGES_STATUS.inc()
                 self._last_status_message = decoded_message
+                try:
+                    self._recv_timeout.set_expected(int(decoded_message.get_value("report_time") or 0))
+                except ValueError:
+                    pass
                 if self._first_status_message_timestamp is None:
                    self._first_status_message_timestamp = time.time()
                 elapsed = int(time.time() - self._first_status_message_timestamp)
@@ -191,41 +329,99 @@ class JuiceboxMITM:
 
                 #TODO we still have a problem on v07 protocol that does not send the current_max_offline
                 # the entity will not be updated
+
+                await self._notify_status_listeners(decoded_message)
+                trace_mark("status_listeners")
                             
             elif isinstance(decoded_message, JuiceboxDebugMessage):
+                _MESSAGES_DEBUG.inc()
                 if decoded_message.is_boot():
                     self._boot_timestamp = time.time()
+            elif isinstance(decoded_message, JuiceboxCommand):
+                _MESSAGES_CMD.inc()
             else:
                 _LOGGER.exception(f"Unexpected juicebox message type {decoded_message}")
           
         except Exception as e:
+            _MESSAGES_INVALID.inc()
             _LOGGER.exception(f"Not a valid juicebox message |{data}| {e}")
         
         return decoded_message
     
-    async def _main_mitm_handler(self, data: bytes, from_addr: tuple[str, int]):
+    async def _main_mitm_handler(
+        self, data: bytes, from_addr: tuple[str, int], recv_time: float = None
+    ):
         if data is None or from_addr is None:
             return
+        if recv_time is None:
+            recv_time = time.perf_counter()
 
         # _LOGGER.debug(f"JuiceboxMITM Recv: {data} from {from_addr}")
-        if from_addr[0] != self._enelx_addr[0]:
-            self._juicebox_addr = from_addr
+        # Status message of the JuiceBox from a new source, decoded to learn it
+        learned_message = None
+        if (
+            from_addr[0] != self._enelx_addr[0]
+            and from_addr[0] not in self._old_enelx_ips
+        ):
+            # Other senders on the LAN must not take the JuiceBox address nor the decoder
+            if self._ingress.check(data, from_addr[0]) is not None:
+                trace_mark("classify", "dropped")
+                return
+            if from_addr != self._juicebox_addr:
+                if not self._ingress.allowed(from_addr[0]):
+                    learned_message = self._decode_juicebox_status(data, from_addr[0])
+                    if learned_message is None:
+                        self._ingress.reject(from_addr[0])
+                        trace_mark("classify", "dropped")
+                        return
+                self._juicebox_addr = from_addr
 
         if from_addr == self._juicebox_addr:
-            # Must decode message to give correct command response based on version
-            # Also this decoded message can will passed to the mqtt handler to skip a new decoding
-            decoded_message = await self._message_decode(data)
+            trace_mark("classify", "juicebox")
+            self._observe_juicebox_recv(recv_time)
+            for listener in self._traffic_listeners:
+                listener(from_addr)
+            # A retransmission is forwarded unchanged, it was already decoded and published
+            duplicate = self._duplicates.is_duplicate(data)
+            if duplicate:
+                decoded_message = None
+                trace_mark("duplicate")
+            else:
+                # Must decode message to give correct command response based on version
+                # Also this decoded message can will passed to the mqtt handler to skip a new decoding
+                decoded_message = await self._message_decode(data, learned_message)
+                trace_mark("decode")
+                if learned_message is None and isinstance(decoded_message, JuiceboxStatusMessage):
+                    self._ingress.learn(from_addr[0], decoded_message.get_value("serial"))
 
-            data = await self._local_mitm_handler(data, decoded_message)
+                data = await self._local_mitm_handler(data, decoded_message)
+                trace_mark("local_handler")
 
             if self._ignore_enelx:
                 # Keep sending responses to local juicebox like the enelx servers using last values
                 # the responses should be send only to valid JuiceboxStatusMessages
-                if isinstance(decoded_message, JuiceboxStatusMessage):
+                # a retransmission may be for a lost response
+                if duplicate or isinstance(decoded_message, JuiceboxStatusMessage):
                     await self.send_cmd_message_to_juicebox(new_values=False)
             else:
                 try:
-                    await self.send_data(data, self._enelx_addr)
+                    # Dropped by the open breaker, nothing went to EnelX
+                    if await self.send_data(
+                        data,
+                        self._enelx_addr,
+                        recv_time=recv_time,
+                        breaker=self._enelx_breaker,
+                    ) and (duplicate or isinstance(decoded_message, JuiceboxStatusMessage)):
+                        # EnelX only answers status messages
+                        self._enelx_unanswered += 1
+                        for listener in self._enelx_listeners:
+                            listener(ENELX_SENT)
+                        if (
+                            self._enelx_unanswered >= ENELX_FAILOVER_UNANSWERED
+                            and self._enelx_failover_handler is not None
+                        ):
+                            self._enelx_unanswered = 0
+                            await self._enelx_failover_handler()
                 except OSError as e:
                     _LOGGER.warning(
                         f"JuiceboxMITM OSError {errno.errorcode[e.errno]} "
@@ -236,11 +432,20 @@ class JuiceboxMITM:
                         f"{errno.errorcode[e.errno]}|{e}"
                     )
                     await self._add_error()
+                    self._enelx_breaker.record_failure()
         elif self._juicebox_addr is not None and from_addr == self._enelx_addr:
+            trace_mark("classify", "enelx")
+            _MESSAGES_CMD.inc()
+            # A datagram from EnelX is the proof that the server is reachable
+            self._enelx_breaker.record_success()
+            self._enelx_unanswered = 0
+            for listener in self._enelx_listeners:
+                listener(ENELX_ANSWER)
             if not self._ignore_enelx:
                 data = await self._remote_mitm_handler(data)
+                trace_mark("remote_handler")
                 try:
-                    await self.send_data(data, self._juicebox_addr)
+                    await self.send_data(data, self._juicebox_addr, recv_time=recv_time)
                 except OSError as e:
                     _LOGGER.warning(
                         f"JuiceboxMITM OSError {errno.errorcode[e.errno]} "
@@ -254,11 +459,29 @@ class JuiceboxMITM:
             else:
                 _LOGGER.info(f"JuiceboxMITM Ignoring From EnelX: {data}")
         else:
+            trace_mark("classify", "unknown")
             _LOGGER.warning(f"JuiceboxMITM Unknown address: {from_addr}")
 
     async def send_data(
-        self, data: bytes, to_addr: tuple[str, int], blocking_time: int = 0.1
+        self,
+        data: bytes,
+        to_addr: tuple[str, int],
+        blocking_time: int = 0.1,
+        recv_time: float = None,
+        breaker: JuiceboxCircuitBreaker = None,
     ):
+        """
+        Send data, retrying up to MAX_RETRY_ATTEMPT times.
+
+        When a circuit breaker is given the data is dropped while the breaker is
+        open and a failing destination stops the retries as soon as the breaker
+        opens, returning False instead of raising ChildProcessError.
+        """
+        if breaker is not None and not breaker.allow():
+            _LOGGER.debug(
+                f"JuiceboxMITM Not sending to {to_addr}: {breaker.name} circuit is {breaker.state}"
+            )
+            return False
         sent = False
         send_attempt = 1
         while not sent and send_attempt <= MAX_RETRY_ATTEMPT:
@@ -273,6 +496,8 @@ class JuiceboxMITM:
                 _LOGGER.warning("JuiceboxMITM Reconnecting.")
                 await self._connect()
 
+            # Counts the sends waiting for (or holding) the sending lock
+            _SEND_QUEUE_DEPTH.inc()
             try:
                 async with asyncio.timeout(MITM_SEND_DATA_TIMEOUT):
                     async with self._sending_lock:
@@ -283,18 +508,39 @@ class JuiceboxMITM:
                                 "JuiceboxMITM Connection Lost while Sending."
                             )
                             await self._add_error()
+                            self._socket_breaker.record_failure()
                             self._dgram = None
                         else:
                             sent = True
+                            trace_mark("send", to_addr)
+                            if recv_time is not None:
+                                (
+                                    _FORWARD_TO_ENELX
+                                    if to_addr == self._enelx_addr
+                                    else _FORWARD_TO_JUICEBOX
+                                ).observe(time.perf_counter() - recv_time)
             except TimeoutError as e:
                 _LOGGER.warning(
                     f"Send Data timeout after {MITM_SEND_DATA_TIMEOUT} sec. "
                     f"({e.__class__.__qualname__}: {e})"
                 )
                 await self._add_error()
+            finally:
+                _SEND_QUEUE_DEPTH.dec()
+            if not sent and breaker is not None:
+                breaker.record_failure()
+                if breaker.state == BREAKER_OPEN:
+                    break
             await asyncio.sleep(max(blocking_time, 0.1))
         if not sent:
+            if breaker is not None:
+                _LOGGER.warning(
+                    f"JuiceboxMITM Unable to send data to {to_addr}, "
+                    f"{breaker.name} circuit is {breaker.state}"
+                )
+                return False
             raise ChildProcessError("JuiceboxMITM: Unable to send data.")
+        return True
 
         # _LOGGER.debug(f"JuiceboxMITM Sent: {data} to {to_addr}")
 
@@ -337,7 +583,7 @@ class JuiceboxMITM:
            message.offline_amperage = int(self._mqtt_handler.get_entity("current_max_offline_set").state)
            message.instant_amperage = int(self._mqtt_handler.get_entity("current_max_online_set").state)
            
-       _LOGGER.info(f"command message = {message} new_values={new_values} new_version={new_version}")
+       _LOGGER.info("command message = %s new_values=%s new_version=%s", message, new_values, new_version)
 
        self._last_command = message;
        return message.build()
@@ -349,26 +595,74 @@ class JuiceboxMITM:
           
        elif self._mqtt_handler.get_entity("act_as_server").is_on():
 
+          build_start = time.perf_counter()
           cmd_message = await self.__build_cmd_message(new_values)
+          _COMMAND_BUILD_TIME.observe(time.perf_counter() - build_start)
           if cmd_message:
-              _LOGGER.info(f"Sending command to juicebox {cmd_message} new_values={new_values}")
+              _LOGGER.info("Sending command to juicebox %s new_values=%s", cmd_message, new_values)
+              send_start = time.perf_counter()
               await self.send_data(cmd_message.encode('utf-8'), self._juicebox_addr)
+              _COMMAND_SEND_TIME.observe(time.perf_counter() - send_start)
 
     async def set_mqtt_handler(self, mqtt_handler):
         self._mqtt_handler = mqtt_handler
 
+    @property
+    def last_status_message(self):
+        return self._last_status_message
+
+    @property
+    def last_command(self):
+        return self._last_command
+
+    async def restore_state(self, status_message=None, command=None):
+        # State saved before a restart, only used until the device sends new data
+        if self._last_status_message is None:
+            self._last_status_message = status_message
+        if self._last_command is None:
+            self._last_command = command
+
+    async def set_enelx_addr(self, enelx_addr):
+        # Next datagram from the JuiceBox goes to the new address, no need to rebind
+        if enelx_addr == self._enelx_addr:
+            return
+        _LOGGER.info(
+            f"EnelX address changed from {self._enelx_addr[0]}:{self._enelx_addr[1]} "
+            f"to {enelx_addr[0]}:{enelx_addr[1]}"
+        )
+        self._old_enelx_ips.add(self._enelx_addr[0])
+        self._old_enelx_ips.discard(enelx_addr[0])
+        self._enelx_addr = enelx_addr
+        self._enelx_unanswered = 0
+        self._enelx_breaker.record_success()
+
+    async def set_enelx_failover_handler(self, enelx_failover_handler):
+        # Awaited when EnelX stops answering the datagrams forwarded to it
+        self._enelx_failover_handler = enelx_failover_handler
+
     async def set_local_mitm_handler(self, local_mitm_handler):
         self._local_mitm_handler = local_mitm_handler
 
     async def set_remote_mitm_handler(self, remote_mitm_handler):
         self._remote_mitm_handler = remote_mitm_handler
 
+    async def add_status_listener(self, listener):
+        self._status_listeners.append(listener)
+
+    async def add_traffic_listener(self, listener):
+        self._traffic_listeners.append(listener)
+
+    async def add_enelx_listener(self, listener):
+        self._enelx_listeners.append(listener)
+
+    async def _notify_status_listeners(self, decoded_message):
+        for listener in self._status_listeners:
+            try:
+                await listener(decoded_message)
+            except Exception as e:
+                _LOGGER.warning(
+                    f"Status listener {listener} failed. ({e.__class__.__qualname__}: {e})"
+                )
+
     async def _add_error(self):
-        self._error_timestamp_list.append(time.time())
-        time_cutoff = time.time() - (ERROR_LOOKBACK_MIN * 60)
-        temp_list = list(
-            filter(lambda el: el > time_cutoff, self._error_timestamp_list)
-        )
-        self._error_timestamp_list = temp_list
-        self._error_count = len(self._error_timestamp_list)
-        _LOGGER.debug(f"Errors in last {ERROR_LOOKBACK_MIN} min: {self._error_count}")
+        self._errors.add()
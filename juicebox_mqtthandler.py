@@ -1,18 +1,106 @@
 import asyncio
+import json
 import logging
+import re
 import time
 
-import ha_mqtt_discoverable.sensors as ha_mqtt
-from const import ERROR_LOOKBACK_MIN, VERSION  # MAX_ERROR_COUNT,
-from ha_mqtt_discoverable import DeviceInfo, Settings
-from paho.mqtt.client import Client, MQTTMessage
+from const import VERSION
+from paho.mqtt.client import MQTT_ERR_SUCCESS, Client, MQTTMessage
+from juicebox_errorbudget import JuiceboxCircuitBreaker, JuiceboxErrorBudget
 from juicebox_message import JuiceboxStatusMessage, JuiceboxDebugMessage, JuiceboxEncryptedMessage
+from juicebox_metrics import METRICS
+from juicebox_tracing import trace_mark
 
 _LOGGER = logging.getLogger(__name__)
 MQTT_SENDING_ENTITIES = ["text", "number", "switch", "button"]
 
+# Discovery fields of each entity type with their default and type, in the order
+# and with the values that ha_mqtt_discoverable 0.13 used to publish them
+_MQTT_COMMON_FIELDS = (
+    ("device", None, None),
+    ("device_class", None, None),
+    ("enabled_by_default", None, None),
+    ("entity_category", None, None),
+    ("expire_after", None, None),
+    ("force_update", None, None),
+    ("icon", None, None),
+    ("name", None, None),
+    ("object_id", None, None),
+    ("qos", None, None),
+    ("unique_id", None, None),
+)
+MQTT_ENTITY_SCHEMA = {
+    "sensor": _MQTT_COMMON_FIELDS + (
+        ("unit_of_measurement", None, None),
+        ("state_class", None, None),
+    ),
+    "switch": _MQTT_COMMON_FIELDS + (
+        ("optimistic", None, None),
+        ("payload_off", "OFF", None),
+        ("payload_on", "ON", None),
+        ("retain", None, None),
+        ("state_topic", None, None),
+    ),
+    "button": _MQTT_COMMON_FIELDS + (
+        ("payload_press", "PRESS", None),
+        ("retain", None, None),
+    ),
+    "text": _MQTT_COMMON_FIELDS + (
+        ("max", 255, int),
+        ("min", 0, int),
+        ("mode", "text", None),
+        ("pattern", None, None),
+        ("retain", None, None),
+    ),
+    "number": _MQTT_COMMON_FIELDS + (
+        ("max", 100, float),
+        ("min", 1, float),
+        ("mode", None, None),
+        ("optimistic", None, None),
+        ("payload_reset", None, None),
+        ("retain", None, None),
+        ("state_topic", None, None),
+        ("step", None, float),
+        ("unit_of_measurement", None, None),
+    ),
+}
+
+_PUBLISH_TIME = METRICS.histogram(
+    "juicepassproxy_mqtt_publish_seconds",
+    "Time spent publishing one decoded message to MQTT",
+)
+_REPUBLISH_TIME = METRICS.histogram(
+    "juicepassproxy_mqtt_republish_seconds",
+    "Time spent republishing discovery and states after Home Assistant came online",
+)
+
+
+def clean_string(raw):
+    # MQTT Discovery protocol only allows [a-zA-Z0-9_-]
+    return re.sub(r"[^A-Za-z0-9_-]", "-", raw)
+
 
 class JuiceboxMQTTEntity:
+    __slots__ = (
+        "name",
+        "entity_type",
+        "_kwargs",
+        "_state",
+        "attributes",
+        "_publisher",
+        "_loop",
+        "experimental",
+        "_unique_id",
+        "_mitm_handler",
+        "_add_error",
+        "_broker_breaker",
+        "config_topic",
+        "state_topic",
+        "attributes_topic",
+        "wrote_configuration",
+        "_config_message",
+    )
+
     def __init__(
         self,
         name,
@@ -24,10 +112,11 @@ class JuiceboxMQTTEntity:
         self._process_kwargs()
         self._state = None
         self.attributes = {}
-        self._mqtt = None
+        self._publisher = None
         self._loop = asyncio.get_running_loop()
+        self.wrote_configuration = False
+        self._config_message = None
         # self.entity_type  # Each use of this class to create a child class needs to set this variable in __init__
-        # self._set_func  # Each use of this class to create a child class needs to set this variable in __init__
 
     def add_kwargs(self, **kwargs):
         self._kwargs.update(kwargs)
@@ -44,56 +133,88 @@ class JuiceboxMQTTEntity:
         self._unique_id = f"{self._kwargs.get('juicebox_id', None)} {self.name}"
         self._mitm_handler = self._kwargs.get("mitm_handler", None)
         self._add_error = self._kwargs.get("add_error_func", None)
+        self._broker_breaker = self._kwargs.get("broker_breaker", None)
 
     @property
     def state(self):
         return self._state
 
+    def _set_topics(self):
+        mqtt_settings = self._kwargs.get("mqtt", self._kwargs.get("mqtt_settings", None))
+        entity_topic = f"{self.entity_type}"
+        if (device := self._kwargs.get("device", None)) is not None:
+            entity_topic += f"/{clean_string(device['name'])}"
+        entity_topic += f"/{clean_string(self.name)}"
+        self.config_topic = f"{mqtt_settings.discovery_prefix}/{entity_topic}/config"
+        self.state_topic = f"{mqtt_settings.state_prefix}/{entity_topic}/state"
+        self.attributes_topic = f"{mqtt_settings.state_prefix}/{entity_topic}/attributes"
+        return mqtt_settings, entity_topic
+
+    def discovery_config(self):
+        config = {"component": self.entity_type}
+        for key, default, cast in MQTT_ENTITY_SCHEMA[self.entity_type]:
+            value = self._kwargs.get(key, None)
+            if value is not None and cast is not None:
+                value = cast(value)
+            elif value is None:
+                value = default
+            if value is not None:
+                config[key] = value
+        config["state_topic"] = self.state_topic
+        config["json_attributes_topic"] = self.attributes_topic
+        # All entities of the device follow the same availability topic
+        if (availability_topic := self._kwargs.get("availability_topic", None)) is not None:
+            config["availability_topic"] = availability_topic
+        return config
+
     async def start(self):
-        entity_info_keys = getattr(
-            ha_mqtt, f"{self.entity_type.title()}Info"
-        ).__fields__.keys()
-        entity_info = {}
-        for key in entity_info_keys:
-            if self._kwargs.get(key, None) is not None:
-                entity_info.update({key: self._kwargs.get(key, None)})
-        self._mqtt = getattr(ha_mqtt, f"{self.entity_type.title()}")(
-            Settings(
-                mqtt=self._kwargs.get("mqtt", self._kwargs.get("mqtt_settings", None)),
-                entity=getattr(ha_mqtt, f"{self.entity_type.title()}Info").parse_obj(
-                    entity_info
-                ),
-            )
-        )
+        self._set_topics()
+        self._config_message = json.dumps(self.discovery_config())
+        self._publisher = self._kwargs.get("publisher", None)
 
         if self._kwargs.get("initial_state", None) is not None:
             await self.set(self._kwargs.get("initial_state", None))
 
-    async def close(self):
-        if self._mqtt is not None:
-            self._mqtt.mqtt_client.disconnect()
+    def write_config(self):
+        self._publisher.publish(self.config_topic, self._config_message)
+        self.wrote_configuration = True
+
+    def _publish(self, payload, topic=None):
+        # The discovery config goes first, entities show on Home Assistant with their first state
+        if not self.wrote_configuration:
+            self.write_config()
+        self._publisher.publish(topic or self.state_topic, payload)
+
+    async def republish(self):
+        """Publishes again the discovery config and last state, only for entities already on Home Assistant"""
+        if self._publisher is None or not self.wrote_configuration:
+            return False
+        self.write_config()
+        if self._state is not None:
+            await self.set(self._state)
+        if self.attributes:
+            await self.set_attributes(self.attributes)
+        return True
 
     async def set_state(self, state):
         await self.set(state)
 
+    def _state_payload(self, state):
+        return str(state)
+
     async def set(self, state=None):
         self._state = state
+        # The state is kept for the MITM but nothing is published while the broker circuit is open
+        if self._broker_breaker is not None and not self._broker_breaker.allow():
+            return
         try:
-            if self.entity_type == 'number':
-                # float to be used by any number, JuiceboxMessage will use int
-                getattr(self._mqtt, self._set_func)(float(state))
-            elif self.entity_type == 'switch':
-                # This works with ha-mqtt-discoverable after v0.14.0 
-                # but for ARM we need older version 
-                # getattr(self._mqtt, self._set_func)(state.lower() == 'on')
-                # workaround calling the on/off methods
-                if (state.lower() == 'on'):
-                   self._mqtt.on()
-                else:
-                   self._mqtt.off()
-            else:
-                getattr(self._mqtt, self._set_func)(state)
+            self._publish(self._state_payload(state))
+            trace_mark("publish", self.name)
+            if self._broker_breaker is not None:
+                self._broker_breaker.record_success()
         except AttributeError as e:
+            if self._broker_breaker is not None:
+                self._broker_breaker.record_failure()
             if self._add_error is not None:
                 await self._add_error()
             _LOGGER.warning(
@@ -104,9 +225,15 @@ class JuiceboxMQTTEntity:
 
     async def set_attributes(self, attr={}):
         self.attributes = attr
+        if self._broker_breaker is not None and not self._broker_breaker.allow():
+            return
         try:
-            self._mqtt.set_attributes(attr)
+            self._publish(json.dumps(attr), self.attributes_topic)
+            if self._broker_breaker is not None:
+                self._broker_breaker.record_success()
         except AttributeError as e:
+            if self._broker_breaker is not None:
+                self._broker_breaker.record_failure()
             if self._add_error is not None:
                 await self._add_error()
             _LOGGER.warning(
@@ -117,6 +244,8 @@ class JuiceboxMQTTEntity:
 
 
 class JuiceboxMQTTSendingEntity(JuiceboxMQTTEntity):
+    __slots__ = ("command_timestamp", "command_topic")
+
     def __init__(
         self,
         name,
@@ -126,24 +255,21 @@ class JuiceboxMQTTSendingEntity(JuiceboxMQTTEntity):
         super().__init__(name, **kwargs)
         self.command_timestamp = None
 
+    def _set_topics(self):
+        mqtt_settings, entity_topic = super()._set_topics()
+        self.command_topic = f"{mqtt_settings.state_prefix}/{entity_topic}/command"
+        return mqtt_settings, entity_topic
+
+    def discovery_config(self):
+        config = super().discovery_config()
+        config["command_topic"] = self.command_topic
+        return config
+
     async def start(self):
-        entity_info_keys = getattr(
-            ha_mqtt, f"{self.entity_type.title()}Info"
-        ).__fields__.keys()
-        entity_info = {}
-        for key in entity_info_keys:
-            if self._kwargs.get(key, None) is not None:
-                entity_info.update({key: self._kwargs.get(key, None)})
-        self._mqtt = getattr(ha_mqtt, f"{self.entity_type.title()}")(
-            Settings(
-                mqtt=self._kwargs.get("mqtt", self._kwargs.get("mqtt_settings", None)),
-                entity=getattr(ha_mqtt, f"{self.entity_type.title()}Info").parse_obj(
-                    entity_info
-                ),
-            ),
-            command_callback=self._callback,
-            user_data=self._kwargs.get("user_data", None),
-        )
+        self._set_topics()
+        self._config_message = json.dumps(self.discovery_config())
+        self._publisher = self._kwargs.get("publisher", None)
+        self._publisher.subscribe(self.command_topic, self._callback)
 
         if self._kwargs.get("initial_state", None) is not None:
             await self.set(self._kwargs.get("initial_state", None))
@@ -154,7 +280,11 @@ class JuiceboxMQTTSendingEntity(JuiceboxMQTTEntity):
             await self.set(self.name)
 
     def _callback(self, client: Client, user_data, message: MQTTMessage):
-        self._loop.create_task(self._callback_async(client, user_data, message))
+        # Called by the MQTT network thread
+        self._loop.call_soon_threadsafe(
+            self._loop.create_task,
+            self._callback_async(client, self._kwargs.get("user_data", None), message),
+        )
 
     async def _callback_async(self, client: Client, user_data, message: MQTTMessage):
         """
@@ -186,6 +316,8 @@ class JuiceboxMQTTSendingEntity(JuiceboxMQTTEntity):
 
 
 class JuiceboxMQTTSensor(JuiceboxMQTTEntity):
+    __slots__ = ()
+
     def __init__(
         self,
         name,
@@ -193,11 +325,12 @@ class JuiceboxMQTTSensor(JuiceboxMQTTEntity):
     ):
         # _LOGGER.debug(f"Sensor Init: {name}")
         self.entity_type = "sensor"
-        self._set_func = "set_state"
         super().__init__(name, **kwargs)
 
 
 class JuiceboxMQTTNumber(JuiceboxMQTTSendingEntity):
+    __slots__ = ()
+
     def __init__(
         self,
         name,
@@ -205,12 +338,21 @@ class JuiceboxMQTTNumber(JuiceboxMQTTSendingEntity):
     ):
         # _LOGGER.debug(f"Number Init: {name}")
         self.entity_type = "number"
-        self._set_func = "set_value"
         super().__init__(name, **kwargs)
 
+    def _state_payload(self, state):
+        # float to be used by any number, JuiceboxMessage will use int
+        value = float(state)
+        minimum = self._kwargs.get("min", 1)
+        maximum = self._kwargs.get("max", 100)
+        if not minimum <= value <= maximum:
+            raise RuntimeError(f"Value is not within configured boundaries [{minimum}, {maximum}]")
+        return str(value)
 
 
 class JuiceboxMQTTSwitch(JuiceboxMQTTSendingEntity):
+    __slots__ = ()
+
     def __init__(
         self,
         name,
@@ -218,19 +360,49 @@ class JuiceboxMQTTSwitch(JuiceboxMQTTSendingEntity):
     ):
         # _LOGGER.debug(f"Switch Init: {name}")
         self.entity_type = "switch"
-        self._set_func = "update_state"
         super().__init__(name, **kwargs)
 
+    def _state_payload(self, state):
+        return "ON" if state.lower() == 'on' else "OFF"
 
     def is_on(self):
 
         if type(self.state) is str:
            return self.state.lower() == 'on'
-           
+
         return self.state
 
 
+class JuiceboxMQTTButton(JuiceboxMQTTSendingEntity):
+    __slots__ = ()
+
+    def __init__(
+        self,
+        name,
+        **kwargs,
+    ):
+        # _LOGGER.debug(f"Button Init: {name}")
+        self.entity_type = "button"
+        super().__init__(name, **kwargs)
+
+    async def set(self, state=None):
+        # Buttons have no state, only the discovery config is published
+        self._state = state
+        if self._publisher is not None:
+            self.write_config()
+
+    async def _callback_async(self, client: Client, user_data, message: MQTTMessage):
+        _LOGGER.info(f"Button Callback ({self.name})")
+        press_func = self._kwargs.get("press_func", None)
+        if press_func is not None:
+            await press_func()
+        else:
+            _LOGGER.warning(f"{self.name} has nothing to do")
+
+
 class JuiceboxMQTTText(JuiceboxMQTTSendingEntity):
+    __slots__ = ()
+
     def __init__(
         self,
         name,
@@ -238,13 +410,90 @@ class JuiceboxMQTTText(JuiceboxMQTTSendingEntity):
     ):
         # _LOGGER.debug(f"Text Init: {name}")
         self.entity_type = "text"
-        self._set_func = "set_text"
         super().__init__(name, **kwargs)
 
+    def _state_payload(self, state):
+        text = str(state)
+        minimum = self._kwargs.get("min", 0)
+        maximum = self._kwargs.get("max", 255)
+        if not minimum <= len(text) <= maximum:
+            raise RuntimeError(f"Text is not within configured length boundaries [{minimum}, {maximum}]")
+        return text
+
     async def set_text(self, state):
         await self.set(state)
 
 
+class JuiceboxMQTTPublisher:
+    """
+    The only MQTT connection of the device, shared by all its entities. The
+    availability topic is the Last Will, when JuicePass Proxy goes away the
+    broker marks all entities offline. Also listens to the Home Assistant
+    birth message and to the command topics of the entities.
+    """
+
+    def __init__(self, mqtt_settings, availability_topic, birth_topic, birth_callback):
+        self._mqtt_settings = mqtt_settings
+        self.availability_topic = availability_topic
+        self.birth_topic = birth_topic
+        self._birth_callback = birth_callback
+        self._loop = asyncio.get_running_loop()
+        self._client = None
+        # Command topics, subscribed again on every connection
+        self._subscriptions = {}
+
+    async def start(self):
+        self._client = Client(self._mqtt_settings.client_name)
+        if self._mqtt_settings.username:
+            self._client.username_pw_set(
+                self._mqtt_settings.username, password=self._mqtt_settings.password
+            )
+        if self._mqtt_settings.tls_key or self._mqtt_settings.use_tls:
+            self._client.tls_set(
+                ca_certs=self._mqtt_settings.tls_ca_cert,
+                certfile=self._mqtt_settings.tls_certfile,
+                keyfile=self._mqtt_settings.tls_key,
+            )
+        self._client.will_set(self.availability_topic, "offline", retain=True)
+        self._client.on_connect = self._on_connect
+        self._client.message_callback_add(self.birth_topic, self._on_birth)
+        for topic, callback in self._subscriptions.items():
+            self._client.message_callback_add(topic, callback)
+        result = self._client.connect(self._mqtt_settings.host, self._mqtt_settings.port)
+        if result != MQTT_ERR_SUCCESS:
+            raise RuntimeError("Error while connecting to MQTT broker")
+        self._client.loop_start()
+
+    async def close(self):
+        if self._client is not None:
+            self._client.publish(self.availability_topic, "offline", retain=True)
+            self._client.disconnect()
+            self._client.loop_stop()
+            self._client = None
+
+    def publish(self, topic, payload, retain=True):
+        return self._client.publish(topic, payload, retain=retain)
+
+    def subscribe(self, topic, callback):
+        """callback(client, user_data, message) is called by the MQTT network thread"""
+        self._subscriptions[topic] = callback
+        if self._client is not None:
+            self._client.message_callback_add(topic, callback)
+            if self._client.is_connected():
+                self._client.subscribe(topic, qos=1)
+
+    def _on_connect(self, client: Client, user_data, flags, rc):
+        # Also called on reconnections, the broker may have published the Last Will
+        client.publish(self.availability_topic, "online", retain=True)
+        client.subscribe(self.birth_topic, qos=1)
+        for topic in list(self._subscriptions):
+            client.subscribe(topic, qos=1)
+
+    def _on_birth(self, client: Client, user_data, message: MQTTMessage):
+        if message.payload.decode() == "online":
+            self._loop.call_soon_threadsafe(self._loop.create_task, self._birth_callback())
+
+
 class JuiceboxMQTTHandler:
     def __init__(
         self,
@@ -267,27 +516,32 @@ class JuiceboxMQTTHandler:
         # Try to use first the MAX_CURRENT as maximum, if not found use the previous run current_rating or default of 48 which is safe and not so big
         self._max_current = config.get_device(self._juicebox_id, "MAX_CURRENT", config.get_device(self._juicebox_id, "current_rating", 48))
         _LOGGER.info(f"max_current: {self._max_current}")
-        self._error_count = 0
-        self._error_timestamp_list = []
-
-        self._device = DeviceInfo(
-            name=self._device_name,
-            identifiers=(
+        self._errors = JuiceboxErrorBudget("mqtt")
+        self._broker_breaker = JuiceboxCircuitBreaker("broker")
+
+        self._device = {
+            "name": self._device_name,
+            "model": "JuiceBox",
+            "manufacturer": "EnelX",
+            "sw_version": VERSION,
+            "identifiers": (
                 [self._juicebox_id]
                 if self._juicebox_id is not None
                 else [self._device_name]
             ),
-            connections=[
+            "connections": [
                 (
                     ["JuiceBox ID", self._juicebox_id]
                     if self._juicebox_id is not None
                     else []
                 )
             ],
-            manufacturer="EnelX",
-            model="JuiceBox",
-            sw_version=VERSION,
-            via_device="JuicePass Proxy",
+        }
+        self._publisher = JuiceboxMQTTPublisher(
+            self._mqtt_settings,
+            availability_topic=f"{self._mqtt_settings.state_prefix}/{clean_string(self._device_name)}/availability",
+            birth_topic=f"{self._mqtt_settings.discovery_prefix}/status",
+            birth_callback=self.republish,
         )
 
         self._entities = {
@@ -394,6 +648,52 @@ class JuiceboxMQTTHandler:
                 device_class="power_factor",
                 expire_after=7200,
             ),
+            # Total of the last complete day, the 96 interval values are on the attributes
+            "energy_profile": JuiceboxMQTTSensor(
+                name="Energy Profile (Last Day)",
+                icon="mdi:chart-bar",
+                expire_after=0, # Only updated once a day
+            ),
+            # Energy of the last finished session, the session record is on the attributes
+            "last_session": JuiceboxMQTTSensor(
+                name="Last Session Energy",
+                device_class="energy",
+                unit_of_measurement="kWh",
+                expire_after=0, # Only updated when the car is unplugged
+            ),
+            # Link quality of the JuiceBox Wi-Fi and of EnelX, published by JuiceboxLinkQuality
+            "link_loss": JuiceboxMQTTSensor(
+                name="Link Loss",
+                state_class="measurement",
+                unit_of_measurement="%",
+                icon="mdi:wifi-alert",
+                entity_category="diagnostic",
+                expire_after=7200,
+            ),
+            "link_jitter": JuiceboxMQTTSensor(
+                name="Link Jitter",
+                state_class="measurement",
+                device_class="duration",
+                unit_of_measurement="ms",
+                entity_category="diagnostic",
+                expire_after=7200,
+            ),
+            "enelx_response": JuiceboxMQTTSensor(
+                name="EnelX Response Rate",
+                state_class="measurement",
+                unit_of_measurement="%",
+                icon="mdi:cloud-check",
+                entity_category="diagnostic",
+                expire_after=7200,
+            ),
+            "enelx_rtt": JuiceboxMQTTSensor(
+                name="EnelX RTT",
+                state_class="measurement",
+                device_class="duration",
+                unit_of_measurement="ms",
+                entity_category="diagnostic",
+                expire_after=7200,
+            ),
             # Make possible to control from HA when juicepassproxy will act as ENEL X server for the juicebox
             # Will only work when ignoring ENEL X server
             "act_as_server": JuiceboxMQTTSwitch(
@@ -424,6 +724,13 @@ class JuiceboxMQTTHandler:
                 entity_category="diagnostic",
                 expire_after=0, # Keep last message available
             ),
+            # Profile JuicePass Proxy, files are written to the log location
+            "profile": JuiceboxMQTTButton(
+                name="Profile JuicePass Proxy",
+                enabled_by_default=False,
+                icon="mdi:speedometer",
+                entity_category="diagnostic",
+            ),
             "send_to_juicebox": JuiceboxMQTTText(
                 name="Send Command to JuiceBox",
                 user_data="RAW",
@@ -445,17 +752,26 @@ class JuiceboxMQTTHandler:
                 device=self._device,
                 mqtt_settings=self._mqtt_settings,
                 add_error_func=self._add_error,
+                broker_breaker=self._broker_breaker,
+                publisher=self._publisher,
+                availability_topic=self._publisher.availability_topic,
             )
             if entity.entity_type in MQTT_SENDING_ENTITIES:
                 entity.add_kwargs(mitm_handler=self._mitm_handler)
 
     def get_entity(self, name):
         return self._entities[name]
+
+    def set_initial_state(self, key, state):
+        # Only for entities without an initial_state on config, must be called before start
+        if self._config.get_device(self._juicebox_id, key + "_initial_state", None) is None:
+            _LOGGER.info(f"restored initial_state : {key} -> {state}")
+            self._entities[key].add_kwargs(initial_state=state)
         
     async def start(self):
         _LOGGER.info("Starting JuiceboxMQTTHandler")
 
-        # while self._error_count < MAX_ERROR_COUNT:
+        await self._publisher.start()
         mqtt_task_list = []
         for entity in self._entities.values():
             if entity.experimental is False or self._experimental is True:
@@ -465,8 +781,23 @@ class JuiceboxMQTTHandler:
         )
 
     async def close(self):
+        await self._publisher.close()
+
+    async def republish(self):
+        """Home Assistant restarted, sends discovery and the last known states in one burst"""
+        republish_start = time.perf_counter()
+        republished = 0
         for entity in self._entities.values():
-            await entity.close()
+            if await entity.republish():
+                republished += 1
+        elapsed = time.perf_counter() - republish_start
+        _REPUBLISH_TIME.observe(elapsed)
+        _LOGGER.info(
+            f"Home Assistant is online, republished {republished} entities in {elapsed * 1000:.1f} ms"
+        )
+
+    async def set_profile_handler(self, profile_func):
+        self._entities["profile"].add_kwargs(press_func=profile_func)
 
     async def set_mitm_handler(self, mitm_handler):
         self._mitm_handler = mitm_handler
@@ -488,9 +819,17 @@ class JuiceboxMQTTHandler:
         if key in message:
             self._config.update_device_value(self._juicebox_id, key, message[key])
             await self._config.write_if_changed()
+            trace_mark("config_write", key)
             
     async def _basic_message_publish(self, message):
-        _LOGGER.debug(f"Publish {message.get('type').title()} Message: {message}")
+        publish_start = time.perf_counter()
+        try:
+            await self._basic_message_publish_entities(message)
+        finally:
+            _PUBLISH_TIME.observe(time.perf_counter() - publish_start)
+
+    async def _basic_message_publish_entities(self, message):
+        _LOGGER.debug("Publish %s Message: %s", message.get('type').title(), message)
 
         # try:
         attributes = {}
@@ -526,7 +865,7 @@ class JuiceboxMQTTHandler:
 
     async def remote_mitm_handler(self, data):
         try:
-            _LOGGER.debug(f"From EnelX: {data}")
+            _LOGGER.debug("From EnelX: %s", data)
             if (
                 self._experimental
                 and self._entities.get("data_from_enelx", None) is not None
@@ -551,7 +890,7 @@ class JuiceboxMQTTHandler:
     async def local_mitm_handler(self, data, decoded_message):
         message = None
         try:
-            _LOGGER.debug(f"From JuiceBox: {data} decoded={decoded_message}")            
+            _LOGGER.debug("From JuiceBox: %s decoded=%s", data, decoded_message)            
             if "JuiceboxMITM_OSERROR" in str(data):
                 message = await self._udp_mitm_oserror_message_parse(data)
                 
@@ -565,7 +904,7 @@ class JuiceboxMQTTHandler:
             else:
                 _LOGGER.error(f"should never arrive here, message is unsupported {data} {decoded_message}")
         
-            _LOGGER.debug(f"decode/parsed message = {message}")
+            _LOGGER.debug("decode/parsed message = %s", message)
             
             if message:
                 # Something is wrong if device is changed
@@ -591,11 +930,4 @@ class JuiceboxMQTTHandler:
         #    )
 
     async def _add_error(self):
-        self._error_timestamp_list.append(time.time())
-        time_cutoff = time.time() - (ERROR_LOOKBACK_MIN * 60)
-        temp_list = list(
-            filter(lambda el: el > time_cutoff, self._error_timestamp_list)
-        )
-        self._error_timestamp_list = temp_list
-        self._error_count = len(self._error_timestamp_list)
-        _LOGGER.debug(f"Errors in last {ERROR_LOOKBACK_MIN} min: {self._error_count}")
+        self._errors.add()
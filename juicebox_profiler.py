@@ -0,0 +1,137 @@
+import asyncio
+import collections
+import cProfile
+import json
+import logging
+import os
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from const import PROFILE_DURATION, PROFILE_MAX_DURATION, PROFILE_SAMPLE_INTERVAL
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class JuiceboxProfiler:
+    """
+    Profiles the running proxy for a while: a thread samples the stacks of all
+    threads (sys._current_frames) into collapsed stacks (flame graph input) and
+    cProfile records the event loop thread into a pstats file. Both are written
+    to path. The loop keeps running, UDP forwarding is only slowed by cProfile.
+    """
+
+    def __init__(
+        self,
+        path,
+        duration=PROFILE_DURATION,
+        interval=PROFILE_SAMPLE_INTERVAL,
+        max_duration=PROFILE_MAX_DURATION,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._path = Path(path)
+        self._duration = duration
+        self._max_duration = max_duration
+        self._interval = interval
+        self._running = False
+        self._task = None
+
+    @property
+    def running(self):
+        return self._running
+
+    async def profile(self, duration=None):
+        """Returns the written files, None if a profile is already running"""
+        if self._running:
+            _LOGGER.warning("Profile already running")
+            return None
+        self._running = True
+        duration = duration or self._duration
+        _LOGGER.warning(f"Profiling JuicePass Proxy for {duration} sec")
+        stacks = collections.Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample, args=(stop, stacks), name="JuiceboxProfiler", daemon=True
+        )
+        profiler = cProfile.Profile()
+        try:
+            sampler.start()
+            profiler.enable()
+            await asyncio.sleep(duration)
+        finally:
+            profiler.disable()
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            self._running = False
+        base = self._path.joinpath(
+            f"juicepassproxy_profile_{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        )
+        try:
+            files = await asyncio.to_thread(self._write, base, profiler, stacks)
+        except OSError as e:
+            _LOGGER.warning(
+                f"Can't write profile to {self._path}. ({e.__class__.__qualname__}: {e})"
+            )
+            return None
+        _LOGGER.warning(f"Profile written: {files}")
+        return files
+
+    def _sample(self, stop, stacks):
+        own = threading.get_ident()
+        while not stop.wait(self._interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(
+                        f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+
+    def _write(self, base, profiler, stacks):
+        self._path.mkdir(parents=True, exist_ok=True)
+        collapsed = base.with_suffix(".collapsed")
+        with open(collapsed, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        pstats_file = base.with_suffix(".pstats")
+        profiler.dump_stats(pstats_file)
+        return {
+            "collapsed": str(collapsed),
+            "pstats": str(pstats_file),
+            "samples": sum(stacks.values()),
+        }
+
+    def start_profile(self):
+        """Starts a profile in background, for signal handlers"""
+        # The loop only keeps a weak reference to tasks
+        self._task = asyncio.get_running_loop().create_task(self.profile())
+        self._task.add_done_callback(self._profile_done)
+
+    def _profile_done(self, task):
+        if self._task is task:
+            self._task = None
+
+    async def http_route(self, query):
+        """
+        /profile?seconds=N runs a profile of at most max_duration seconds and
+        returns the written files, ValueError when N is not a positive number.
+        """
+        duration = None
+        if "seconds" in query:
+            duration = float(query["seconds"])
+            # Also false for nan
+            if not duration > 0:
+                raise ValueError(f"seconds must be positive: {query['seconds']}")
+            duration = min(duration, self._max_duration)
+        files = await self.profile(duration)
+        return "application/json", json.dumps(
+            files if files is not None else {"error": "profile already running"}
+        )
@@ -0,0 +1,197 @@
+import datetime
+import logging
+import time
+
+from juicebox_message import (
+    STATUS_CHARGING,
+    STATUS_PLUGGED_IN,
+    STATUS_UNPLUGGED,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+SESSION_PLUG_IN = "plug_in"
+SESSION_CHARGE_START = "charge_start"
+SESSION_CHARGE_STOP = "charge_stop"
+SESSION_UNPLUG = "unplug"
+
+
+def _counter_delta(last, value):
+    """
+    Energy added between two readings of a counter. A lower value means the
+    counter was reset so everything after the reset is new energy.
+    """
+    if last is None or value is None:
+        return 0
+    if value >= last:
+        return value - last
+    return value
+
+
+class JuiceboxDeviceSession:
+    """O(1) state of the current session of one device"""
+
+    __slots__ = (
+        "status",
+        "plugged_at",
+        "charge_start",
+        "charge_end",
+        "last_ts",
+        "session_last",
+        "lifetime_last",
+        "session_energy",
+        "lifetime_energy",
+        "peak_current",
+        "voltage_sum",
+        "voltage_count",
+    )
+
+    def __init__(self):
+        self.status = None
+        self.reset(None)
+
+    def reset(self, timestamp):
+        self.plugged_at = timestamp
+        self.charge_start = None
+        self.charge_end = None
+        self.last_ts = timestamp
+        # energy_session starts from zero on each session
+        self.session_last = 0
+        self.lifetime_last = None
+        self.session_energy = 0
+        self.lifetime_energy = 0
+        self.peak_current = 0
+        self.voltage_sum = 0.0
+        self.voltage_count = 0
+
+    def energy(self):
+        # Both counters can only miss energy: lifetime deltas miss what was
+        # charged before the first message seen on the session (lost plug in,
+        # proxy restart) and energy_session misses what was charged between
+        # the last reading and a counter reset
+        return max(self.lifetime_energy, self.session_energy)
+
+
+def _iso(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+
+
+class JuiceboxSessionTracker:
+    """
+    Streaming charging session detector fed with decoded JuiceboxStatusMessage.
+
+    A session goes from plug in to unplug, charge start/stop inside it are
+    tracked too. Missing transitions (lost datagrams, Unplugged -> Charging) are
+    filled in so each session is closed once. process() only depends on the
+    timestamp given so recorded traffic can be replayed at any speed.
+    """
+
+    def __init__(self, loglevel=None):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._devices = {}
+        self._mqtt_handler = None
+
+    async def set_mqtt_handler(self, mqtt_handler):
+        self._mqtt_handler = mqtt_handler
+
+    def process(self, message, timestamp=None):
+        """Returns (events, session record or None)"""
+        if timestamp is None:
+            timestamp = time.time()
+        serial = message.get_value("serial")
+        session = self._devices.get(serial, None)
+        if session is None:
+            session = JuiceboxDeviceSession()
+            self._devices[serial] = session
+
+        status = message.get_processed_value("status")
+        if status not in (STATUS_CHARGING, STATUS_PLUGGED_IN, STATUS_UNPLUGGED):
+            # Error and unknown status don't change the session
+            status = session.status
+        events = []
+        record = None
+        plugged = status in (STATUS_CHARGING, STATUS_PLUGGED_IN)
+        was_plugged = session.status in (STATUS_CHARGING, STATUS_PLUGGED_IN)
+
+        if plugged and not was_plugged:
+            session.reset(timestamp)
+            events.append(SESSION_PLUG_IN)
+
+        if plugged:
+            self._accumulate(session, message, status)
+            if status == STATUS_CHARGING:
+                if session.status != STATUS_CHARGING:
+                    events.append(SESSION_CHARGE_START)
+                    if session.charge_start is None:
+                        session.charge_start = timestamp
+                session.charge_end = timestamp
+
+        if session.status == STATUS_CHARGING and status != STATUS_CHARGING:
+            events.append(SESSION_CHARGE_STOP)
+
+        if was_plugged and not plugged:
+            events.append(SESSION_UNPLUG)
+            record = self._record(serial, session, timestamp)
+
+        session.status = status
+        session.last_ts = timestamp
+        return events, record
+
+    def _accumulate(self, session, message, status):
+        try:
+            lifetime = message.get_processed_value("energy_lifetime")
+        except (TypeError, ValueError):
+            lifetime = None
+        try:
+            energy_session = message.get_processed_value("energy_session")
+        except (TypeError, ValueError):
+            energy_session = None
+        session.lifetime_energy += _counter_delta(session.lifetime_last, lifetime)
+        if lifetime is not None:
+            session.lifetime_last = lifetime
+        session.session_energy += _counter_delta(session.session_last, energy_session)
+        if energy_session is not None:
+            session.session_last = energy_session
+        if status == STATUS_CHARGING:
+            current = message.get_processed_value("current") or 0
+            if current > session.peak_current:
+                session.peak_current = current
+            # Not every status message has the voltage
+            voltage = (
+                message.get_processed_value("voltage") if message.has_value("voltage") else None
+            )
+            if voltage:
+                session.voltage_sum += voltage
+                session.voltage_count += 1
+
+    def _record(self, serial, session, timestamp):
+        return {
+            "serial": serial,
+            "start": _iso(session.plugged_at),
+            "end": _iso(timestamp),
+            "charge_start": _iso(session.charge_start),
+            "charge_end": _iso(session.charge_end),
+            "duration": round(timestamp - session.plugged_at),
+            "energy": round(session.energy() / 1000, 3),
+            "energy_session_counter": round(session.session_energy / 1000, 3),
+            "peak_current": session.peak_current,
+            "average_voltage": (
+                round(session.voltage_sum / session.voltage_count, 1)
+                if session.voltage_count
+                else None
+            ),
+        }
+
+    async def status_listener(self, message):
+        events, record = self.process(message)
+        if events:
+            _LOGGER.info(f"Session events of {message.get_value('serial')}: {events}")
+        if record is not None:
+            _LOGGER.info(f"Session finished: {record}")
+            if self._mqtt_handler is not None:
+                entity = self._mqtt_handler.get_entity("last_session")
+                await entity.set_attributes(record)
+                await entity.set_state(record["energy"])
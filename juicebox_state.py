@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+
+from const import STATE_DB, STATE_MAX_AGE, STATE_SAVE_INTERVAL
+from juicebox_message import (
+    JuiceboxCommand,
+    JuiceboxEncryptedMessage,
+    JuiceboxStatusMessage,
+    juicebox_message_from_string,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Entities that keep the values used on commands sent to the device
+STATE_SETPOINTS = ("current_max_online_set", "current_max_offline_set")
+
+
+def command_to_dict(command):
+    return {
+        "counter": command.counter,
+        "offline_amperage": command.offline_amperage,
+        "instant_amperage": command.instant_amperage,
+        "new_version": command.new_version,
+    }
+
+
+def command_from_dict(data):
+    command = JuiceboxCommand(new_version=data.get("new_version", False))
+    command.counter = int(data["counter"])
+    command.offline_amperage = int(data["offline_amperage"])
+    command.instant_amperage = int(data["instant_amperage"])
+    return command
+
+
+class JuiceboxStateSnapshot:
+    """
+    Saves what JuicePass Proxy learned from each device (last status message,
+    protocol version, command counter and the online/offline setpoints) to
+    STATE_DB on config_loc and gives it back at startup.
+
+    With the snapshot restored commands continue the counter and setpoints are
+    known on the first datagram, instead of waiting minutes for the device
+    (v07 devices don't send the offline current).
+    """
+
+    def __init__(
+        self,
+        config_loc,
+        filename=STATE_DB,
+        save_interval=STATE_SAVE_INTERVAL,
+        max_age=STATE_MAX_AGE,
+        clock=time.time,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._file = Path(config_loc)
+        self._file.mkdir(parents=True, exist_ok=True)
+        self._file = self._file.joinpath(filename)
+        self._save_interval = save_interval
+        self._max_age = max_age
+        self._clock = clock
+        self._devices = {}
+        self._mitm_handler = None
+        self._mqtt_handler = None
+        self._last_save = clock()
+        self._load()
+
+    def _load(self):
+        if not self._file.exists():
+            return
+        try:
+            with open(self._file, "r") as file:
+                self._devices = json.load(file)
+            _LOGGER.info(f"Loaded state of {len(self._devices)} devices")
+        except Exception as e:
+            _LOGGER.warning(
+                f"Can't load {self._file}. ({e.__class__.__qualname__}: {e})"
+            )
+
+    def _write(self, data):
+        tmp_file = self._file.with_suffix(".tmp")
+        with open(tmp_file, "w") as file:
+            json.dump(data, file)
+        tmp_file.replace(self._file)
+
+    async def set_mitm_handler(self, mitm_handler):
+        self._mitm_handler = mitm_handler
+
+    async def set_mqtt_handler(self, mqtt_handler):
+        self._mqtt_handler = mqtt_handler
+
+    def get(self, serial):
+        return self._devices.get(serial, None)
+
+    def capture(self):
+        """Updates the state of the device the MITM is talking to"""
+        if self._mitm_handler is None:
+            return None
+        message = self._mitm_handler.last_status_message
+        if not isinstance(message, JuiceboxStatusMessage) or isinstance(
+            message, JuiceboxEncryptedMessage
+        ):
+            return None
+        serial = message.get_value("serial")
+        if serial is None:
+            return None
+        state = self._devices.setdefault(serial, {})
+        state["saved_at"] = self._clock()
+        state["protocol"] = message.get_value("v")
+        state["status"] = str(message)
+        if (command := self._mitm_handler.last_command) is not None:
+            state["command"] = command_to_dict(command)
+        if self._mqtt_handler is not None:
+            setpoints = state.setdefault("setpoints", {})
+            for key in STATE_SETPOINTS:
+                if self._mitm_handler.is_mqtt_numeric_entity_defined(key):
+                    setpoints[key] = int(float(self._mqtt_handler.get_entity(key).state))
+        return state
+
+    async def save(self):
+        self._last_save = self._clock()
+        self.capture()
+        try:
+            await asyncio.to_thread(self._write, self._devices)
+        except OSError as e:
+            _LOGGER.warning(
+                f"Can't write to {self._file}. ({e.__class__.__qualname__}: {e})"
+            )
+
+    async def close(self):
+        await self.save()
+
+    async def restore(self, serial):
+        """Gives the saved state of serial to the MITM and MQTT handler, must be called before they start"""
+        state = self._devices.get(serial, None)
+        if not state:
+            return False
+        if self._mqtt_handler is not None:
+            for key, value in state.get("setpoints", {}).items():
+                if key in STATE_SETPOINTS:
+                    self._mqtt_handler.set_initial_state(key, value)
+
+        age = self._clock() - state.get("saved_at", 0)
+        if age > self._max_age:
+            _LOGGER.info(f"State of {serial} is {age / 3600:.1f} h old, only setpoints restored")
+            return True
+        try:
+            status_message = (
+                juicebox_message_from_string(state["status"])
+                if state.get("status")
+                else None
+            )
+            command = (
+                command_from_dict(state["command"]) if state.get("command") else None
+            )
+        except Exception as e:
+            _LOGGER.warning(
+                f"Invalid saved state of {serial}. ({e.__class__.__qualname__}: {e})"
+            )
+            return True
+        if self._mitm_handler is not None:
+            await self._mitm_handler.restore_state(status_message, command)
+        _LOGGER.info(
+            f"Restored state of {serial}: protocol {state.get('protocol')}, "
+            f"command counter {command.counter if command else None}, "
+            f"setpoints {state.get('setpoints', {})}"
+        )
+        return True
+
+    async def status_listener(self, message):
+        if self._clock() - self._last_save > self._save_interval:
+            await self.save()
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+
+from const import (
+    ERROR_LOOKBACK_MIN,
+    MAX_JPP_LOOP,
+    SUPERVISOR_HEALTHY_TIME,
+    SUPERVISOR_MAX_RESTART_DELAY,
+    SUPERVISOR_RESTART_DELAY,
+)
+from juicebox_errorbudget import JuiceboxErrorBudget
+from juicebox_metrics import METRICS
+
+_LOGGER = logging.getLogger(__name__)
+
+CHILD_RUNNING = "running"
+CHILD_RESTARTING = "restarting"
+CHILD_DONE = "done"
+CHILD_FAILED = "failed"
+
+_RESTARTS = METRICS.counter(
+    "juicepassproxy_component_restarts_total",
+    "Restarts of a component by the supervisor",
+    ("component",),
+)
+
+
+class JuiceboxSupervisedChild:
+    """One component of the supervisor"""
+
+    __slots__ = (
+        "name",
+        "start",
+        "close",
+        "state",
+        "restarts",
+        "delay",
+        "started_at",
+        "last_error",
+        "budget",
+    )
+
+    def __init__(self, name, start, close, max_restarts, clock):
+        self.name = name
+        self.start = start
+        self.close = close
+        self.state = CHILD_RUNNING
+        self.restarts = 0
+        self.delay = None
+        self.started_at = None
+        self.last_error = None
+        self.budget = JuiceboxErrorBudget(
+            f"restart_{name}",
+            max_errors=max_restarts,
+            window=ERROR_LOOKBACK_MIN * 60,
+            clock=clock,
+        )
+
+    def inspect(self):
+        return {
+            "state": self.state,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+        }
+
+
+class JuiceboxSupervisor:
+    """
+    Runs each component (MITM, MQTT handler, UDPC updater...) on its own task
+    and restarts only the one that failed, with its own backoff. Components
+    that return are done and not restarted.
+
+    A component restarted more than max_restarts times within
+    ERROR_LOOKBACK_MIN minutes stops the supervisor with ChildProcessError.
+    """
+
+    def __init__(
+        self,
+        restart_delay=SUPERVISOR_RESTART_DELAY,
+        max_restart_delay=SUPERVISOR_MAX_RESTART_DELAY,
+        healthy_time=SUPERVISOR_HEALTHY_TIME,
+        max_restarts=MAX_JPP_LOOP,
+        clock=time.monotonic,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._restart_delay = restart_delay
+        self._max_restart_delay = max_restart_delay
+        self._healthy_time = healthy_time
+        self._max_restarts = max_restarts
+        self._clock = clock
+        self._children = {}
+        self._tasks = []
+
+    def add(self, name, start, close=None):
+        """
+        start is a coroutine function running the component, close an optional
+        coroutine function releasing it before a restart
+        """
+        self._children[name] = JuiceboxSupervisedChild(
+            name, start, close, self._max_restarts, self._clock
+        )
+
+    def inspect(self):
+        return {name: child.inspect() for name, child in self._children.items()}
+
+    async def start(self):
+        _LOGGER.info(f"Starting JuiceboxSupervisor: {list(self._children)}")
+        self._tasks = [
+            asyncio.create_task(self._run_child(child), name=child.name)
+            for child in self._children.values()
+        ]
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            await self.close()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for child in self._children.values():
+            await self._close_child(child)
+
+    async def _close_child(self, child):
+        if child.close is None:
+            return
+        try:
+            await child.close()
+        except Exception as e:
+            _LOGGER.warning(
+                f"Error closing {child.name}. ({e.__class__.__qualname__}: {e})"
+            )
+
+    async def _run_child(self, child):
+        while True:
+            child.state = CHILD_RUNNING
+            child.started_at = self._clock()
+            try:
+                await child.start()
+                child.state = CHILD_DONE
+                return
+            except Exception as e:
+                child.last_error = f"{e.__class__.__qualname__}: {e}"
+                _LOGGER.exception(f"{child.name} failed: {child.last_error}")
+            await self._close_child(child)
+
+            if child.budget.add() > self._max_restarts:
+                child.state = CHILD_FAILED
+                raise ChildProcessError(
+                    f"JuiceboxSupervisor: {child.name} failed more than "
+                    f"{self._max_restarts} times in the last {ERROR_LOOKBACK_MIN} min."
+                )
+            if (
+                child.delay is None
+                or self._clock() - child.started_at >= self._healthy_time
+            ):
+                child.delay = self._restart_delay
+            else:
+                child.delay = min(child.delay * 2, self._max_restart_delay)
+            child.state = CHILD_RESTARTING
+            child.restarts += 1
+            _RESTARTS.labels(child.name).inc()
+            _LOGGER.warning(f"Restarting {child.name} in {child.delay} sec")
+            await asyncio.sleep(child.delay)
@@ -1,10 +1,85 @@
 import asyncio
 import logging
+import time
 
 import telnetlib3
+from const import TELNET_SNAPSHOT_TTL
 
 _LOGGER = logging.getLogger(__name__)
 
+TELNET_PROMPT = b"> "
+TELNET_EOL = b"\r\n"
+
+
+class JuiceboxTelnetResponseParser:
+    """
+    Incremental parser of the responses of pipelined commands.
+
+    Each response is the echo of the command line, the output lines and the
+    prompt at the start of a line. Bytes are scanned only once, a partial
+    echo or prompt at the end of a chunk is kept until the next feed().
+    """
+
+    def __init__(self, commands):
+        self._echos = [command.encode("ascii") + TELNET_EOL for command in commands]
+        self._buffer = bytearray()
+        self._pos = 0
+        self._output_start = None
+        self.responses = []
+
+    @property
+    def done(self):
+        return len(self.responses) == len(self._echos)
+
+    def feed(self, data: bytes):
+        self._buffer += data
+        while not self.done:
+            if self._output_start is None:
+                echo = self._echos[len(self.responses)]
+                idx = self._buffer.find(echo, self._pos)
+                if idx < 0:
+                    # Anything before the echo (banner, previous prompt) is skipped
+                    self._pos = max(self._pos, len(self._buffer) - len(echo) + 1)
+                    return
+                self._output_start = idx + len(echo)
+                self._pos = self._output_start
+            if self._buffer.startswith(TELNET_PROMPT, self._output_start):
+                end = self._output_start
+            else:
+                idx = self._buffer.find(TELNET_EOL + TELNET_PROMPT, self._pos)
+                if idx < 0:
+                    self._pos = max(
+                        self._output_start,
+                        len(self._buffer) - len(TELNET_EOL + TELNET_PROMPT) + 1,
+                    )
+                    return
+                end = idx + len(TELNET_EOL)
+            self.responses.append(bytes(self._buffer[self._output_start:end]))
+            del self._buffer[: end + len(TELNET_PROMPT)]
+            self._pos = 0
+            self._output_start = None
+
+
+def parse_udpc_list(output: bytes):
+    out = []
+    for line in output.decode("utf-8", "replace").split("\r\n"):
+        # Skip header "! # Type  Info"
+        if not line.startswith("#"):
+            continue
+        parts = line.split(" ")
+        if len(parts) >= 5:
+            out.append({"id": parts[1], "type": parts[2], "dest": parts[4]})
+    return out
+
+
+def parse_variables(output: bytes):
+    vars = {}
+    for line in output.decode("utf-8", "replace").split("\r\n"):
+        parts = line.split(": ")
+        if len(parts) == 2:
+            vars[parts[0]] = parts[1]
+    return vars
+
 
 class JuiceboxTelnet:
     def __init__(self, host, port, timeout=None, loglevel=None):
@@ -36,7 +111,8 @@ class JuiceboxTelnet:
                 data = await self.reader.readuntil(match)
         except asyncio.TimeoutError as e:
             raise TimeoutError(f"readuntil (match: {match}, data: {data})") from e
-        except ConnectionResetError as e:
+        except (ConnectionResetError, asyncio.IncompleteReadError) as e:
+            # IncompleteReadError means the device closed the connection
             raise ConnectionResetError(
                 f"readuntil (match: {match}, data: {data})"
             ) from e
@@ -76,65 +152,170 @@ class JuiceboxTelnet:
             self.writer.close()
         self.writer = None
 
+    async def run_commands(self, commands):
+        """
+        Send all commands on a single write and return the output (bytes) of
+        each one, responses are matched back to the commands by their echo.
+        """
+        if not await self.open():
+            return None
+        parser = JuiceboxTelnetResponseParser(commands)
+        payload = b"".join(command.encode("ascii") + b"\n" for command in commands)
+        try:
+            async with asyncio.timeout(self.timeout):
+                self.writer.write(payload)
+                await self.writer.drain()
+                while not parser.done:
+                    data = await self.reader.read(4096)
+                    if not data:
+                        raise ConnectionResetError("Connection closed by JuiceBox")
+                    parser.feed(data)
+        except TimeoutError as e:
+            raise TimeoutError(
+                f"run_commands (commands: {commands}, responses: {parser.responses})"
+            ) from e
+        except ConnectionResetError as e:
+            raise ConnectionResetError(
+                f"run_commands (commands: {commands}, responses: {parser.responses})"
+            ) from e
+        return parser.responses
+
     async def get_udpc_list(self):
-        out = []
-        if await self.open():
-            await self.write(b"\n")
-            await self.readuntil(b"> ")
-            await self.write(b"list\n")
-            await self.readuntil(b"list\r\n! ")
-            res = await self.readuntil(b">")
-            lines = str(res[:-3]).split("\\r\\n")
-            for line in lines[1:]:
-                parts = line.split(" ")
-                if len(parts) >= 5:
-                    out.append({"id": parts[1], "type": parts[2], "dest": parts[4]})
-        return out
+        if responses := await self.run_commands(["list"]):
+            return parse_udpc_list(responses[0])
+        return []
 
     async def get_variable(self, variable) -> bytes:
-        if await self.open():
-            await self.write(b"\n")
-            await self.readuntil(b"> ")
-            cmd = f"get {variable}\r\n".encode("ascii")
-            await self.write(cmd)
-            await self.readuntil(cmd)
-            res = await self.readuntil(b">")
-            return res[:-1].strip()
+        if responses := await self.run_commands([f"get {variable}"]):
+            return responses[0].strip()
         return None
 
     async def get_all_variables(self):
-        vars = {}
-        if await self.open():
-            await self.write(b"\n")
-            await self.readuntil(b">")
-            cmd = "get all\r\n".encode("ascii")
-            await self.write(cmd)
-            await self.readuntil(cmd)
-            res = await self.readuntil(b">")
-            lines = str(res[:-1]).split("\\r\\n")
-            for line in lines:
-                parts = line.split(": ")
-                if len(parts) == 2:
-                    vars[parts[0]] = parts[1]
-        return vars
+        if responses := await self.run_commands(["get all"]):
+            return parse_variables(responses[0])
+        return {}
 
     async def close_udpc_stream(self, id):
-        if await self.open():
-            await self.write(b"\n")
-            await self.readuntil(b">")
-            await self.write(f"stream_close {id}\n".encode("ascii"))
-            await self.readuntil(b">")
+        await self.run_commands([f"stream_close {id}"])
 
     async def write_udpc_stream(self, host, port):
-        if await self.open():
-            await self.write(b"\n")
-            await self.readuntil(b">")
-            await self.write(f"udpc {host} {port}\n".encode("ascii"))
-            await self.readuntil(b">")
+        await self.run_commands([f"udpc {host} {port}"])
 
     async def save_udpc(self):
-        if await self.open():
-            await self.write(b"\n")
-            await self.readuntil(b">")
-            await self.write(b"save\n")
-            await self.readuntil(b">")
+        await self.run_commands(["save"])
+
+
+class JuiceboxTelnetSession:
+    """
+    Shared telnet connection to one JuiceBox.
+
+    The telnet server of the device is slow and single user, all components
+    use the same connection through get() and commands are serialized with a
+    lock. A snapshot of get all and the UDPC list is cached for snapshot_ttl
+    seconds so startup lookups only talk to the device once.
+    """
+
+    _sessions = {}
+
+    @classmethod
+    def get(cls, host, port, timeout=None, loglevel=None):
+        key = (host, int(port))
+        session = cls._sessions.get(key, None)
+        if session is None:
+            session = cls(host, int(port), timeout=timeout, loglevel=loglevel)
+            cls._sessions[key] = session
+        return session
+
+    def __init__(
+        self,
+        host,
+        port,
+        timeout=None,
+        snapshot_ttl=TELNET_SNAPSHOT_TTL,
+        clock=time.monotonic,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self.host = host
+        self.port = port
+        self._telnet = JuiceboxTelnet(host, port, timeout=timeout, loglevel=loglevel)
+        self._lock = asyncio.Lock()
+        self._snapshot_ttl = snapshot_ttl
+        self._clock = clock
+        self._snapshot = None
+        self._snapshot_time = None
+
+    async def _run(self, command, *args):
+        async with self._lock:
+            try:
+                return await getattr(self._telnet, command)(*args)
+            except (TimeoutError, ConnectionResetError, OSError):
+                # Next command will reconnect
+                await self._telnet.close()
+                raise
+
+    async def open(self):
+        return await self._run("open")
+
+    async def close(self):
+        async with self._lock:
+            await self._telnet.close()
+
+    def invalidate(self):
+        self._snapshot = None
+
+    async def snapshot(self, max_age=None):
+        """
+        {"variables": get all, "udpc": UDPC list} not older than max_age
+        seconds (default snapshot_ttl)
+        """
+        if max_age is None:
+            max_age = self._snapshot_ttl
+        if (
+            self._snapshot is not None
+            and self._clock() - self._snapshot_time < max_age
+        ):
+            return self._snapshot
+        async with self._lock:
+            # Another task may have refreshed it while waiting for the lock
+            if (
+                self._snapshot is not None
+                and self._clock() - self._snapshot_time < max_age
+            ):
+                return self._snapshot
+            try:
+                # Both commands on one round trip
+                udpc, variables = await self._telnet.run_commands(["list", "get all"])
+                snapshot = {
+                    "udpc": parse_udpc_list(udpc),
+                    "variables": parse_variables(variables),
+                }
+            except (TimeoutError, ConnectionResetError, OSError):
+                await self._telnet.close()
+                raise
+            self._snapshot = snapshot
+            self._snapshot_time = self._clock()
+            _LOGGER.debug(f"Telnet snapshot: {snapshot}")
+            return snapshot
+
+    async def get_udpc_list(self, max_age=None):
+        return (await self.snapshot(max_age))["udpc"]
+
+    async def get_variable(self, variable, max_age=None) -> str:
+        variables = (await self.snapshot(max_age))["variables"]
+        if variable in variables:
+            return variables[variable]
+        value = await self._run("get_variable", variable)
+        return value.decode("utf-8") if value is not None else None
+
+    async def close_udpc_stream(self, id):
+        self.invalidate()
+        await self._run("close_udpc_stream", id)
+
+    async def write_udpc_stream(self, host, port):
+        self.invalidate()
+        await self._run("write_udpc_stream", host, port)
+
+    async def save_udpc(self):
+        await self._run("save_udpc")
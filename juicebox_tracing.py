@@ -0,0 +1,124 @@
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import time
+from collections import deque
+
+_LOGGER = logging.getLogger(__name__)
+
+# Trace of the datagram being handled, None when tracing is disabled
+_CURRENT_TRACE = contextvars.ContextVar("juicebox_trace", default=None)
+
+
+class JuiceboxTrace:
+    """Timestamps (time.perf_counter) of each stage handling one datagram"""
+
+    __slots__ = ("trace_id", "kind", "wall_time", "start", "end", "stages", "token")
+
+    def __init__(self, trace_id, start):
+        self.trace_id = trace_id
+        self.kind = None
+        self.wall_time = time.time()
+        self.start = start
+        self.end = None
+        self.stages = []
+        self.token = None
+
+    def mark(self, stage, detail=None):
+        self.stages.append((stage, detail, time.perf_counter()))
+        if stage == "classify":
+            self.kind = detail
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "time": self.wall_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "stages": [
+                {
+                    "stage": stage if detail is None else f"{stage} {detail}",
+                    "ms": round((when - self.start) * 1000, 3),
+                }
+                for stage, detail, when in self.stages
+            ],
+        }
+
+
+class JuiceboxTracer:
+    """
+    Keeps the last and the slowest traces, each on a buffer of size traces.
+    Disabled (size 0) start() returns None and mark() does nothing.
+    """
+
+    def __init__(self, size=0):
+        self._ids = itertools.count(1)
+        self.set_size(size)
+
+    @property
+    def enabled(self):
+        return self._size > 0
+
+    def set_size(self, size):
+        self._size = size
+        self._recent = deque(maxlen=max(size, 1))
+        # min heap of (duration, trace_id, trace)
+        self._slowest = []
+
+    def start(self, start=None):
+        """New trace, also the current one of the running task until finish()"""
+        if not self._size:
+            return None
+        trace = JuiceboxTrace(
+            next(self._ids), start if start is not None else time.perf_counter()
+        )
+        trace.mark("recv")
+        trace.token = _CURRENT_TRACE.set(trace)
+        return trace
+
+    def finish(self, trace):
+        trace.end = time.perf_counter()
+        _CURRENT_TRACE.reset(trace.token)
+        trace.token = None
+        self._recent.append(trace)
+        item = (trace.end - trace.start, trace.trace_id, trace)
+        if len(self._slowest) < self._size:
+            heapq.heappush(self._slowest, item)
+        elif item[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, item)
+
+    def recent(self):
+        return [trace.to_dict() for trace in reversed(self._recent)]
+
+    def slowest(self):
+        return [
+            trace.to_dict()
+            for _, _, trace in sorted(self._slowest, key=lambda item: -item[0])
+        ]
+
+    async def http_route(self, query):
+        """/traces?kind=slowest|recent"""
+        kind = query.get("kind", None)
+        traces = {}
+        if kind in (None, "slowest"):
+            traces["slowest"] = self.slowest()
+        if kind in (None, "recent"):
+            traces["recent"] = self.recent()
+        return "application/json", json.dumps(traces)
+
+
+# Process wide tracer, enabled by juicepassproxy with --trace_buffer
+TRACER = JuiceboxTracer()
+
+
+def trace_mark(stage, detail=None):
+    """Marks a stage on the trace of the datagram being handled, if any"""
+    trace = _CURRENT_TRACE.get()
+    if trace is not None:
+        trace.mark(stage, detail)
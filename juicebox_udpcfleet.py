@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import random
+import time
+
+from aiorun import run
+from const import (
+    DEFAULT_TELNET_PORT,
+    DEFAULT_TELNET_TIMEOUT,
+    LOG_DATE_FORMAT,
+    LOG_FORMAT,
+    UDPC_CHECK_MAX_INTERVAL,
+    UDPC_FLEET_CHECK_INTERVAL,
+    UDPC_FLEET_JITTER,
+    UDPC_FLEET_MIN_HOST_INTERVAL,
+    UDPC_FLEET_WORKERS,
+)
+from juicebox_metrics import METRICS
+from juicebox_telnet import JuiceboxTelnetSession
+from juicebox_udpcupdater import check_udpc, udpc_check_timeout
+
+_LOGGER = logging.getLogger(__name__)
+
+HOST_PENDING = "pending"
+HOST_OK = "ok"
+HOST_UPDATED = "updated"
+HOST_ERROR = "error"
+
+_FLEET_CHECK_TIME = METRICS.histogram(
+    "juicepassproxy_udpc_fleet_check_seconds",
+    "Time of one UDPC check on a fleet JuiceBox",
+    ("result",),
+)
+_FLEET_CHECK_OK = _FLEET_CHECK_TIME.labels(HOST_OK)
+_FLEET_CHECK_UPDATED = _FLEET_CHECK_TIME.labels(HOST_UPDATED)
+_FLEET_CHECK_ERROR = _FLEET_CHECK_TIME.labels(HOST_ERROR)
+_FLEET_BUSY_WORKERS = METRICS.gauge(
+    "juicepassproxy_udpc_fleet_busy_workers",
+    "Fleet telnet workers running a check",
+)
+
+
+class JuiceboxUDPCFleetHost:
+    """State of one JuiceBox of the fleet"""
+
+    __slots__ = (
+        "host",
+        "port",
+        "state",
+        "next_check",
+        "last_check",
+        "latency",
+        "checks",
+        "updates",
+        "failures",
+        "last_error",
+        "running",
+        "check_timeout",
+    )
+
+    def __init__(self, host, port, telnet_timeout=None):
+        self.host = host
+        self.port = port
+        self.state = HOST_PENDING
+        self.next_check = 0
+        self.last_check = None
+        self.latency = None
+        self.checks = 0
+        self.updates = 0
+        self.failures = 0
+        self.last_error = None
+        self.running = False
+        # Learned from the time of the checks of this JuiceBox
+        self.check_timeout = udpc_check_timeout(telnet_timeout)
+
+    def inspect(self):
+        return {
+            "host": f"{self.host}:{self.port}",
+            "state": self.state,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "checks": self.checks,
+            "updates": self.updates,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "check_timeout": round(self.check_timeout.get(), 1),
+        }
+
+
+class JuiceboxUDPCFleet:
+    """
+    Keeps the UDPC of many JuiceBoxes pointing to JuicePass Proxy.
+
+    Due hosts are taken from a heap ordered by next check and handed to a
+    fixed number of telnet workers. Each host is checked at most once every
+    min_host_interval seconds, checks are spread with jitter and hosts that
+    fail back off up to UDPC_CHECK_MAX_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        jpp_host,
+        udpc_port=8047,
+        telnet_timeout=None,
+        workers=UDPC_FLEET_WORKERS,
+        check_interval=UDPC_FLEET_CHECK_INTERVAL,
+        min_host_interval=UDPC_FLEET_MIN_HOST_INTERVAL,
+        jitter=UDPC_FLEET_JITTER,
+        clock=time.monotonic,
+        loglevel=None,
+    ):
+        if loglevel is not None:
+            _LOGGER.setLevel(loglevel)
+        self._jpp_host = jpp_host
+        self._udpc_port = udpc_port
+        self._telnet_timeout = telnet_timeout
+        self._workers = workers
+        self._check_interval = check_interval
+        self._min_host_interval = min_host_interval
+        self._jitter = jitter
+        self._clock = clock
+        self._hosts = {}
+        self._schedule = []
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._busy = 0
+        _FLEET_BUSY_WORKERS.set_function(lambda: self._busy)
+
+    def add_host(self, host, port=DEFAULT_TELNET_PORT):
+        key = (host, int(port))
+        if key in self._hosts:
+            return
+        entry = JuiceboxUDPCFleetHost(host, int(port), self._telnet_timeout)
+        # Spread the first checks so they don't all start together
+        entry.next_check = self._clock() + random.uniform(
+            0, self._check_interval * self._jitter
+        )
+        self._hosts[key] = entry
+        heapq.heappush(self._schedule, (entry.next_check, key))
+        self._wakeup.set()
+
+    def remove_host(self, host, port=DEFAULT_TELNET_PORT):
+        # Schedule entries of removed hosts are skipped by the scheduler
+        self._hosts.pop((host, int(port)), None)
+
+    def inspect(self):
+        return [entry.inspect() for entry in self._hosts.values()]
+
+    async def start(self):
+        _LOGGER.info(
+            f"Starting JuiceboxUDPCFleet with {len(self._hosts)} hosts and {self._workers} workers"
+        )
+        self._tasks = [
+            asyncio.create_task(self._worker(), name=f"udpc_fleet_worker_{i}")
+            for i in range(self._workers)
+        ]
+        self._tasks.append(asyncio.create_task(self._scheduler(), name="udpc_fleet_scheduler"))
+        await asyncio.gather(*self._tasks)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def _reschedule(self, entry, delay):
+        delay = max(delay, self._min_host_interval)
+        delay *= 1 + random.uniform(-self._jitter, self._jitter)
+        entry.next_check = self._clock() + delay
+        heapq.heappush(self._schedule, (entry.next_check, (entry.host, entry.port)))
+        self._wakeup.set()
+
+    async def _scheduler(self):
+        while True:
+            now = self._clock()
+            while self._schedule and self._schedule[0][0] <= now:
+                due, key = heapq.heappop(self._schedule)
+                entry = self._hosts.get(key, None)
+                # Skip removed hosts, old entries and hosts already being checked
+                if entry is None or entry.next_check != due or entry.running:
+                    continue
+                entry.running = True
+                self._queue.put_nowait(entry)
+            self._wakeup.clear()
+            timeout = self._schedule[0][0] - now if self._schedule else None
+            try:
+                async with asyncio.timeout(timeout):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            entry = await self._queue.get()
+            self._busy += 1
+            try:
+                await self._check(entry)
+            finally:
+                self._busy -= 1
+                entry.running = False
+
+    async def _check(self, entry):
+        session = JuiceboxTelnetSession.get(
+            entry.host,
+            entry.port,
+            timeout=self._telnet_timeout,
+            loglevel=_LOGGER.getEffectiveLevel(),
+        )
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(entry.check_timeout.get()):
+                updated = await check_udpc(session, self._jpp_host, self._udpc_port)
+        except Exception as e:
+            # Any failure of one JuiceBox must not stop the worker
+            if isinstance(e, TimeoutError):
+                entry.check_timeout.expired()
+            entry.latency = time.perf_counter() - start
+            _FLEET_CHECK_ERROR.observe(entry.latency)
+            entry.failures += 1
+            entry.state = HOST_ERROR
+            entry.last_error = f"{e.__class__.__qualname__}: {e}"
+            _LOGGER.warning(
+                f"UDPC check of {entry.host}:{entry.port} failed ({entry.failures}). "
+                f"({e.__class__.__qualname__}: {e})"
+            )
+            self._reschedule(
+                entry,
+                min(self._check_interval * 2 ** (entry.failures - 1), UDPC_CHECK_MAX_INTERVAL),
+            )
+        else:
+            entry.latency = time.perf_counter() - start
+            entry.check_timeout.observe(entry.latency)
+            entry.failures = 0
+            entry.last_error = None
+            if updated:
+                entry.updates += 1
+                entry.state = HOST_UPDATED
+                _FLEET_CHECK_UPDATED.observe(entry.latency)
+                _LOGGER.info(f"UDPC of {entry.host}:{entry.port} changed to {self._jpp_host}")
+            else:
+                entry.state = HOST_OK
+                _FLEET_CHECK_OK.observe(entry.latency)
+            self._reschedule(entry, self._check_interval)
+        finally:
+            entry.checks += 1
+            entry.last_check = self._clock()
+            # Release the single user telnet of the device
+            await session.close()
+
+
+def parse_host(value):
+    host, _, port = value.strip().partition(":")
+    return host, int(port or DEFAULT_TELNET_PORT)
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Keep the UDPC of many JuiceBoxes pointing to JuicePass Proxy"
+    )
+    parser.add_argument(
+        "--jpp_host",
+        required=True,
+        help="IP or Hostname of JuicePass Proxy to publish on the JuiceBoxes",
+    )
+    parser.add_argument(
+        "--hosts",
+        required=True,
+        help="File with one JuiceBox host[:telnet_port] per line",
+    )
+    parser.add_argument(
+        "--udpc_port", type=int, default=8047, help="UDPC port (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=UDPC_FLEET_WORKERS,
+        help="Concurrent telnet workers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--check_interval",
+        type=int,
+        default=UDPC_FLEET_CHECK_INTERVAL,
+        help="Seconds between checks of each JuiceBox (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--telnet_timeout",
+        type=int,
+        default=DEFAULT_TELNET_TIMEOUT,
+        help="Timeout in seconds for telnet operations (default: %(default)s)",
+    )
+    parser.add_argument("--debug", action="store_true", help="Show Debug level logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format=LOG_FORMAT,
+        datefmt=LOG_DATE_FORMAT,
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+    fleet = JuiceboxUDPCFleet(
+        args.jpp_host,
+        udpc_port=args.udpc_port,
+        telnet_timeout=int(args.telnet_timeout) or None,
+        workers=args.workers,
+        check_interval=args.check_interval,
+    )
+    with open(args.hosts, "r") as file:
+        for line in file:
+            if line.strip() and not line.startswith("#"):
+                fleet.add_host(*parse_host(line))
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.check_interval)
+            _LOGGER.info(f"Fleet state: {json.dumps(fleet.inspect())}")
+
+    await asyncio.gather(fleet.start(), report())
+
+
+if __name__ == "__main__":
+    run(main(), stop_on_unhandled_errors=True)
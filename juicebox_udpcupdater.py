@@ -4,14 +4,81 @@ import time
 
 from const import (
     ERROR_LOOKBACK_MIN,
-    MAX_ERROR_COUNT,
-    MAX_RETRY_ATTEMPT,
+    UDPC_CHECK_MAX_INTERVAL,
+    UDPC_TRAFFIC_GAP_FACTOR,
+    UDPC_TRAFFIC_GAP_MIN,
+    UDPC_UPDATE_CHECK_MIN_TIMEOUT,
     UDPC_UPDATE_CHECK_TIMEOUT,
 )
-from juicebox_telnet import JuiceboxTelnet
+from juicebox_adaptivetimeout import JuiceboxAdaptiveTimeout
+from juicebox_errorbudget import JuiceboxCircuitBreaker, JuiceboxErrorBudget
+from juicebox_metrics import METRICS
+from juicebox_telnet import JuiceboxTelnetSession
 
 _LOGGER = logging.getLogger(__name__)
 
+_UDPC_CHECKS = METRICS.counter(
+    "juicepassproxy_udpc_checks_total",
+    "UDPC checks done on the JuiceBox over telnet",
+)
+
+
+def udpc_check_timeout(telnet_timeout=None, name=None):
+    """Adaptive timeout of a UDPC check, never less than one telnet command"""
+    minimum = max(UDPC_UPDATE_CHECK_MIN_TIMEOUT, telnet_timeout or 0)
+    return JuiceboxAdaptiveTimeout(
+        max(UDPC_UPDATE_CHECK_TIMEOUT, minimum), minimum, name=name
+    )
+
+
+async def check_udpc(telnet, jpp_host, udpc_port, max_age=0):
+    """
+    Make the UDPC stream of the JuiceBox point to jpp_host:udpc_port, returns
+    True when it had to be changed. Telnet errors are raised to the caller.
+    """
+    connections = await telnet.get_udpc_list(max_age)
+    update_required = True
+    udpc_streams_to_close = {}  # Key = Connection id, Value = list id
+    udpc_stream_to_update = 0
+
+    # _LOGGER.debug(f"connections: {connections}")
+
+    for i, connection in enumerate(connections):
+        if connection["type"] == "UDPC":
+            udpc_streams_to_close.update({int(connection["id"]): i})
+            if jpp_host not in connection["dest"]:
+                udpc_stream_to_update = int(connection["id"])
+    # _LOGGER.debug(f"udpc_streams_to_close: {udpc_streams_to_close}")
+    if udpc_stream_to_update == 0 and len(udpc_streams_to_close) > 0:
+        udpc_stream_to_update = int(max(udpc_streams_to_close, key=int))
+    _LOGGER.debug(f"Active UDPC Stream: {udpc_stream_to_update}")
+
+    for stream in list(udpc_streams_to_close):
+        if stream < udpc_stream_to_update:
+            udpc_streams_to_close.pop(stream, None)
+
+    if len(udpc_streams_to_close) == 0:
+        _LOGGER.info("UDPC IP not found, updating")
+    elif (
+        jpp_host
+        not in connections[udpc_streams_to_close[udpc_stream_to_update]]["dest"]
+    ):
+        _LOGGER.info("UDPC IP incorrect, updating")
+        _LOGGER.debug(f"connections: {connections}")
+    elif len(udpc_streams_to_close) == 1:
+        _LOGGER.info("UDPC IP correct")
+        update_required = False
+
+    if update_required:
+        for id in udpc_streams_to_close:
+            _LOGGER.debug(f"Closing UDPC stream: {id}")
+            await telnet.close_udpc_stream(id)
+        await telnet.write_udpc_stream(jpp_host, udpc_port)
+        # Save is not recommended https://github.com/snicker/juicepassproxy/issues/96
+        # await telnet.save_udpc()
+        _LOGGER.info("UDPC IP Changed")
+    return update_required
+
 
 class JuiceboxUDPCUpdater:
     def __init__(
@@ -22,6 +89,7 @@ class JuiceboxUDPCUpdater:
         udpc_port=8047,
         telnet_timeout=None,
         loglevel=None,
+        clock=time.monotonic,
     ):
         if loglevel is not None:
             _LOGGER.setLevel(loglevel)
@@ -31,15 +99,26 @@ class JuiceboxUDPCUpdater:
         self._telnet_port = telnet_port
         self._telnet_timeout = telnet_timeout
         self._default_sleep_interval = 30
-        self._udpc_update_loop_task = None
         self._telnet = None
-        self._error_count = 0
-        self._error_timestamp_list = []
+        self._clock = clock
+        # Datagrams from the JuiceBox prove the UDPC is right, telnet is only
+        # used when they stop for longer than the traffic gap
+        self._last_traffic = None
+        self._report_interval = None
+        self._next_check = 0
+        self._backoff = self._default_sleep_interval
+        # The first check can use the snapshot taken at startup
+        self._snapshot_max_age = None
+        self._errors = JuiceboxErrorBudget("udpc_updater")
+        self._telnet_breaker = JuiceboxCircuitBreaker("telnet")
+        self._check_timeout = udpc_check_timeout(telnet_timeout, name="udpc_check")
 
     async def start(self):
         _LOGGER.info("Starting JuiceboxUDPCUpdater")
+        # Errors before a restart by the supervisor are already counted there
+        self._errors.reset()
 
-        await self._connect()
+        await self._udpc_update_loop()
 
     async def close(self):
         if self._telnet is not None:
@@ -48,16 +127,16 @@ class JuiceboxUDPCUpdater:
 
     async def _connect(self):
         connect_attempt = 1
-        while (
-            self._telnet is None
-            and connect_attempt <= MAX_RETRY_ATTEMPT
-            and self._error_count < MAX_ERROR_COUNT
-        ):
-            _LOGGER.debug(
-                f"Telnet connection attempt {connect_attempt} of {MAX_RETRY_ATTEMPT}"
-            )
+        while self._telnet is None and not self._errors.exhausted():
+            # Wait for the telnet circuit instead of hammering a JuiceBox that is not answering
+            if not self._telnet_breaker.allow():
+                retry_in = max(self._telnet_breaker.retry_in(), 1)
+                _LOGGER.debug(f"Telnet circuit open. Retrying in {retry_in:.0f} sec")
+                await asyncio.sleep(retry_in)
+                continue
+            _LOGGER.debug(f"Telnet connection attempt {connect_attempt}")
             connect_attempt += 1
-            self._telnet = JuiceboxTelnet(
+            self._telnet = JuiceboxTelnetSession.get(
                 self._juicebox_host,
                 self._telnet_port,
                 loglevel=_LOGGER.getEffectiveLevel(),
@@ -65,12 +144,14 @@ class JuiceboxUDPCUpdater:
             )
             try:
                 await self._telnet.open()
+                self._telnet_breaker.record_success()
             except TimeoutError as e:
                 _LOGGER.warning(
                     "JuiceboxUDPCUpdater Telnet Timeout. Reconnecting. "
                     f"({e.__class__.__qualname__}: {e})"
                 )
                 await self._add_error()
+                self._telnet_breaker.record_failure()
                 await self._telnet.close()
                 self._telnet = None
                 pass
@@ -80,41 +161,84 @@ class JuiceboxUDPCUpdater:
                     f"({e.__class__.__qualname__}: {e})"
                 )
                 await self._add_error()
+                self._telnet_breaker.record_failure()
                 await self._telnet.close()
                 self._telnet = None
                 pass
         if self._telnet is None:
             raise ChildProcessError("JuiceboxUDPCUpdater: Unable to connect to Telnet.")
-        if self._udpc_update_loop_task is None or self._udpc_update_loop_task.done():
-            self._udpc_update_loop_task = await self._udpc_update_loop()
-            self._loop.create_task(self._udpc_update_loop_task)
         _LOGGER.info("JuiceboxUDPCUpdater Connected to Juicebox Telnet")
 
+    def notify_traffic(self, from_addr=None):
+        """Called by JuiceboxMITM for each datagram received from the JuiceBox"""
+        now = self._clock()
+        if self._last_traffic is not None:
+            # EWMA of the time between datagrams, follows the device report interval.
+            # Gaps are clamped to the traffic gap so an outage doesn't delay the next
+            # redirect check, a longer report interval is still followed over a few samples
+            gap = min(now - self._last_traffic, self._traffic_gap())
+            if self._report_interval is None:
+                self._report_interval = gap
+            else:
+                self._report_interval += (gap - self._report_interval) / 8
+        self._last_traffic = now
+        # Traffic is back, next gap will be checked right away
+        self._next_check = 0
+        self._backoff = self._default_sleep_interval
+
+    def _traffic_gap(self):
+        if self._report_interval is None:
+            return UDPC_TRAFFIC_GAP_MIN
+        return max(UDPC_TRAFFIC_GAP_MIN, self._report_interval * UDPC_TRAFFIC_GAP_FACTOR)
+
+    def _time_until_check(self):
+        now = self._clock()
+        if self._last_traffic is not None:
+            gap_end = self._last_traffic + self._traffic_gap()
+            if gap_end > now:
+                return gap_end - now
+        return max(0, self._next_check - now)
+
     async def _udpc_update_loop(self):
         _LOGGER.debug("Starting JuiceboxUDPCUpdater Loop")
-        while self._error_count < MAX_ERROR_COUNT:
-            sleep_interval = self._default_sleep_interval
-            if self._telnet is None:
-                _LOGGER.warning(
-                    "JuiceboxUDPCUpdater Telnet Connection Lost. Reconnecting."
+        while not self._errors.exhausted():
+            if (wait := self._time_until_check()) > 0:
+                await asyncio.sleep(wait)
+                continue
+            if self._last_traffic is not None:
+                _LOGGER.info(
+                    f"No datagrams from JuiceBox for {self._clock() - self._last_traffic:.0f} sec. "
+                    "Checking UDPC."
                 )
+            if self._telnet is None:
                 await self._connect()
-                continue
+            sleep_interval = self._backoff
+            check_timeout = self._check_timeout.get()
+            check_start = time.perf_counter()
             try:
-                async with asyncio.timeout(UDPC_UPDATE_CHECK_TIMEOUT):
+                async with asyncio.timeout(check_timeout):
                     sleep_interval = await self._udpc_update_handler(sleep_interval)
+                self._check_timeout.observe(time.perf_counter() - check_start)
             except TimeoutError as e:
                 _LOGGER.warning(
-                    f"UDPC Update Check timeout after {UDPC_UPDATE_CHECK_TIMEOUT} sec. "
+                    f"UDPC Update Check timeout after {check_timeout:.0f} sec. "
                     f"({e.__class__.__qualname__}: {e})"
                 )
                 await self._add_error()
+                self._check_timeout.expired()
+                self._telnet_breaker.record_failure()
                 await self._telnet.close()
                 self._telnet = None
                 sleep_interval = 3
-            await asyncio.sleep(sleep_interval)
+            _UDPC_CHECKS.inc()
+            # Release the single user telnet of the device until next check
+            if self._telnet is not None:
+                await self._telnet.close()
+                self._telnet = None
+            self._next_check = self._clock() + sleep_interval
+            self._backoff = min(self._backoff * 2, UDPC_CHECK_MAX_INTERVAL)
         raise ChildProcessError(
-            f"JuiceboxUDPCUpdater: More than {self._error_count} "
+            f"JuiceboxUDPCUpdater: More than {self._errors.count()} "
             f"errors in the last {ERROR_LOOKBACK_MIN} min."
         )
 
@@ -122,47 +246,11 @@ class JuiceboxUDPCUpdater:
         sleep_interval = default_sleep_interval
         try:
             _LOGGER.info("JuiceboxUDPCUpdater Check Starting")
-            connections = await self._telnet.get_udpc_list()
-            update_required = True
-            udpc_streams_to_close = {}  # Key = Connection id, Value = list id
-            udpc_stream_to_update = 0
-
-            # _LOGGER.debug(f"connections: {connections}")
-
-            for i, connection in enumerate(connections):
-                if connection["type"] == "UDPC":
-                    udpc_streams_to_close.update({int(connection["id"]): i})
-                    if self._jpp_host not in connection["dest"]:
-                        udpc_stream_to_update = int(connection["id"])
-            # _LOGGER.debug(f"udpc_streams_to_close: {udpc_streams_to_close}")
-            if udpc_stream_to_update == 0 and len(udpc_streams_to_close) > 0:
-                udpc_stream_to_update = int(max(udpc_streams_to_close, key=int))
-            _LOGGER.debug(f"Active UDPC Stream: {udpc_stream_to_update}")
-
-            for stream in list(udpc_streams_to_close):
-                if stream < udpc_stream_to_update:
-                    udpc_streams_to_close.pop(stream, None)
-
-            if len(udpc_streams_to_close) == 0:
-                _LOGGER.info("UDPC IP not found, updating")
-            elif (
-                self._jpp_host
-                not in connections[udpc_streams_to_close[udpc_stream_to_update]]["dest"]
-            ):
-                _LOGGER.info("UDPC IP incorrect, updating")
-                _LOGGER.debug(f"connections: {connections}")
-            elif len(udpc_streams_to_close) == 1:
-                _LOGGER.info("UDPC IP correct")
-                update_required = False
-
-            if update_required:
-                for id in udpc_streams_to_close:
-                    _LOGGER.debug(f"Closing UDPC stream: {id}")
-                    await self._telnet.close_udpc_stream(id)
-                await self._telnet.write_udpc_stream(self._jpp_host, self._udpc_port)
-                # Save is not recommended https://github.com/snicker/juicepassproxy/issues/96
-                # await self._telnet.save_udpc()
-                _LOGGER.info("UDPC IP Changed")
+            await check_udpc(
+                self._telnet, self._jpp_host, self._udpc_port, self._snapshot_max_age
+            )
+            self._snapshot_max_age = 0
+            self._telnet_breaker.record_success()
         except ConnectionResetError as e:
             _LOGGER.warning(
                 "Telnet connection to JuiceBox lost. "
@@ -170,6 +258,7 @@ class JuiceboxUDPCUpdater:
                 f"({e.__class__.__qualname__}: {e})"
             )
             await self._add_error()
+            self._telnet_breaker.record_failure()
             await self._telnet.close()
             self._telnet = None
             sleep_interval = 3
@@ -180,6 +269,7 @@ class JuiceboxUDPCUpdater:
                 f"({e.__class__.__qualname__}: {e})"
             )
             await self._add_error()
+            self._telnet_breaker.record_failure()
             await self._telnet.close()
             self._telnet = None
             sleep_interval = 3
@@ -190,17 +280,11 @@ class JuiceboxUDPCUpdater:
                 f"({e.__class__.__qualname__}: {e})"
             )
             await self._add_error()
+            self._telnet_breaker.record_failure()
             await self._telnet.close()
             self._telnet = None
             sleep_interval = 3
         return sleep_interval
 
     async def _add_error(self):
-        self._error_timestamp_list.append(time.time())
-        time_cutoff = time.time() - (ERROR_LOOKBACK_MIN * 60)
-        temp_list = list(
-            filter(lambda el: el > time_cutoff, self._error_timestamp_list)
-        )
-        self._error_timestamp_list = temp_list
-        self._error_count = len(self._error_timestamp_list)
-        _LOGGER.debug(f"Errors in last {ERROR_LOOKBACK_MIN} min: {self._error_count}")
+        self._errors.add()
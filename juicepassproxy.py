@@ -2,40 +2,51 @@
 
 import argparse
 import asyncio
+import atexit
+import functools
 import ipaddress
 import logging
+import signal
 import socket
+import sqlite3
 import sys
-from logging.handlers import TimedRotatingFileHandler
 from pathlib import Path
 
-import dns
-from aiorun import run
 from const import (
-    DAYS_TO_KEEP_LOGS,
     DEFAULT_DEVICE_NAME,
     DEFAULT_ENELX_IP,
     DEFAULT_ENELX_PORT,
+    DEFAULT_HISTORY_DAYS,
     DEFAULT_ENELX_SERVER,
     DEFAULT_LOCAL_IP,
     DEFAULT_LOGLEVEL,
+    DEFAULT_METRICS_HOST,
+    DEFAULT_METRICS_PORT,
     DEFAULT_MQTT_DISCOVERY_PREFIX,
     DEFAULT_MQTT_HOST,
     DEFAULT_MQTT_PORT,
     DEFAULT_TELNET_PORT,
     DEFAULT_TELNET_TIMEOUT,
+    DEFAULT_TRACE_BUFFER,
+    DEFAULT_SLOW_CALLBACK_MS,
     EXTERNAL_DNS,
     LOG_DATE_FORMAT,
     LOG_FORMAT,
     LOGFILE,
-    MAX_JPP_LOOP,
     VERSION,
 )
-from ha_mqtt_discoverable import Settings
+from juicebox_history import JuiceboxHistory
+from juicebox_interval import JuiceboxIntervalProfile
+from juicebox_linkquality import JuiceboxLinkQuality
+from juicebox_logging import rotating_file_handler, setup_logging
+from juicebox_loopmonitor import JuiceboxLoopMonitor
+from juicebox_metrics import JuiceboxMetricsServer
 from juicebox_mitm import JuiceboxMITM
-from juicebox_mqtthandler import JuiceboxMQTTHandler
-from juicebox_telnet import JuiceboxTelnet
-from juicebox_udpcupdater import JuiceboxUDPCUpdater
+from juicebox_profiler import JuiceboxProfiler
+from juicebox_session import JuiceboxSessionTracker
+from juicebox_state import JuiceboxStateSnapshot
+from juicebox_supervisor import JuiceboxSupervisor
+from juicebox_tracing import TRACER
 from juicebox_config import JuiceboxConfig
 
 logging.basicConfig(
@@ -93,12 +104,14 @@ async def get_local_ip():
 
 
 async def resolve_ip_external_dns(address, use_dns=EXTERNAL_DNS):
-    # res = await dns.asyncresolver.Resolver()
-    res = dns.resolver.Resolver()
+    import dns.asyncresolver
+
+    res = dns.asyncresolver.Resolver(configure=False)
     res.nameservers = [use_dns]
     try:
-        # answers = await res.resolve(
-        answers = res.resolve(address, rdtype=dns.rdatatype.A, raise_on_no_answer=True)
+        answers = await res.resolve(
+            address, rdtype=dns.rdatatype.A, raise_on_no_answer=True
+        )
     except (
         dns.resolver.LifetimeTimeout,
         dns.resolver.NoNameservers,
@@ -123,20 +136,22 @@ async def is_valid_ip(test_ip):
 
 
 async def get_enelx_server_port(juicebox_host, telnet_port, telnet_timeout=None):
+    from juicebox_telnet import JuiceboxTelnetSession
+
     try:
-        async with JuiceboxTelnet(
+        session = JuiceboxTelnetSession.get(
             juicebox_host,
             telnet_port,
             loglevel=_LOGGER.getEffectiveLevel(),
             timeout=telnet_timeout,
-        ) as tn:
-            connections = await tn.get_udpc_list()
-            # _LOGGER.debug(f"connections: {connections}")
-            for connection in connections:
-                if connection["type"] == "UDPC" and not await is_valid_ip(
-                    connection["dest"].split(":")[0]
-                ):
-                    return connection["dest"]
+        )
+        connections = await session.get_udpc_list()
+        # _LOGGER.debug(f"connections: {connections}")
+        for connection in connections:
+            if connection["type"] == "UDPC" and not await is_valid_ip(
+                connection["dest"].split(":")[0]
+            ):
+                return connection["dest"]
     except TimeoutError as e:
         _LOGGER.warning(
             "Error in getting EnelX Server and Port via Telnet. "
@@ -153,15 +168,18 @@ async def get_enelx_server_port(juicebox_host, telnet_port, telnet_timeout=None)
 
 
 async def get_juicebox_id(juicebox_host, telnet_port, telnet_timeout=None):
+    from juicebox_telnet import JuiceboxTelnetSession
+
     try:
-        async with JuiceboxTelnet(
+        session = JuiceboxTelnetSession.get(
             juicebox_host,
             telnet_port,
             loglevel=_LOGGER.getEffectiveLevel(),
             timeout=telnet_timeout,
-        ) as tn:
-            juicebox_id = (await tn.get_variable("email.name_address")).decode("utf-8")
-            return juicebox_id
+        )
+        # Answered from the snapshot taken by get_enelx_server_port
+        juicebox_id = await session.get_variable("email.name_address")
+        return juicebox_id
     except TimeoutError as e:
         _LOGGER.warning(
             "Error in getting JuiceBox ID via Telnet. "
@@ -178,6 +196,108 @@ async def get_juicebox_id(juicebox_host, telnet_port, telnet_timeout=None):
 
 
 
+async def discover(args, config, telnet_timeout=None, resolve_enelx=True):
+    """
+    Look up the EnelX server, JuiceBox ID, local IP and EnelX IP concurrently.
+    Values not given as arguments are returned on a dict, None if not found.
+    """
+    lookups = {}
+    if args.juicebox_host:
+        # Both telnet lookups are answered by one snapshot of the device
+        if not args.ignore_enelx:
+            lookups["enelx_server_port"] = get_enelx_server_port(
+                args.juicebox_host, args.telnet_port, telnet_timeout=telnet_timeout
+            )
+        if not args.juicebox_id:
+            lookups["juicebox_id"] = get_juicebox_id(
+                args.juicebox_host, args.telnet_port, telnet_timeout=telnet_timeout
+            )
+    if not args.local_ip:
+        lookups["local_ip"] = get_local_ip()
+    # Resolve the known EnelX server while telnet is still running
+    enelx_server = config.get("ENELX_SERVER", DEFAULT_ENELX_SERVER)
+    if resolve_enelx and not args.enelx_ip:
+        lookups["enelx_ip"] = resolve_ip_external_dns(enelx_server)
+
+    results = await asyncio.gather(*lookups.values(), return_exceptions=True)
+    discovered = {}
+    for name, result in zip(lookups, results):
+        if isinstance(result, Exception):
+            _LOGGER.warning(
+                f"Unable to discover {name}. ({result.__class__.__qualname__}: {result})"
+            )
+            result = None
+        discovered[name] = result
+
+    enelx_server_port = discovered.get("enelx_server_port", None)
+    if (
+        resolve_enelx
+        and not args.enelx_ip
+        and enelx_server_port
+        and enelx_server_port.split(":")[0] != enelx_server
+    ):
+        discovered["enelx_ip"] = await resolve_ip_external_dns(
+            enelx_server_port.split(":")[0]
+        )
+    _LOGGER.debug(f"discovered: {discovered}")
+    return discovered
+
+
+def can_warm_start(args, config):
+    """True if config has every value that is not given as an argument"""
+    if args.cold_start:
+        return False
+    required = ["ENELX_SERVER", "ENELX_PORT"]
+    if not args.enelx_ip:
+        required.append("ENELX_IP")
+    if not args.local_ip:
+        required.append("LOCAL_IP")
+    if not args.juicebox_id:
+        required.append("JUICEBOX_ID")
+    return all(config.get(key, None) for key in required)
+
+
+async def apply_discovery(discovery_task, args, config, mitm_handler, enelx_addr):
+    """
+    Waits for the background discovery of a warm start and updates config with
+    what changed. EnelX IP is switched on the running MITM, other changes are
+    used on the next restart.
+    """
+    try:
+        # Shielded so a restart of the JPP loop does not cancel the discovery
+        discovered = await asyncio.shield(discovery_task)
+    except Exception as e:
+        _LOGGER.warning(f"Discovery failed. ({e.__class__.__qualname__}: {e})")
+        return
+
+    if enelx_server_port := discovered.get("enelx_server_port", None):
+        enelx_server, enelx_port = enelx_server_port.split(":")
+        config.update_value("ENELX_SERVER", enelx_server)
+        if enelx_port != str(config.get("ENELX_PORT", None)):
+            _LOGGER.warning(
+                f"EnelX port changed to {enelx_port}, will be used after restart"
+            )
+            config.update_value("ENELX_PORT", enelx_port)
+
+    enelx_ip = discovered.get("enelx_ip", None)
+    if enelx_ip and enelx_ip != config.get("ENELX_IP", None):
+        config.update_value("ENELX_IP", enelx_ip)
+        await mitm_handler.set_enelx_addr((enelx_ip, enelx_addr[1]))
+
+    local_ip = discovered.get("local_ip", None)
+    if local_ip and local_ip != config.get("LOCAL_IP", None):
+        _LOGGER.warning(f"Local IP changed to {local_ip}, will be used after restart")
+        config.update_value("LOCAL_IP", local_ip)
+
+    juicebox_id = discovered.get("juicebox_id", None)
+    if juicebox_id and juicebox_id != config.get("JUICEBOX_ID", None):
+        _LOGGER.warning(
+            f"JuiceBox ID changed to {juicebox_id}, will be used after restart"
+        )
+        config.update_value("JUICEBOX_ID", juicebox_id)
+
+    await config.write_if_changed()
+
 
 def ip_to_tuple(ip):
     if isinstance(ip, tuple):
@@ -354,6 +474,52 @@ async def parse_args():
         help="Destination IP (and optional port) of EnelX Server. If not defined, --juicebox_host required and then will obtain it automatically. (Ex. 54.161.185.130:8047) [Deprecated: -d --dst]",
     )
 
+    parser.add_argument(
+        "--cold_start",
+        action="store_true",
+        help="Wait for Telnet and DNS lookups before starting instead of starting from the values saved on config (default: warm start when config has them)",
+    )
+
+    parser.add_argument(
+        "--metrics_port",
+        type=int,
+        metavar="PORT",
+        default=DEFAULT_METRICS_PORT,
+        help="Port for the Prometheus metrics endpoint, 0 to disable (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--metrics_host",
+        type=str,
+        metavar="HOST",
+        default=DEFAULT_METRICS_HOST,
+        help="Address the metrics endpoint listens on (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--history_days",
+        type=int,
+        metavar="DAYS",
+        default=DEFAULT_HISTORY_DAYS,
+        help="Days of decoded status messages to keep on the local history store at config_loc, 0 to disable (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--trace_buffer",
+        type=int,
+        metavar="TRACES",
+        default=DEFAULT_TRACE_BUFFER,
+        help="Traces of the last and of the slowest datagrams to keep, shown at /traces of the metrics endpoint, 0 to disable (default: %(default)s)",
+    )
+
+    parser.add_argument(
+        "--slow_callback_ms",
+        type=int,
+        metavar="MS",
+        default=DEFAULT_SLOW_CALLBACK_MS,
+        help="Report code blocking the event loop longer than this, 0 to disable the loop monitor (default: %(default)s)",
+    )
+
     return parser.parse_args()
 
 
@@ -366,16 +532,10 @@ async def main():
         log_loc.mkdir(parents=True, exist_ok=True)
         log_loc = log_loc.joinpath(LOGFILE)
         log_loc.touch(exist_ok=True)
-        log_handlers.append(TimedRotatingFileHandler(
-                log_loc, when="midnight", backupCount=DAYS_TO_KEEP_LOGS
-            ))
-    logging.basicConfig(
-        format=LOG_FORMAT,
-        datefmt=LOG_DATE_FORMAT,
-        level=DEFAULT_LOGLEVEL,
-        handlers=log_handlers,
-        force=True,
-    )
+        log_handlers.append(rotating_file_handler(log_loc))
+    # Console and file are written from another thread, not from the event loop
+    log_listener = setup_logging(log_handlers, DEFAULT_LOGLEVEL)
+    atexit.register(log_listener.stop)
     if args.debug:
         _LOGGER.setLevel(logging.DEBUG)
     _LOGGER.warning(
@@ -420,11 +580,20 @@ async def main():
     ignore_enelx = args.ignore_enelx
     _LOGGER.info(f"ignore_enelx: {ignore_enelx}")
 
-    enelx_server_port = None
-    if not ignore_enelx:
-        enelx_server_port = await get_enelx_server_port(
-            args.juicebox_host, args.telnet_port, telnet_timeout=telnet_timeout
+    discovery_task = None
+    if can_warm_start(args, config):
+        # Start from cached config, discovery runs while the MITM is already forwarding
+        _LOGGER.info("Warm start from config, discovery continues in background")
+        discovered = {}
+        # EnelX IP is kept up to date by JuiceboxEnelXResolver
+        discovery_task = asyncio.create_task(
+            discover(args, config, telnet_timeout=telnet_timeout, resolve_enelx=False),
+            name="discovery",
         )
+    else:
+        discovered = await discover(args, config, telnet_timeout=telnet_timeout)
+
+    enelx_server_port = discovered.get("enelx_server_port", None)
 
     if enelx_server_port:
         _LOGGER.debug(f"enelx_server_port: {enelx_server_port}")
@@ -459,7 +628,7 @@ async def main():
             local_addr = ip_to_tuple(args.local_ip)
         else:
             local_addr = ip_to_tuple(f"{args.local_ip}:{local_port}")
-    elif local_ip := await get_local_ip():
+    elif local_ip := discovered.get("local_ip", None):
         local_addr = ip_to_tuple(f"{local_ip}:{local_port}")
     else:
         local_addr = ip_to_tuple(
@@ -486,7 +655,7 @@ async def main():
             enelx_addr = ip_to_tuple(args.enelx_ip)
         else:
             enelx_addr = ip_to_tuple(f"{args.enelx_ip}:{enelx_port}")
-    elif enelx_server_ip := await resolve_ip_external_dns(enelx_server):
+    elif enelx_server_ip := discovered.get("enelx_ip", None):
         enelx_addr = ip_to_tuple(f"{enelx_server_ip}:{enelx_port}")
     else:
         enelx_addr = ip_to_tuple(
@@ -499,9 +668,7 @@ async def main():
 
     if juicebox_id := args.juicebox_id:
         pass
-    elif juicebox_id := await get_juicebox_id(
-        args.juicebox_host, args.telnet_port, telnet_timeout=telnet_timeout
-    ):
+    elif juicebox_id := discovered.get("juicebox_id", None):
         pass
     else:
         juicebox_id = config.get("JUICEBOX_ID", None)
@@ -522,6 +689,10 @@ async def main():
 
     await config.write_if_changed()
 
+    # pydantic and ha_mqtt_discoverable are the slowest imports of a start
+    from ha_mqtt_discoverable import Settings
+    from juicebox_mqtthandler import JuiceboxMQTTHandler
+
     mqtt_settings = Settings.MQTT(
         host=args.mqtt_host,
         port=args.mqtt_port,
@@ -530,81 +701,176 @@ async def main():
         discovery_prefix=args.mqtt_discovery_prefix,
     )
 
-    jpp_loop_count = 1
-    while jpp_loop_count <= MAX_JPP_LOOP:
-        if jpp_loop_count != 1:
-            _LOGGER.error(f"Restarting JuicePass Proxy Loop ({jpp_loop_count})")
-        jpp_loop_count += 1
-        jpp_task_list = []
-        udpc_updater = None
-        mqtt_handler = JuiceboxMQTTHandler(
-            mqtt_settings=mqtt_settings,
-            device_name=args.device_name,
-            juicebox_id=juicebox_id,
-            config=config,
-            experimental=experimental,
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = JuiceboxMetricsServer(
+            args.metrics_host,
+            args.metrics_port,
             loglevel=_LOGGER.getEffectiveLevel(),
         )
-        jpp_task_list.append(
-            asyncio.create_task(mqtt_handler.start(), name="mqtt_handler")
-        )
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            _LOGGER.warning(
+                f"Unable to start metrics endpoint. ({e.__class__.__qualname__}: {e})"
+            )
+            metrics_server = None
 
-        mitm_handler = JuiceboxMITM(
-            jpp_addr=local_addr,  # Local/Docker IP
-            enelx_addr=enelx_addr,  # EnelX IP
-            ignore_enelx=ignore_enelx,
+    if args.trace_buffer > 0:
+        TRACER.set_size(args.trace_buffer)
+        if metrics_server is not None:
+            metrics_server.add_route("/traces", TRACER.http_route)
+        else:
+            _LOGGER.warning("Tracing enabled without metrics_port, traces are not available")
+
+    history = None
+    if args.history_days > 0:
+        history = JuiceboxHistory(
+            args.config_loc,
+            args.history_days,
             loglevel=_LOGGER.getEffectiveLevel(),
-            # windows users are having trouble with reuse_port=True
-            # TODO find a safe way to detect windows and change the default value
-            reuse_port=config.get("reuse_port", not args.disable_reuse_port), 
         )
-        await mitm_handler.set_local_mitm_handler(mqtt_handler.local_mitm_handler)
-        await mitm_handler.set_remote_mitm_handler(mqtt_handler.remote_mitm_handler)
-        jpp_task_list.append(
-            asyncio.create_task(mitm_handler.start(), name="mitm_handler")
+        try:
+            await history.start()
+        except sqlite3.Error as e:
+            _LOGGER.warning(
+                f"Unable to start history store. ({e.__class__.__qualname__}: {e})"
+            )
+            history = None
+        else:
+            if metrics_server is not None:
+                metrics_server.add_route("/history", history.http_route)
+
+    interval_profile = JuiceboxIntervalProfile(
+        args.config_loc, loglevel=_LOGGER.getEffectiveLevel()
+    )
+
+    session_tracker = JuiceboxSessionTracker(loglevel=_LOGGER.getEffectiveLevel())
+    link_quality = JuiceboxLinkQuality(loglevel=_LOGGER.getEffectiveLevel())
+
+    mqtt_handler = JuiceboxMQTTHandler(
+        mqtt_settings=mqtt_settings,
+        device_name=args.device_name,
+        juicebox_id=juicebox_id,
+        config=config,
+        experimental=experimental,
+        loglevel=_LOGGER.getEffectiveLevel(),
+    )
+
+    mitm_handler = JuiceboxMITM(
+        jpp_addr=local_addr,  # Local/Docker IP
+        enelx_addr=enelx_addr,  # EnelX IP
+        ignore_enelx=ignore_enelx,
+        loglevel=_LOGGER.getEffectiveLevel(),
+        # windows users are having trouble with reuse_port=True
+        # TODO find a safe way to detect windows and change the default value
+        reuse_port=config.get("reuse_port", not args.disable_reuse_port),
+        # Only this JuiceBox can take the place of the one already known
+        juicebox_host=args.juicebox_host,
+        juicebox_id=juicebox_id,
+    )
+    await mitm_handler.set_local_mitm_handler(mqtt_handler.local_mitm_handler)
+    await mitm_handler.set_remote_mitm_handler(mqtt_handler.remote_mitm_handler)
+    if history is not None:
+        await mitm_handler.add_status_listener(history.status_listener)
+    await interval_profile.set_mqtt_handler(mqtt_handler)
+    await mitm_handler.add_status_listener(interval_profile.status_listener)
+    await session_tracker.set_mqtt_handler(mqtt_handler)
+    await mitm_handler.add_status_listener(session_tracker.status_listener)
+    await link_quality.set_mqtt_handler(mqtt_handler)
+    await mitm_handler.add_status_listener(link_quality.status_listener)
+    await mitm_handler.add_enelx_listener(link_quality.enelx_listener)
+    if metrics_server is not None:
+        metrics_server.add_route("/link", link_quality.http_route)
+    await mqtt_handler.set_mitm_handler(mitm_handler)
+    await mitm_handler.set_mqtt_handler(mqtt_handler)
+
+    # On demand profile with SIGUSR1, the MQTT button or /profile
+    profiler = JuiceboxProfiler(
+        Path(args.log_loc) if enable_file_log else Path(args.config_loc),
+        loglevel=_LOGGER.getEffectiveLevel(),
+    )
+    await mqtt_handler.set_profile_handler(profiler.profile)
+    if metrics_server is not None:
+        metrics_server.add_route("/profile", profiler.http_route)
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, profiler.start_profile
+        )
+
+    # Last known state of the device, commands can be sent on the first datagram
+    state_snapshot = JuiceboxStateSnapshot(
+        args.config_loc, loglevel=_LOGGER.getEffectiveLevel()
+    )
+    await state_snapshot.set_mitm_handler(mitm_handler)
+    await state_snapshot.set_mqtt_handler(mqtt_handler)
+    if juicebox_id:
+        await state_snapshot.restore(juicebox_id)
+    await mitm_handler.add_status_listener(state_snapshot.status_listener)
+
+    # Each component is restarted alone, the others keep their connections
+    supervisor = JuiceboxSupervisor(loglevel=_LOGGER.getEffectiveLevel())
+    # MITM first: it listens before the MQTT connect blocks the loop
+    supervisor.add("mitm_handler", mitm_handler.start, mitm_handler.close)
+    supervisor.add("mqtt_handler", mqtt_handler.start, mqtt_handler.close)
+
+    if args.slow_callback_ms > 0:
+        loop_monitor = JuiceboxLoopMonitor(
+            args.slow_callback_ms / 1000, loglevel=_LOGGER.getEffectiveLevel()
         )
+        if metrics_server is not None:
+            metrics_server.add_route("/loop", loop_monitor.http_route)
+        supervisor.add("loop_monitor", loop_monitor.start, loop_monitor.close)
 
-        await mqtt_handler.set_mitm_handler(mitm_handler)
-        await mitm_handler.set_mqtt_handler(mqtt_handler)
-
-        if args.update_udpc:
-            jpp_host = args.jpp_host or local_addr[0]
-            udpc_updater = JuiceboxUDPCUpdater(
-                juicebox_host=args.juicebox_host,
-                jpp_host=jpp_host,
-                telnet_port=telnet_port,
-                udpc_port=local_addr[1],
-                telnet_timeout=telnet_timeout,
-                loglevel=_LOGGER.getEffectiveLevel(),
-            )
-            jpp_task_list.append(
-                asyncio.create_task(udpc_updater.start(), name="udpc_updater")
-            )
+    if not args.enelx_ip and not ignore_enelx:
+        from juicebox_dns import JuiceboxEnelXResolver
 
-        try:
-            await asyncio.gather(
-                *jpp_task_list,
-            )
-        except Exception as e:
-            _LOGGER.exception(
-                f"A JuicePass Proxy task failed: {e.__class__.__qualname__}: {e}"
-            )
-            await mqtt_handler.close()
-            await mitm_handler.close()
-            del mqtt_handler
-            del mitm_handler
-            if udpc_updater is not None:
-                await udpc_updater.close()
-                del udpc_updater
-            await asyncio.sleep(5)
-            _LOGGER.debug(f"jpp_task_list: {jpp_task_list}")
-            for task in jpp_task_list:
-                task.cancel()
-        await asyncio.sleep(5)
+        enelx_resolver = JuiceboxEnelXResolver(
+            enelx_server, enelx_port, config, loglevel=_LOGGER.getEffectiveLevel()
+        )
+        await enelx_resolver.set_mitm_handler(mitm_handler)
+        await mitm_handler.set_enelx_failover_handler(enelx_resolver.failover)
+        supervisor.add("enelx_resolver", enelx_resolver.start)
+
+    if discovery_task is not None:
+        supervisor.add(
+            "apply_discovery",
+            functools.partial(
+                apply_discovery, discovery_task, args, config, mitm_handler, enelx_addr
+            ),
+        )
+
+    if args.update_udpc:
+        from juicebox_udpcupdater import JuiceboxUDPCUpdater
+
+        jpp_host = args.jpp_host or local_addr[0]
+        udpc_updater = JuiceboxUDPCUpdater(
+            juicebox_host=args.juicebox_host,
+            jpp_host=jpp_host,
+            telnet_port=telnet_port,
+            udpc_port=local_addr[1],
+            telnet_timeout=telnet_timeout,
+            loglevel=_LOGGER.getEffectiveLevel(),
+        )
+        await mitm_handler.add_traffic_listener(udpc_updater.notify_traffic)
+        supervisor.add("udpc_updater", udpc_updater.start, udpc_updater.close)
+
+    try:
+        await supervisor.start()
+    except ChildProcessError as e:
+        _LOGGER.error(f"A JuicePass Proxy component keeps failing. ({e.__class__.__qualname__}: {e})")
 
     _LOGGER.error("JuicePass Proxy Exiting")
+    if discovery_task is not None:
+        discovery_task.cancel()
+    await state_snapshot.close()
+    await interval_profile.close()
+    if history is not None:
+        await history.close()
     sys.exit(1)
 
 
 if __name__ == "__main__":
+    from aiorun import run
+
     run(main(), stop_on_unhandled_errors=True)
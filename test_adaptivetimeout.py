@@ -0,0 +1,115 @@
+import asyncio
+import unittest
+
+import asyncio_dgram
+
+from const import MITM_SEND_DATA_TIMEOUT
+from juicebox_adaptivetimeout import JuiceboxAdaptiveTimeout
+from juicebox_metrics import METRICS
+from juicebox_mitm import JuiceboxMITM
+from juicebox_udpcupdater import udpc_check_timeout
+from test_startup import DEBUG_MESSAGE, FAKE_ENELX_IP, passthrough
+
+
+class TestAdaptiveTimeout(unittest.IsolatedAsyncioTestCase):
+
+    def test_learned_timeout(self):
+        timeout = JuiceboxAdaptiveTimeout(120, 15, 900, min_samples=4)
+        self.assertEqual(120, timeout.get())
+        for _ in range(3):
+            timeout.observe(9)
+        self.assertEqual(120, timeout.get())
+        timeout.observe(9)
+        # 3 report intervals
+        self.assertEqual(27, timeout.get())
+        # Irregular intervals add 4 deviations
+        timeout.observe(30)
+        self.assertGreater(timeout.get(), timeout.average + 4 * 2)
+        self.assertGreater(timeout.get(), 27)
+
+    def test_expected_interval(self):
+        timeout = JuiceboxAdaptiveTimeout(120, 15, 900)
+        # Report time known from the first status message
+        timeout.set_expected(9)
+        self.assertEqual(27, timeout.get())
+        # Debug messages between status messages don't make it shorter
+        for _ in range(8):
+            timeout.observe(1)
+        self.assertEqual(27, timeout.get())
+        # Slow reporting firmware is not limited by the initial value
+        timeout.set_expected(120)
+        self.assertEqual(360, timeout.get())
+        timeout.set_expected(1)
+        self.assertEqual(15, timeout.get())
+
+    def test_expired_backoff(self):
+        timeout = JuiceboxAdaptiveTimeout(120, 15, 900)
+        timeout.set_expected(9)
+        timeout.expired()
+        self.assertEqual(54, timeout.get())
+        for _ in range(5):
+            timeout.expired()
+        self.assertEqual(900, timeout.get())
+        timeout.observe(9)
+        self.assertEqual(27, timeout.get())
+
+    async def test_inner_timeouts(self):
+        # A UDPC check is never cut before one telnet command timed out
+        timeout = udpc_check_timeout(30)
+        for _ in range(8):
+            timeout.observe(0.5)
+        self.assertEqual(30, timeout.get())
+        timeout = udpc_check_timeout(120)
+        self.assertEqual(120, timeout.get())
+        timeout.expired()
+        self.assertEqual(120, timeout.get())
+        # A handler is never cut before one send timed out
+        mitm_timeout = JuiceboxMITM(("127.0.0.1", 0), (FAKE_ENELX_IP, 8047))._handler_timeout
+        for _ in range(8):
+            mitm_timeout.observe(0.01)
+        self.assertEqual(MITM_SEND_DATA_TIMEOUT, mitm_timeout.get())
+        mitm_timeout.expired()
+        self.assertEqual(2 * MITM_SEND_DATA_TIMEOUT, mitm_timeout.get())
+
+    async def test_outage_keeps_socket(self):
+        outages = METRICS.get("juicepassproxy_juicebox_outages_total").labels()
+        outages_before = outages.value
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(("127.0.0.1", 0), enelx.sockname, local_mitm_handler=passthrough)
+        mitm._recv_timeout = JuiceboxAdaptiveTimeout(0.1, 0.1, 0.4, min_samples=2)
+        task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            dgram = mitm._dgram
+            juicebox = await asyncio_dgram.connect(dgram.sockname)
+            for _ in range(3):
+                await juicebox.send(DEBUG_MESSAGE)
+                async with asyncio.timeout(1):
+                    await enelx.recv()
+                await asyncio.sleep(0.01)
+            self.assertEqual(2, mitm._recv_timeout.samples)
+            # JuiceBox silent for a few timeouts
+            await asyncio.sleep(1)
+            self.assertEqual(outages_before + 1, outages.value)
+            self.assertIsNotNone(mitm._outage_start)
+            self.assertGreaterEqual(mitm._recv_timeout.backoff, 4)
+
+            await juicebox.send(DEBUG_MESSAGE)
+            async with asyncio.timeout(1):
+                self.assertEqual(DEBUG_MESSAGE, (await enelx.recv())[0])
+            self.assertIsNone(mitm._outage_start)
+            self.assertEqual(1, mitm._recv_timeout.backoff)
+            # The outage was not an interval
+            self.assertEqual(2, mitm._recv_timeout.samples)
+            self.assertIs(dgram, mitm._dgram)
+            self.assertEqual(0, mitm._errors.count())
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
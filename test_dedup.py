@@ -0,0 +1,105 @@
+import asyncio
+import time
+import unittest
+
+import asyncio_dgram
+
+import test_message
+from juicebox_dedup import JuiceboxDuplicateFilter, duplicate_key
+from juicebox_metrics import METRICS
+from juicebox_mitm import JuiceboxMITM
+from test_message import FAKE_SERIAL
+from test_startup import DEBUG_MESSAGE, FAKE_ENELX_IP
+from test_state import FakeSetpointsMQTTHandler
+
+V07_SAMPLE = test_message.TestMessage.V07_SAMPLE.encode()
+V07_SAMPLE_2 = test_message.TestMessage.V07_SAMPLE_2.encode()
+
+
+def status(counter, crc=b"KKD"):
+    return V07_SAMPLE.replace(b",s0001,", f",s{counter:04d},".encode()).replace(b"!KKD:", b"!" + crc + b":")
+
+
+class TestDuplicateFilter(unittest.IsolatedAsyncioTestCase):
+
+    def test_key(self):
+        self.assertEqual((FAKE_SERIAL.encode(), 1, b"KKD"), duplicate_key(V07_SAMPLE))
+        self.assertEqual((FAKE_SERIAL.encode(), 177, b"QBJ"), duplicate_key(V07_SAMPLE_2))
+        self.assertIsNone(duplicate_key(DEBUG_MESSAGE))
+        self.assertIsNone(duplicate_key(b"CMD41325A0040M040C006S638!5N5$"))
+
+    def test_window(self):
+        duplicates = JuiceboxDuplicateFilter(window=8)
+        self.assertFalse(duplicates.is_duplicate(status(100)))
+        # Retransmission
+        self.assertTrue(duplicates.is_duplicate(status(100)))
+        self.assertFalse(duplicates.is_duplicate(status(101)))
+        # Late retransmission inside the window
+        self.assertFalse(duplicates.is_duplicate(status(99)))
+        self.assertTrue(duplicates.is_duplicate(status(99)))
+        self.assertTrue(duplicates.is_duplicate(status(100)))
+        # Same counter with other content is not a duplicate
+        self.assertFalse(duplicates.is_duplicate(status(101, b"ABC")))
+        self.assertFalse(duplicates.is_duplicate(status(106)))
+        self.assertTrue(duplicates.is_duplicate(status(101, b"ABC")))
+        # Out of the window
+        self.assertFalse(duplicates.is_duplicate(status(110)))
+        self.assertFalse(duplicates.is_duplicate(status(101, b"ABC")))
+        # Device rebooted, the counter starts again
+        self.assertFalse(duplicates.is_duplicate(status(1)))
+        self.assertTrue(duplicates.is_duplicate(status(1)))
+        # Each device has its window
+        self.assertFalse(duplicates.is_duplicate(status(1).replace(b"0910", b"0911", 1)))
+        # Not a status message
+        self.assertFalse(duplicates.is_duplicate(DEBUG_MESSAGE))
+        self.assertFalse(duplicates.is_duplicate(DEBUG_MESSAGE))
+
+    async def test_retransmission_forwarded_once_decoded(self):
+        handled = []
+
+        async def local_handler(data, decoded_message=None):
+            handled.append(decoded_message)
+            return data
+
+        duplicates_total = METRICS.get("juicepassproxy_duplicates_total").labels()
+        suppressed = duplicates_total.value
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(
+            ("127.0.0.1", 0),
+            enelx.sockname,
+            local_mitm_handler=local_handler,
+            mqtt_handler=FakeSetpointsMQTTHandler(32, 16),
+        )
+        task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            for data in (V07_SAMPLE, V07_SAMPLE, V07_SAMPLE_2, V07_SAMPLE_2):
+                await juicebox.send(data)
+                async with asyncio.timeout(1):
+                    # Duplicates still go to EnelX unchanged
+                    self.assertEqual(data, (await enelx.recv())[0])
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+
+        self.assertEqual(2, len(handled))
+        self.assertEqual(["0001", "0177"], [m.get_value("s") for m in handled])
+        self.assertEqual(suppressed + 2, duplicates_total.value)
+
+    def test_cost(self):
+        duplicates = JuiceboxDuplicateFilter()
+        count = 20000
+        messages = [status(counter % 10000) for counter in range(count)]
+        start = time.perf_counter()
+        for data in messages:
+            duplicates.is_duplicate(data)
+        per_datagram = (time.perf_counter() - start) / count
+        self.assertLess(per_datagram, 0.0001, f"{per_datagram * 1e9:.0f} ns per datagram")
+
+
+if __name__ == '__main__':
+    unittest.main()
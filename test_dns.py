@@ -0,0 +1,169 @@
+import asyncio
+import tempfile
+import unittest
+
+import asyncio_dgram
+import dns.message
+import dns.rcode
+import dns.rrset
+
+import test_message
+from const import ENELX_DNS_MIN_REFRESH, ENELX_FAILOVER_UNANSWERED
+from juicebox_config import JuiceboxConfig
+from juicebox_dns import JuiceboxEnelXResolver
+from juicebox_mitm import JuiceboxMITM
+from test_errorbudget import FakeClock
+from test_startup import DEBUG_MESSAGE, passthrough
+from test_state import FakeSetpointsMQTTHandler
+
+ENELX_SERVER = "juicenet-udp-prod3-usa.enelx.com"
+V07_SAMPLE = test_message.TestMessage.V07_SAMPLE.encode()
+
+
+class FakeDNSServer(asyncio.DatagramProtocol):
+    """Answers A queries from records, SERVFAIL when fail is set"""
+
+    def __init__(self):
+        self.records = {}
+        self.fail = False
+        self.queries = 0
+        self._transport = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: self, local_addr=("127.0.0.1", 0)
+        )
+        self.port = self._transport.get_extra_info("sockname")[1]
+
+    def close(self):
+        self._transport.close()
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        name = query.question[0].name
+        if self.fail:
+            response.set_rcode(dns.rcode.SERVFAIL)
+        elif (record := self.records.get(name.to_text(omit_final_dot=True))) is not None:
+            ips, ttl = record
+            response.answer.append(dns.rrset.from_text(name, ttl, "IN", "A", *ips))
+        else:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        self._transport.sendto(response.to_wire(), addr)
+
+
+class TestEnelXResolver(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.config = JuiceboxConfig(self.tempdir.name)
+        self.dns = FakeDNSServer()
+        await self.dns.start()
+        self.dns.records[ENELX_SERVER] = (["127.0.0.2", "127.0.0.3"], 300)
+        self.clock = FakeClock()
+        self.resolver = self._resolver()
+        self.mitm = JuiceboxMITM(("127.0.0.1", 0), ("54.161.185.130", 8047), local_mitm_handler=passthrough)
+        await self.resolver.set_mitm_handler(self.mitm)
+
+    async def asyncTearDown(self):
+        self.dns.close()
+        self.tempdir.cleanup()
+
+    def _resolver(self):
+        return JuiceboxEnelXResolver(
+            ENELX_SERVER, 8047, self.config, nameserver="127.0.0.1", nameserver_port=self.dns.port, clock=self.clock
+        )
+
+    async def test_refresh_and_cache(self):
+        self.assertTrue(await self.resolver.refresh())
+        self.assertEqual(["127.0.0.2", "127.0.0.3"], self.resolver.addresses)
+        self.assertEqual(("127.0.0.2", 8047), self.mitm._enelx_addr)
+        # Refreshed before the TTL ends
+        self.assertEqual(300 * 0.8, self.resolver._time_until_refresh())
+
+        # Cached answer is used after a restart without asking DNS
+        self.assertEqual("127.0.0.2", self.config.get("ENELX_IP", None))
+        self.assertEqual(1, self.dns.queries)
+        resolver = self._resolver()
+        self.assertEqual(["127.0.0.2", "127.0.0.3"], resolver.addresses)
+        self.assertEqual(300 * 0.8, resolver._time_until_refresh())
+
+        # Short TTLs don't hammer the DNS server
+        self.dns.records[ENELX_SERVER] = (["127.0.0.3", "127.0.0.4"], 5)
+        self.assertTrue(await self.resolver.refresh())
+        self.assertEqual(ENELX_DNS_MIN_REFRESH, self.resolver._time_until_refresh())
+        # Address in use is gone
+        self.assertEqual(("127.0.0.3", 8047), self.mitm._enelx_addr)
+
+        # Address in use is still announced, no change
+        self.dns.records[ENELX_SERVER] = (["127.0.0.4", "127.0.0.3"], 300)
+        self.assertTrue(await self.resolver.refresh())
+        self.assertEqual(("127.0.0.3", 8047), self.mitm._enelx_addr)
+
+    async def test_failed_lookup_keeps_addresses(self):
+        await self.resolver.refresh()
+        self.dns.fail = True
+        self.assertFalse(await self.resolver.refresh())
+        self.assertEqual(["127.0.0.2", "127.0.0.3"], self.resolver.addresses)
+        self.assertEqual(("127.0.0.2", 8047), self.mitm._enelx_addr)
+
+    async def test_failover(self):
+        await self.resolver.refresh()
+        self.assertEqual("127.0.0.3", await self.resolver.failover())
+        # The new address is on the file
+        written = JuiceboxConfig(self.tempdir.name)
+        await written.load()
+        self.assertEqual("127.0.0.3", written.get("ENELX_IP", None))
+        self.assertFalse(self.config.is_changed())
+        self.assertEqual("127.0.0.2", await self.resolver.failover())
+        self.dns.records[ENELX_SERVER] = (["127.0.0.2"], 300)
+        await self.resolver.refresh()
+        self.assertIsNone(await self.resolver.failover())
+
+    async def test_live_failover_on_mitm(self):
+        # First EnelX address never answers, second one does
+        silent = await asyncio_dgram.bind(("127.0.0.2", 0))
+        answering = await asyncio_dgram.bind(("127.0.0.3", silent.sockname[1]))
+        self.dns.records[ENELX_SERVER] = (["127.0.0.2", "127.0.0.3"], 300)
+        resolver = JuiceboxEnelXResolver(
+            ENELX_SERVER, silent.sockname[1], self.config, nameserver="127.0.0.1", nameserver_port=self.dns.port, clock=self.clock
+        )
+        await resolver.set_mitm_handler(self.mitm)
+        await self.mitm.set_enelx_failover_handler(resolver.failover)
+        await self.mitm.set_mqtt_handler(FakeSetpointsMQTTHandler(32, 16))
+        resolver_task = asyncio.create_task(resolver.start())
+        mitm_task = asyncio.create_task(self.mitm.start())
+        try:
+            while self.mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(self.mitm._dgram.sockname)
+            while self.mitm._enelx_addr[0] != "127.0.0.2":
+                await asyncio.sleep(0.001)
+            # EnelX doesn't answer debug messages, they don't count
+            for _ in range(ENELX_FAILOVER_UNANSWERED):
+                await juicebox.send(DEBUG_MESSAGE)
+                async with asyncio.timeout(5):
+                    await silent.recv()
+            self.assertEqual(("127.0.0.2", silent.sockname[1]), self.mitm._enelx_addr)
+            for _ in range(ENELX_FAILOVER_UNANSWERED):
+                await juicebox.send(V07_SAMPLE)
+                async with asyncio.timeout(5):
+                    await silent.recv()
+            await juicebox.send(DEBUG_MESSAGE)
+            async with asyncio.timeout(5):
+                data, _ = await answering.recv()
+            self.assertEqual(DEBUG_MESSAGE, data)
+            self.assertEqual("127.0.0.3", self.config.get("ENELX_IP", None))
+            juicebox.close()
+        finally:
+            resolver_task.cancel()
+            mitm_task.cancel()
+            self.mitm._dgram.close()
+            silent.close()
+            answering.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
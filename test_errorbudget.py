@@ -0,0 +1,98 @@
+import unittest
+
+from juicebox_errorbudget import (
+    BREAKER_CLOSED,
+    BREAKER_HALF_OPEN,
+    BREAKER_OPEN,
+    JuiceboxCircuitBreaker,
+    JuiceboxErrorBudget,
+)
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestErrorBudget(unittest.TestCase):
+
+    def test_sliding_window(self):
+        clock = FakeClock()
+        budget = JuiceboxErrorBudget("test", max_errors=3, window=60, bucket_count=6, clock=clock)
+        budget.add()
+        clock.now += 30
+        budget.add()
+        self.assertEqual(2, budget.count())
+        self.assertFalse(budget.exhausted())
+        budget.add()
+        self.assertTrue(budget.exhausted())
+        # First error leaves the window
+        clock.now += 35
+        self.assertEqual(2, budget.count())
+        # Long idle period clears everything without walking more than the ring
+        clock.now += 10 ** 6
+        self.assertEqual(0, budget.count())
+
+    def test_error_storm(self):
+        clock = FakeClock()
+        budget = JuiceboxErrorBudget("storm", max_errors=10, window=3600, clock=clock)
+        for _ in range(100000):
+            budget.add()
+        self.assertEqual(100000, budget.count())
+        clock.now += 3600
+        self.assertEqual(0, budget.count())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_half_open_close(self):
+        clock = FakeClock()
+        breaker = JuiceboxCircuitBreaker("test", failure_threshold=2, reset_timeout=10, max_reset_timeout=40, clock=clock)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(BREAKER_CLOSED, breaker.state)
+        breaker.record_failure()
+        self.assertEqual(BREAKER_OPEN, breaker.state)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(10, breaker.retry_in())
+
+        clock.now += 10
+        self.assertEqual(BREAKER_HALF_OPEN, breaker.state)
+        # Only one trial call while half open
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(BREAKER_OPEN, breaker.state)
+        # Timeout doubled after failed trial
+        self.assertEqual(20, breaker.retry_in())
+
+        clock.now += 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(BREAKER_CLOSED, breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertEqual("closed", breaker.inspect()["state"])
+
+    def test_trial_without_outcome(self):
+        clock = FakeClock()
+        breaker = JuiceboxCircuitBreaker("trial", failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now += 10
+        # Trial datagram never answered
+        self.assertTrue(breaker.allow())
+        clock.now += 9
+        self.assertFalse(breaker.allow())
+        clock.now += 1
+        self.assertEqual(BREAKER_HALF_OPEN, breaker.state)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(BREAKER_CLOSED, breaker.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
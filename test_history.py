@@ -0,0 +1,217 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from juicebox_history import JuiceboxHistory
+from juicebox_metrics import JuiceboxMetricsServer
+from juicebox_message import juicebox_message_from_string
+from test_message import FAKE_SERIAL
+
+V09U_SAMPLE = '0910000000000000000000000000:v09u,s001,F31,u00412974,V1366,L00004262804,S02,T28,M0024,C0024,m0032,t09,i23,e-0001,f5990,r99,b000,B0000000,P0,E0004501,A00161,p0996!ZW5:'
+
+
+class FakeStatusMessage:
+
+    def __init__(self, serial, **values):
+        self.serial = serial
+        self.values = values
+
+    def get_value(self, type):
+        return self.serial
+
+    def get_processed_value(self, type):
+        return self.values.get(type, None)
+
+
+class TestHistory(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.history = JuiceboxHistory(self.tmpdir.name, 30)
+        await self.history.start()
+        self.message = juicebox_message_from_string(V09U_SAMPLE)
+
+    async def asyncTearDown(self):
+        await self.history.close()
+        self.tmpdir.cleanup()
+
+    async def test_range_and_downsample(self):
+        start = int(time.time()) // 300 * 300 - 900
+        for i in range(100):
+            self.history.add(self.message, start + i * 9)
+        await self.history.flush()
+
+        self.assertEqual([FAKE_SERIAL], await self.history.devices())
+        rows = await self.history.query_range(FAKE_SERIAL, start, start + 90)
+        self.assertEqual(10, len(rows))
+        self.assertEqual(start, rows[0]["ts"])
+        self.assertEqual(16.1, rows[0]["current"])
+        self.assertEqual(136.6, rows[0]["voltage"])
+        self.assertEqual("Charging", rows[0]["status"])
+        self.assertEqual(4262804, rows[0]["energy_lifetime"])
+
+        rows = await self.history.query_downsampled(FAKE_SERIAL, start, start + 900, 300)
+        self.assertEqual(3, len(rows))
+        self.assertEqual(34, rows[0]["samples"])
+        self.assertEqual(4501, rows[0]["energy_session"])
+
+        content_type, body = await self.history.http_route(
+            {"start": str(start), "end": str(start + 900), "step": "300"}
+        )
+        self.assertEqual("application/json", content_type)
+        self.assertIn(FAKE_SERIAL, body)
+
+    async def test_bad_query(self):
+        server = JuiceboxMetricsServer("127.0.0.1", 0)
+        server.add_route("/history", self.history.http_route)
+        await server.start()
+        try:
+            for query in ("start=yesterday", "end=1e", "step=5.5"):
+                reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+                writer.write(f"GET /history?{query} HTTP/1.0\r\n\r\n".encode())
+                response = (await reader.read()).decode()
+                writer.close()
+                self.assertTrue(response.startswith("HTTP/1.0 400 Bad Request"), response)
+        finally:
+            await server.close()
+
+    async def test_prune(self):
+        now = time.time()
+        self.history.add(self.message, now - 40 * 24 * 60 * 60)
+        self.history.add(self.message, now)
+        await self.history.flush()
+        self.assertEqual(1, await self.history.prune(now))
+        rows = await self.history.query_range(FAKE_SERIAL, 0, now + 1)
+        self.assertEqual(1, len(rows))
+
+    async def test_rollups(self):
+        hour = int(time.time()) // 3600 * 3600 - 10 * 3600
+        energy = 1000
+        for i in range(3 * 400):
+            # counter reset in the middle of the second hour
+            energy = 0 if i == 600 else energy + 2
+            self.history.add(
+                FakeStatusMessage("dev", current=i % 40, voltage=240, energy_lifetime=energy),
+                hour + i * 9,
+            )
+            # flush in the middle of an hour to check incremental updates
+            if i % 250 == 0:
+                await self.history.flush()
+        await self.history.flush()
+
+        rows = await self.history.query_rollup("dev", "hour", hour, hour + 4 * 3600)
+        self.assertEqual([hour, hour + 3600, hour + 7200], [row["ts"] for row in rows])
+        self.assertEqual(400, rows[0]["samples"])
+        self.assertEqual(0, rows[0]["current_min"])
+        self.assertEqual(39, rows[0]["current_max"])
+        self.assertEqual(240, rows[0]["voltage_mean"])
+        # first sample has no previous value, reset sample adds nothing
+        self.assertEqual(399 * 2, rows[0]["energy"])
+        self.assertEqual(399 * 2, rows[1]["energy"])
+        self.assertEqual(400 * 2, rows[2]["energy"])
+
+        days = await self.history.query_rollup("dev", "day", 0, hour + 4 * 3600)
+        months = await self.history.query_rollup("dev", "month", 0, hour + 4 * 3600)
+        self.assertEqual(1200, sum(row["samples"] for row in days))
+        self.assertEqual((399 + 399 + 400) * 2, sum(row["energy"] for row in days))
+        self.assertEqual(sum(row["energy"] for row in days), sum(row["energy"] for row in months))
+
+    async def test_rollup_rebuild(self):
+        hour = int(time.time()) // 3600 * 3600 - 3600
+        for i in range(10):
+            self.history.add(FakeStatusMessage("dev", energy_lifetime=i * 10), hour + i * 9)
+        await self.history.flush()
+        # Lose the rollups as if the database was written by an older version
+        await self.history._run(self.history._db.executescript, "DELETE FROM status_rollup; DELETE FROM rollup_state;")
+        await self.history.close()
+
+        self.history = JuiceboxHistory(self.tmpdir.name, 30)
+        await self.history.start()
+        rows = await self.history.query_rollup("dev", "hour", hour, hour + 3600)
+        self.assertEqual(10, rows[0]["samples"])
+        self.assertEqual(90, rows[0]["energy"])
+
+    async def test_rollup_missing_fields(self):
+        hour = int(time.time()) // 3600 * 3600 - 2 * 3600
+        self.history.add(FakeStatusMessage("dev", current=10, voltage=240), hour)
+        self.history.add(FakeStatusMessage("dev", current=20), hour + 9)
+        self.history.add(FakeStatusMessage("dev", current=30), hour + 18)
+        self.history.add(FakeStatusMessage("dev", current=40), hour + 3600)
+        await self.history.flush()
+
+        rows = await self.history.query_rollup("dev", "hour", hour, hour + 2 * 3600)
+        self.assertEqual(240, rows[0]["voltage_mean"])
+        self.assertEqual(20, rows[0]["current_mean"])
+        self.assertIsNone(rows[1]["voltage_mean"])
+        days = await self.history.query_rollup("dev", "day", 0, hour + 2 * 3600)
+        self.assertEqual(240, days[-1]["voltage_mean"])
+        self.assertIsNone(days[-1]["temperature_mean"])
+
+    async def test_rollup_half_hour_zone(self):
+        old_tz = os.environ.get("TZ")
+
+        def restore_tz():
+            if old_tz is None:
+                os.environ.pop("TZ", None)
+            else:
+                os.environ["TZ"] = old_tz
+            time.tzset()
+
+        self.addCleanup(restore_tz)
+        os.environ["TZ"] = "IST-5:30"
+        time.tzset()
+        # local midnight is 18:30 UTC, samples every 5 minutes around it
+        day = int(time.mktime((2026, 10, 19, 0, 0, 0, 0, 0, -1)))
+        for i in range(24):
+            self.history.add(FakeStatusMessage("dev", voltage=240), day - 3600 + i * 300)
+        await self.history.flush()
+
+        hours = await self.history.query_rollup("dev", "hour", 0, day + 3600)
+        self.assertEqual([day - 3600, day], [row["ts"] for row in hours])
+        self.assertEqual([12, 12], [row["samples"] for row in hours])
+        days = await self.history.query_rollup("dev", "day", 0, day + 3600)
+        self.assertEqual([(day - 86400, 12), (day, 12)], [(row["ts"], row["samples"]) for row in days])
+
+    async def test_rollup_old_layout(self):
+        hour = int(time.time()) // 3600 * 3600 - 3600
+        self.history.add(FakeStatusMessage("dev", voltage=240), hour)
+        await self.history.flush()
+        # Rollup table without the per field counts of older versions
+        await self.history._run(
+            self.history._db.executescript,
+            "ALTER TABLE status_rollup DROP COLUMN voltage_count;",
+        )
+        await self.history.close()
+
+        self.history = JuiceboxHistory(self.tmpdir.name, 30)
+        await self.history.start()
+        rows = await self.history.query_rollup("dev", "hour", hour, hour + 3600)
+        self.assertEqual(240, rows[0]["voltage_mean"])
+
+    async def test_downsample_speed(self):
+        # One month of 9 second samples
+        count = 29 * 24 * 60 * 60 // 9
+        start = int(time.time()) // 3600 * 3600 - count * 9
+        for i in range(count):
+            self.history.add(self.message, start + i * 9)
+        await self.history.flush()
+        query_start = time.perf_counter()
+        rows = await self.history.query_downsampled(
+            FAKE_SERIAL, start, start + count * 9, 60 * 60
+        )
+        elapsed = time.perf_counter() - query_start
+        self.assertEqual(29 * 24, len(rows))
+        self.assertLess(elapsed, 2, f"{count} samples downsampled in {elapsed * 1000:.0f} ms")
+
+        # days start at local midnight
+        rows = await self.history.query_rollup(
+            FAKE_SERIAL, "day", start - 24 * 60 * 60, start + count * 9
+        )
+        self.assertIn(len(rows), (29, 30))
+        self.assertEqual(count, sum(row["samples"] for row in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from const import STARTUP_IMPORT_BUDGET, STARTUP_LISTEN_BUDGET
+from test_message import FAKE_SERIAL
+from test_startup import FAKE_ENELX_IP
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Set on runners too slow for the startup budgets, the lazy import checks still run
+SKIP_BUDGETS = bool(os.environ.get("JPP_SKIP_STARTUP_BUDGETS"))
+
+# Only imported by the features that use them
+LAZY_MODULES = ("aiorun", "dns", "telnetlib3", "yaml", "pydantic", "ha_mqtt_discoverable")
+
+
+def parse_importtime(stderr):
+    """Cumulative import time in seconds by module from python -X importtime"""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        imports[module.strip()] = int(cumulative) / 1e6
+    return imports
+
+
+def free_udp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestImportTime(unittest.TestCase):
+
+    def test_import_budget(self):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import juicepassproxy"],
+            cwd=SOURCE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        imports = parse_importtime(result.stderr)
+        slowest = sorted(imports.items(), key=lambda i: i[1], reverse=True)[:5]
+        self.assertEqual(
+            [], [m for m in imports if m.split(".")[0] in LAZY_MODULES]
+        )
+        if not SKIP_BUDGETS:
+            self.assertLess(
+                imports["juicepassproxy"],
+                STARTUP_IMPORT_BUDGET,
+                ", ".join(f"{module} {seconds * 1000:.0f} ms" for module, seconds in slowest),
+            )
+
+    def test_listen_budget(self):
+        # Nothing to discover: no telnet, no DNS, MQTT broker not running
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        port = free_udp_port()
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [
+                sys.executable, "-X", "importtime", "juicepassproxy.py",
+                "--juicebox_id", FAKE_SERIAL,
+                "--enelx_ip", f"{FAKE_ENELX_IP}:8047",
+                "--local_ip", f"127.0.0.1:{port}",
+                "--config_loc", tempdir.name,
+                "--log_loc", "none",
+                "--mqtt_host", "127.0.0.1",
+                "--mqtt_port", str(free_udp_port()),
+            ],
+            cwd=SOURCE_DIR,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        lines = []
+        try:
+            for line in process.stderr:
+                lines.append(line)
+                if f"JuiceboxMITM listening at 127.0.0.1:{port}" in line:
+                    break
+            listening = time.perf_counter() - start
+        finally:
+            process.kill()
+            process.wait()
+            process.stderr.close()
+        self.assertIn("JuiceboxMITM listening", lines[-1])
+        imports = parse_importtime("".join(lines))
+        # dns is still imported by paho.mqtt.client
+        for module in ("juicebox_dns", "juicebox_telnet", "juicebox_udpcupdater", "telnetlib3"):
+            self.assertNotIn(module, imports)
+        if not SKIP_BUDGETS:
+            self.assertLess(listening, STARTUP_LISTEN_BUDGET, f"MITM listening after {listening * 1000:.0f} ms")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+import asyncio
+import os
+import socket
+import statistics
+import sys
+import time
+import unittest
+
+import asyncio_dgram
+
+import test_message
+from juicebox_ingress import (
+    INGRESS_PREFIX,
+    INGRESS_RATE_LIMITED,
+    INGRESS_SIZE,
+    JuiceboxIngressFilter,
+)
+from juicebox_metrics import METRICS
+from juicebox_mitm import JuiceboxMITM
+from test_errorbudget import FakeClock
+from test_message import FAKE_SERIAL
+from test_startup import DEBUG_MESSAGE, FAKE_ENELX_IP, passthrough
+from test_state import FakeSetpointsMQTTHandler
+
+V07_SAMPLE = test_message.TestMessage.V07_SAMPLE.encode()
+OTHER_SERIAL_STATUS = test_message.TestMessage.ISSUE_84_SAMPLE_MESSAGE.encode()
+JUICEBOX_IP = "127.0.0.1"
+ATTACKER_IP = "127.0.0.3"
+
+# Datagrams per second of the flood. Faster floods of big datagrams overflow the
+# kernel receive buffer, that drops the JuiceBox datagrams whatever the proxy does
+FLOOD_RATE = 5000
+FLOOD = (
+    b"\x00" * 64,
+    b"9" * 4000,
+    DEBUG_MESSAGE,
+    OTHER_SERIAL_STATUS,
+    V07_SAMPLE.replace(b"!KKD:", b"!XXX:"),
+)
+
+
+def flood(host, port, seconds, rate=FLOOD_RATE):
+    """Sends FLOOD datagrams from ATTACKER_IP at rate per second during seconds, prints the count"""
+    sent = 0
+    start = time.perf_counter()
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((ATTACKER_IP, 0))
+        while time.perf_counter() - start < seconds:
+            for data in FLOOD:
+                sock.sendto(data, (host, port))
+                sent += 1
+            time.sleep(max(0, start + sent / rate - time.perf_counter()))
+    print(sent)
+
+
+class TestIngressFilter(unittest.IsolatedAsyncioTestCase):
+
+    def test_checks(self):
+        clock = FakeClock()
+        ingress = JuiceboxIngressFilter(max_size=300, rate=1, burst=2, clock=clock)
+        self.assertIsNone(ingress.check(V07_SAMPLE, JUICEBOX_IP))
+        self.assertEqual(INGRESS_SIZE, ingress.check(b"0" * 301, JUICEBOX_IP))
+        self.assertEqual(INGRESS_PREFIX, ingress.check(b"CMD41325A0040M040C006S638!5N5$", JUICEBOX_IP))
+        # Burst used by the last 2 datagrams that reached the bucket
+        self.assertEqual(INGRESS_RATE_LIMITED, ingress.check(V07_SAMPLE, JUICEBOX_IP))
+        # Other source has its own bucket
+        self.assertIsNone(ingress.check(DEBUG_MESSAGE, ATTACKER_IP))
+        clock.now += 1
+        self.assertIsNone(ingress.check(V07_SAMPLE, JUICEBOX_IP))
+        self.assertEqual(INGRESS_RATE_LIMITED, ingress.check(V07_SAMPLE, JUICEBOX_IP))
+        clock.now += 2
+        self.assertEqual(
+            INGRESS_PREFIX,
+            ingress.check(b"091000000000000000000000000x:v07", ATTACKER_IP),
+        )
+        self.assertEqual(INGRESS_PREFIX, ingress.check(b":v07", ATTACKER_IP))
+
+    def test_learned_source(self):
+        clock = FakeClock()
+        ingress = JuiceboxIngressFilter(unknown_rate=1, burst=1, clock=clock)
+        # Nothing known yet, any source can be the JuiceBox
+        self.assertTrue(ingress.allowed(ATTACKER_IP))
+        self.assertTrue(ingress.learn(JUICEBOX_IP, FAKE_SERIAL))
+        self.assertTrue(ingress.allowed(JUICEBOX_IP))
+        self.assertFalse(ingress.allowed(ATTACKER_IP))
+        # Sources not allowed share a slower bucket
+        self.assertIsNone(ingress.check(DEBUG_MESSAGE, ATTACKER_IP))
+        self.assertEqual(INGRESS_RATE_LIMITED, ingress.check(DEBUG_MESSAGE, "127.0.0.4"))
+        self.assertIsNone(ingress.check(DEBUG_MESSAGE, JUICEBOX_IP))
+        # Only the same serial moves the JuiceBox
+        self.assertFalse(ingress.learn(ATTACKER_IP, "0000000000000000000000000000"))
+        self.assertTrue(ingress.learn("192.168.1.20", FAKE_SERIAL))
+        self.assertFalse(ingress.allowed(JUICEBOX_IP))
+
+        configured = JuiceboxIngressFilter("192.168.1.20", FAKE_SERIAL)
+        self.assertFalse(configured.allowed(JUICEBOX_IP))
+        self.assertTrue(configured.allowed("192.168.1.20"))
+        self.assertFalse(configured.learn(JUICEBOX_IP, "0000000000000000000000000000"))
+        # A hostname is learned from the status messages
+        self.assertTrue(JuiceboxIngressFilter("juicebox.local").allowed(ATTACKER_IP))
+
+    async def test_new_source_decoded_once(self):
+        decodes = METRICS.get("juicepassproxy_decode_seconds").labels()
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        # Configured address is not the one the JuiceBox uses now
+        mitm = JuiceboxMITM(
+            (JUICEBOX_IP, 0),
+            enelx.sockname,
+            local_mitm_handler=passthrough,
+            mqtt_handler=FakeSetpointsMQTTHandler(32, 16),
+            juicebox_host="192.168.1.20",
+            juicebox_id=FAKE_SERIAL,
+        )
+        task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            decoded_before = decodes.count
+            await juicebox.send(V07_SAMPLE)
+            async with asyncio.timeout(1):
+                self.assertEqual(V07_SAMPLE, (await enelx.recv())[0])
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+        self.assertEqual(juicebox.sockname, mitm._juicebox_addr)
+        self.assertEqual(decoded_before + 1, decodes.count)
+        self.assertIsNotNone(mitm._last_status_message)
+
+    async def test_flood(self):
+        # Latency as in production, debug mode costs more than the filter
+        asyncio.get_running_loop().set_debug(False)
+        decodes = METRICS.get("juicepassproxy_decode_seconds").labels()
+        dropped = METRICS.get("juicepassproxy_ingress_dropped_total")
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(
+            (JUICEBOX_IP, 0),
+            enelx.sockname,
+            local_mitm_handler=passthrough,
+            mqtt_handler=FakeSetpointsMQTTHandler(32, 16),
+        )
+        task = asyncio.create_task(mitm.start())
+        generator = None
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            await juicebox.send(V07_SAMPLE)
+            async with asyncio.timeout(1):
+                await enelx.recv()
+            juicebox_addr = mitm._juicebox_addr
+            await asyncio.sleep(0.12)
+
+            async def forward_latencies():
+                latencies = []
+                for _ in range(10):
+                    start = time.perf_counter()
+                    await juicebox.send(DEBUG_MESSAGE)
+                    async with asyncio.timeout(2):
+                        while (await enelx.recv())[0] != DEBUG_MESSAGE:
+                            pass
+                    latencies.append(time.perf_counter() - start)
+                    # Forwarding waits 0.1 sec after each send
+                    await asyncio.sleep(0.12)
+                return latencies
+
+            baseline = await forward_latencies()
+            decoded_before = decodes.count
+            # Other process, the generator must not hold the GIL of the proxy
+            host, port = mitm._dgram.sockname
+            generator = await asyncio.create_subprocess_exec(
+                sys.executable,
+                "-c",
+                f"import test_ingress; test_ingress.flood({host!r}, {port}, 2)",
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=asyncio.subprocess.PIPE,
+            )
+            await asyncio.sleep(0.3)
+            flooded = await forward_latencies()
+            sent = int((await generator.communicate())[0])
+            juicebox.close()
+        finally:
+            if generator is not None and generator.returncode is None:
+                generator.kill()
+                await generator.wait()
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+
+        reasons = {
+            reason: dropped.labels(reason).value
+            for reason in ("size", "prefix", "rate", "source")
+        }
+        report = (
+            f"flood of {sent} datagrams, dropped {reasons}: forwarding p50 "
+            f"{statistics.median(baseline) * 1000:.2f} ms -> {statistics.median(flooded) * 1000:.2f} ms, "
+            f"max {max(baseline) * 1000:.2f} ms -> {max(flooded) * 1000:.2f} ms"
+        )
+        self.assertGreater(sent, FLOOD_RATE, report)
+        self.assertEqual(juicebox_addr, mitm._juicebox_addr)
+        # Only the probes and the bucket of other sources reached the decoder
+        self.assertLess(decodes.count - decoded_before, 10 + 20 + 10, report)
+        self.assertLess(statistics.median(flooded), statistics.median(baseline) + 0.005, report)
+        self.assertLess(max(flooded), 0.05, report)
+
+
+if __name__ == '__main__':
+    unittest.main()
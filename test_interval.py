@@ -0,0 +1,85 @@
+import datetime
+import tempfile
+import unittest
+
+from juicebox_interval import JuiceboxIntervalProfile
+from juicebox_message import juicebox_message_from_string
+from test_history import V09U_SAMPLE
+from test_message import FAKE_SERIAL
+
+
+class FakeEntity:
+
+    def __init__(self):
+        self.state = None
+        self.attributes = None
+
+    async def set_state(self, state):
+        self.state = state
+
+    async def set_attributes(self, attr={}):
+        self.attributes = attr
+
+
+class FakeMQTTHandler:
+
+    def __init__(self):
+        self.entity = FakeEntity()
+
+    def get_entity(self, name):
+        return self.entity
+
+
+class TestIntervalProfile(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.midnight = datetime.datetime(2024, 6, 1).timestamp()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_rollover(self):
+        profile = JuiceboxIntervalProfile(self.tmpdir.name)
+        # Device memory is reported at 12:00, slots after 48 are still from yesterday
+        noon = self.midnight + 12 * 60 * 60
+        for slot in range(96):
+            self.assertIsNone(profile.update("dev", slot, slot, noon))
+        today = profile.profile("dev")
+        self.assertEqual(list(range(49)), today["intervals"][:49])
+        self.assertEqual([None] * 47, today["intervals"][49:])
+        self.assertEqual("2024-06-01", today["date"])
+
+        # Rest of the day
+        for slot in range(49, 96):
+            profile.update("dev", slot, 1, self.midnight + (slot + 0.5) * 15 * 60)
+        finished = profile.update("dev", 0, 5, self.midnight + 24 * 60 * 60 + 1)
+        self.assertEqual("2024-06-01", finished["date"])
+        self.assertTrue(finished["complete"])
+        self.assertEqual(sum(range(49)) + 47, finished["total"])
+        self.assertEqual(5, profile.profile("dev")["total"])
+
+    async def test_persist_and_publish(self):
+        clock = lambda: self.midnight + 60
+        profile = JuiceboxIntervalProfile(self.tmpdir.name, clock=clock)
+        mqtt = FakeMQTTHandler()
+        await profile.set_mqtt_handler(mqtt)
+        message = juicebox_message_from_string(V09U_SAMPLE)
+        await profile.status_listener(message)
+        await profile.close()
+
+        restarted = JuiceboxIntervalProfile(self.tmpdir.name, clock=clock)
+        # i23 is after slot 0, so it is from yesterday
+        yesterday = datetime.date(2024, 5, 31).toordinal()
+        self.assertEqual(-1, restarted.profile(FAKE_SERIAL, yesterday)["intervals"][23])
+
+        # Next day publishes the finished profile
+        await restarted.set_mqtt_handler(mqtt)
+        restarted._clock = lambda: self.midnight + 24 * 60 * 60 + 60
+        await restarted.status_listener(message)
+        self.assertEqual("2024-06-01", mqtt.entity.attributes["date"])
+        self.assertEqual(0, mqtt.entity.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
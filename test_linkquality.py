@@ -0,0 +1,204 @@
+import asyncio
+import json
+import time
+import unittest
+
+import asyncio_dgram
+
+import test_message
+from const import MAX_RETRY_ATTEMPT
+from juicebox_linkquality import JuiceboxLinkQuality
+from juicebox_message import juicebox_message_from_bytes
+from juicebox_metrics import METRICS
+from juicebox_mitm import ENELX_ANSWER, ENELX_SENT, JuiceboxMITM
+from test_errorbudget import FakeClock
+from test_interval import FakeEntity
+from test_message import FAKE_SERIAL
+from test_startup import FAKE_ENELX_IP, passthrough
+from test_state import FakeSetpointsMQTTHandler
+
+V07_SAMPLE = test_message.TestMessage.V07_SAMPLE.encode()
+
+
+class FakeLinkMQTTHandler:
+
+    def __init__(self):
+        self.entities = {
+            name: FakeEntity()
+            for name in ("link_loss", "link_jitter", "enelx_response", "enelx_rtt")
+        }
+
+    def get_entity(self, name):
+        return self.entities[name]
+
+
+class TestLinkQuality(unittest.IsolatedAsyncioTestCase):
+
+    def test_loss_and_reordering(self):
+        link_quality = JuiceboxLinkQuality(samples=4)
+        link = link_quality.process("loss", 1, 10, 0)
+        link_quality.process("loss", 2, 10, 10)
+        self.assertEqual(0, link.lost)
+        self.assertEqual(0.0, link.loss)
+        # 3 and 4 lost
+        link_quality.process("loss", 5, 10, 50)
+        self.assertEqual(2, link.lost)
+        # 2 samples of 1 and one of 0
+        self.assertAlmostEqual((1 - 0.75 ** 2) * 0.75, link.loss)
+        # 4 arrives late
+        link_quality.process("loss", 4, 10, 51)
+        self.assertEqual(1, link.lost)
+        self.assertEqual(1, link.reordered)
+        self.assertEqual(5, link.counter)
+        self.assertEqual(2, METRICS.get("juicepassproxy_link_lost_total").labels("loss").value)
+        self.assertEqual(1, METRICS.get("juicepassproxy_link_reordered_total").labels("loss").value)
+        # Too far ahead, the device rebooted while nothing was received
+        link_quality.process("loss", 1000, 10, 60)
+        self.assertEqual(1, link.resets)
+        self.assertEqual(1, link.lost)
+        self.assertEqual(1000, link.counter)
+        # Device rebooted
+        link_quality.process("loss", 1, 10, 70)
+        self.assertEqual(2, link.resets)
+        self.assertEqual(1, link.counter)
+        self.assertEqual(6, link.received)
+        # Each device has its link
+        self.assertEqual(0, link_quality.process("other", 100, 10, 60).lost)
+
+    def test_jitter(self):
+        link_quality = JuiceboxLinkQuality()
+        link = link_quality.process("jitter", 1, 10, 0)
+        for counter in range(2, 10):
+            link_quality.process("jitter", counter, 10, (counter - 1) * 10)
+        self.assertEqual(0.0, link.jitter)
+        # 2 seconds late, then on time again
+        link_quality.process("jitter", 10, 10, 92)
+        self.assertAlmostEqual(2 / 16, link.jitter)
+        # On time again after a lost datagram, 2 seconds early after the late one
+        link_quality.process("jitter", 12, 10, 110)
+        self.assertAlmostEqual(2 / 16 + (2 - 2 / 16) / 16, link.jitter)
+        self.assertAlmostEqual(
+            link.jitter,
+            METRICS.get("juicepassproxy_link_jitter_seconds").labels("jitter").get(),
+        )
+
+    def test_enelx(self):
+        clock = FakeClock()
+        link_quality = JuiceboxLinkQuality(samples=2, clock=clock)
+        self.assertEqual({"response": None, "rtt": None}, link_quality.enelx())
+        link_quality.enelx_listener(ENELX_SENT)
+        clock.now += 0.2
+        link_quality.enelx_listener(ENELX_ANSWER)
+        self.assertEqual({"response": 1.0, "rtt": 0.2}, link_quality.enelx())
+        # Not answered
+        link_quality.enelx_listener(ENELX_SENT)
+        clock.now += 10
+        link_quality.enelx_listener(ENELX_SENT)
+        clock.now += 0.6
+        link_quality.enelx_listener(ENELX_ANSWER)
+        # Late answer without a datagram sent
+        link_quality.enelx_listener(ENELX_ANSWER)
+        self.assertEqual({"response": 0.75, "rtt": 0.25}, link_quality.enelx())
+
+    async def test_status_listener(self):
+        clock = FakeClock()
+        link_quality = JuiceboxLinkQuality(report_interval=60, clock=clock)
+        mqtt = FakeLinkMQTTHandler()
+        await link_quality.set_mqtt_handler(mqtt)
+        message = juicebox_message_from_bytes(V07_SAMPLE)
+        await link_quality.status_listener(message)
+        self.assertEqual(0.0, mqtt.entities["link_loss"].state)
+        self.assertEqual(0, mqtt.entities["link_jitter"].state)
+        # Nothing from EnelX yet
+        self.assertIsNone(mqtt.entities["enelx_response"].state)
+
+        link_quality.enelx_listener(ENELX_SENT)
+        clock.now += 0.1
+        link_quality.enelx_listener(ENELX_ANSWER)
+        clock.now += 59.9
+        next_message = juicebox_message_from_bytes(
+            V07_SAMPLE.replace(b",s0001,", b",s0003,").replace(b"!KKD:", b"!JKH:")
+        )
+        await link_quality.status_listener(next_message)
+        # One lost of the last 32, t09: 2 datagrams in 60 s is 42 s of jitter
+        self.assertEqual(3.0, mqtt.entities["link_loss"].state)
+        self.assertEqual(2625, mqtt.entities["link_jitter"].state)
+        self.assertEqual(100.0, mqtt.entities["enelx_response"].state)
+        self.assertEqual(100, mqtt.entities["enelx_rtt"].state)
+
+        _, body = await link_quality.http_route({})
+        link = json.loads(body)["devices"][FAKE_SERIAL]
+        self.assertEqual({"received": 2, "lost": 1, "reordered": 0, "resets": 0}, {
+            k: link[k] for k in ("received", "lost", "reordered", "resets")
+        })
+
+    async def test_mitm_enelx_listener(self):
+        events = []
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(
+            ("127.0.0.1", 0),
+            enelx.sockname,
+            local_mitm_handler=passthrough,
+            remote_mitm_handler=passthrough,
+            mqtt_handler=FakeSetpointsMQTTHandler(32, 16),
+        )
+        await mitm.add_enelx_listener(events.append)
+        task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            await juicebox.send(V07_SAMPLE)
+            async with asyncio.timeout(1):
+                _, proxy_addr = await enelx.recv()
+                await enelx.send(b"CMD41325A0040M040C006S638!5N5$", proxy_addr)
+                await juicebox.recv()
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+        self.assertEqual([ENELX_SENT, ENELX_ANSWER], events)
+
+    async def test_mitm_breaker_open(self):
+        events = []
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(
+            ("127.0.0.1", 0),
+            enelx.sockname,
+            local_mitm_handler=passthrough,
+            mqtt_handler=FakeSetpointsMQTTHandler(32, 16),
+        )
+        await mitm.add_enelx_listener(events.append)
+        for _ in range(MAX_RETRY_ATTEMPT):
+            mitm._enelx_breaker.record_failure()
+        task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            await juicebox.send(V07_SAMPLE)
+            while mitm._last_status_message is None:
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.01)
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+        # Dropped by the breaker, not sent
+        self.assertEqual([], events)
+        self.assertEqual(0, mitm._enelx_unanswered)
+
+    def test_cost(self):
+        link_quality = JuiceboxLinkQuality()
+        count = 20000
+        start = time.perf_counter()
+        for counter in range(count):
+            link_quality.process("cost", counter % 10000 + counter % 3, 10, counter * 10.0)
+        per_datagram = (time.perf_counter() - start) / count
+        self.assertLess(per_datagram, 0.0001, f"{per_datagram * 1e9:.0f} ns per datagram")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import asyncio
+import gzip
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from const import LOG_RATE_LIMIT_BURST
+from juicebox_logging import JuiceboxRateLimitFilter, rotating_file_handler, setup_logging
+from juicebox_mitm import JuiceboxMITM
+import test_message
+from test_errorbudget import FakeClock
+from test_startup import FAKE_ENELX_IP
+from test_state import FakeSetpointsMQTTHandler
+
+_LOGGER = logging.getLogger("juicebox_mitm")
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+        self.threads.add(threading.get_ident())
+
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        root = logging.getLogger()
+        self._root = (root.handlers[:], root.level)
+
+    def tearDown(self):
+        root = logging.getLogger()
+        root.handlers[:], level = self._root
+        root.setLevel(level)
+        self.tempdir.cleanup()
+
+    def test_rate_limit(self):
+        clock = FakeClock()
+        handler = RecordingHandler()
+        listener = setup_logging([handler], logging.INFO, JuiceboxRateLimitFilter(burst=3, interval=60, clock=clock))
+
+        def encrypted(i):
+            _LOGGER.error("Encrypted messages are not supported yet %s", i)
+
+        for i in range(10):
+            encrypted(i)
+        _LOGGER.info("other call site")
+        clock.now += 60
+        encrypted(10)
+        listener.stop()
+        self.assertEqual(
+            [
+                "Encrypted messages are not supported yet 0",
+                "Encrypted messages are not supported yet 1",
+                "Encrypted messages are not supported yet 2",
+                "other call site",
+                "Encrypted messages are not supported yet 10 (suppressed 7 similar)",
+            ],
+            handler.messages,
+        )
+        # Written from the listener thread
+        self.assertNotIn(threading.get_ident(), handler.threads)
+
+    def test_rate_limit_flush(self):
+        handler = RecordingHandler()
+        listener = setup_logging([handler], logging.INFO, JuiceboxRateLimitFilter(burst=2, interval=0.05))
+        try:
+
+            def burst(name, count):
+                for i in range(count):
+                    _LOGGER.warning("Burst %s %s", name, i)
+
+            # The call site goes silent after the burst, the count is written anyway
+            burst("timer", 6)
+            for _ in range(200):
+                if len(handler.messages) == 3:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(
+                ["Burst timer 0", "Burst timer 1", "Burst timer 5 (suppressed 3 similar)"],
+                handler.messages,
+            )
+        finally:
+            handler.messages.clear()
+            burst("stop", 3)
+            listener.stop()
+        self.assertEqual(["Burst stop 0", "Burst stop 1", "Burst stop 2"], handler.messages)
+
+    def test_compressed_rotation(self):
+        log_file = os.path.join(self.tempdir.name, "juicepassproxy.log")
+        handler = rotating_file_handler(log_file, backup_count=2)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        for day in range(4):
+            handler.emit(logging.makeLogRecord({"msg": f"day {day}"}))
+            handler.rolloverAt = 0
+            handler.rotation_filename = lambda name, day=day: f"{log_file}.2024-06-0{day + 1}.gz"
+            handler.doRollover()
+        handler.close()
+        rotated = sorted(f for f in os.listdir(self.tempdir.name) if f.endswith(".gz"))
+        self.assertEqual(["juicepassproxy.log.2024-06-03.gz", "juicepassproxy.log.2024-06-04.gz"], rotated)
+        with gzip.open(os.path.join(self.tempdir.name, rotated[-1]), "rt") as file:
+            self.assertEqual("day 3\n", file.read())
+
+    def test_benchmark_per_message(self):
+        """Loop time spent per status message and command with INFO enabled"""
+        log_file = os.path.join(self.tempdir.name, "juicepassproxy.log")
+        data = test_message.TestMessage.V07_SAMPLE.encode()
+
+        async def per_message(count=2000):
+            mitm = JuiceboxMITM(
+                ("127.0.0.1", 0), (FAKE_ENELX_IP, 8047), mqtt_handler=FakeSetpointsMQTTHandler(32, 16)
+            )
+            start = time.perf_counter()
+            for _ in range(count):
+                await mitm._message_decode(data)
+                # Logs "command message = ..." at INFO for each status message
+                await mitm._JuiceboxMITM__build_cmd_message(False)
+                _LOGGER.error("Encrypted messages are not supported yet")
+            return (time.perf_counter() - start) / count
+
+        sync_handler = logging.FileHandler(log_file)
+        logging.basicConfig(level=logging.INFO, handlers=[sync_handler], force=True)
+        sync = min(asyncio.run(per_message()) for _ in range(3))
+        sync_handler.close()
+        with open(log_file) as file:
+            commands = [line for line in file if "command message = " in line]
+        self.assertEqual(3 * 2000, len(commands))
+        os.remove(log_file)
+
+        listener = setup_logging([rotating_file_handler(log_file)], logging.INFO)
+        queued = min(asyncio.run(per_message()) for _ in range(3))
+        listener.stop()
+        self.assertLessEqual(
+            queued,
+            sync,
+            f"per message with INFO: file on loop {sync * 1e6:.1f} us, queue + rate limit {queued * 1e6:.1f} us",
+        )
+        with open(log_file) as file:
+            lines = file.read().splitlines()
+        # Rate limited, then the suppressed count
+        errors = [line for line in lines if "ERROR" in line]
+        self.assertEqual(LOG_RATE_LIMIT_BURST + 1, len(errors))
+        self.assertIn(f"(suppressed {3 * 2000 - LOG_RATE_LIMIT_BURST - 1} similar)", errors[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import time
+import unittest
+
+from juicebox_loopmonitor import JuiceboxLoopMonitor
+from juicebox_metrics import METRICS
+
+
+def write_config_blocking():
+    # Like a synchronous yaml.dump or DNS lookup on the loop
+    time.sleep(0.3)
+
+
+class TestLoopMonitor(unittest.IsolatedAsyncioTestCase):
+
+    async def test_names_blocking_code(self):
+        monitor = JuiceboxLoopMonitor(0.05, interval=0.01, report_interval=3600)
+        lags = METRICS.get("juicepassproxy_loop_lag_seconds").labels()
+        lag_count = lags.count
+        blocked_total = METRICS.get("juicepassproxy_loop_blocked_total").labels().value
+        task = asyncio.create_task(monitor.start())
+        try:
+            await asyncio.sleep(0.1)
+            self.assertEqual([], monitor.events())
+            self.assertGreater(lags.count, lag_count)
+
+            async def config_writer():
+                write_config_blocking()
+
+            await asyncio.create_task(config_writer(), name="config_writer")
+            async with asyncio.timeout(1):
+                while not monitor.events():
+                    await asyncio.sleep(0.01)
+            event = monitor.events()[0]
+            self.assertEqual("config_writer", event["task"])
+            self.assertTrue(event["where"].startswith("test_loopmonitor.py:"), event["where"])
+            self.assertTrue(event["where"].endswith("write_config_blocking"), event["where"])
+            self.assertGreaterEqual(event["duration_ms"], 250)
+            self.assertEqual(blocked_total + 1, METRICS.get("juicepassproxy_loop_blocked_total").labels().value)
+
+            self.assertIn("test_loopmonitor.py:", monitor.report())
+            self.assertIsNone(monitor.report())
+            _, body = await monitor.http_route({})
+            self.assertEqual(1, len(json.loads(body)["events"]))
+        finally:
+            task.cancel()
+            await monitor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import time
+import unittest
+
+from juicebox_metrics import JuiceboxMetricsRegistry, JuiceboxMetricsServer
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    def test_histogram_render(self):
+        registry = JuiceboxMetricsRegistry()
+        histogram = registry.histogram("test_seconds", "Test", ("stage",), buckets=(0.1, 1))
+        child = histogram.labels("decode")
+        child.observe(0.05)
+        child.observe(0.5)
+        child.observe(5)
+        text = registry.render()
+        self.assertIn('test_seconds_bucket{stage="decode",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="decode",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="decode",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{stage="decode"} 3', text)
+        self.assertIn("# TYPE test_seconds histogram", text)
+
+    def test_counter_and_gauge(self):
+        registry = JuiceboxMetricsRegistry()
+        counter = registry.counter("test_total", "Test", ("type",))
+        counter.labels("status").inc()
+        counter.labels("status").inc(2)
+        errors = 7
+        registry.gauge("test_errors", "Test").set_function(lambda: errors)
+        text = registry.render()
+        self.assertIn('test_total{type="status"} 3', text)
+        self.assertIn("test_errors 7", text)
+        # Same definition returns the same family, other definition fails
+        self.assertIs(counter, registry.counter("test_total", "Test", ("type",)))
+        with self.assertRaises(ValueError):
+            registry.gauge("test_total", "Test")
+
+    def test_observe_is_cheap(self):
+        registry = JuiceboxMetricsRegistry()
+        child = registry.histogram("bench_seconds", "Bench").labels()
+        count = 100000
+        start = time.perf_counter()
+        for _ in range(count):
+            child.observe(0.003)
+        per_call = (time.perf_counter() - start) / count
+        self.assertEqual(count, child.count)
+        self.assertLess(per_call, 20e-6, f"{per_call * 1e9:.0f} ns/call")
+
+    async def test_server(self):
+        registry = JuiceboxMetricsRegistry()
+        registry.counter("served_total", "Test").inc()
+        server = JuiceboxMetricsServer("127.0.0.1", 0, registry=registry)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+            response = (await reader.read()).decode()
+            writer.close()
+            self.assertTrue(response.startswith("HTTP/1.0 200 OK"))
+            self.assertIn("served_total 1", response)
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET /missing HTTP/1.0\r\n\r\n")
+            response = (await reader.read()).decode()
+            writer.close()
+            self.assertTrue(response.startswith("HTTP/1.0 404"))
+
+            async def route(query):
+                if query["value"] == "error":
+                    raise RuntimeError("broken route")
+                return "text/plain", str(int(query["value"]))
+
+            server.add_route("/route", route)
+            for value, status in (("4", "200 OK"), ("x", "400 Bad Request"), ("error", "500")):
+                reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+                writer.write(f"GET /route?value={value} HTTP/1.0\r\n\r\n".encode())
+                response = (await reader.read()).decode()
+                writer.close()
+                self.assertTrue(response.startswith(f"HTTP/1.0 {status}"), response)
+        finally:
+            await server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
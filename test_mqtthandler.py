@@ -0,0 +1,279 @@
+import asyncio
+import json
+import struct
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+from ha_mqtt_discoverable import Settings
+
+from const import VERSION
+from juicebox_config import JuiceboxConfig
+from juicebox_mqtthandler import JuiceboxMQTTHandler
+from test_message import FAKE_SERIAL
+
+
+def _string(data, pos):
+    size = struct.unpack_from("!H", data, pos)[0]
+    return data[pos + 2:pos + 2 + size], pos + 2 + size
+
+
+def _packet(first_byte, body):
+    length = bytearray()
+    size = len(body)
+    while True:
+        byte, size = size % 128, size // 128
+        length.append(byte | (0x80 if size else 0))
+        if not size:
+            break
+    return bytes([first_byte]) + bytes(length) + body
+
+
+def _publish_packet(topic, payload, retain=False):
+    topic = topic.encode()
+    return _packet(0x30 | retain, struct.pack("!H", len(topic)) + topic + payload)
+
+
+class FakeMQTTBroker:
+    """MQTT 3.1.1 broker with QoS 0 delivery, retained messages and Last Will, exact topics only"""
+
+    def __init__(self):
+        self.retained = {}
+        self.published = []
+        self.connects = 0
+        self._clients = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        for writer in list(self._clients):
+            writer.close()
+        while self._clients:
+            await asyncio.sleep(0.001)
+
+    def publish(self, topic, payload, retain=False):
+        self.published.append((time.perf_counter(), topic, payload))
+        if retain:
+            self.retained[topic] = payload
+        for writer, client in list(self._clients.items()):
+            if topic in client["topics"]:
+                writer.write(_publish_packet(topic, payload))
+
+    def subscribed(self, topic):
+        return any(topic in client["topics"] for client in self._clients.values())
+
+    def kick(self, topic):
+        """Drops the connection of the client with a Last Will on topic"""
+        for writer, client in list(self._clients.items()):
+            if client["will"] is not None and client["will"][0] == topic:
+                writer.close()
+
+    async def _read_packet(self, reader):
+        first_byte = (await reader.readexactly(1))[0]
+        size, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            size += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first_byte, await reader.readexactly(size)
+
+    async def _handle(self, reader, writer):
+        client = {"topics": set(), "will": None}
+        self._clients[writer] = client
+        try:
+            while True:
+                first_byte, body = await self._read_packet(reader)
+                packet_type = first_byte >> 4
+                if packet_type == 1:  # CONNECT
+                    self.connects += 1
+                    _, pos = _string(body, 0)
+                    flags = body[pos + 1]
+                    _, pos = _string(body, pos + 4)
+                    if flags & 0x04:
+                        will_topic, pos = _string(body, pos)
+                        will_payload, pos = _string(body, pos)
+                        client["will"] = (will_topic.decode(), will_payload, bool(flags & 0x20))
+                    writer.write(_packet(0x20, b"\x00\x00"))
+                elif packet_type == 3:  # PUBLISH
+                    topic, pos = _string(body, 0)
+                    if (first_byte >> 1) & 0x03:
+                        packet_id = body[pos:pos + 2]
+                        pos += 2
+                        writer.write(_packet(0x40, packet_id))
+                    self.publish(topic.decode(), body[pos:], retain=bool(first_byte & 0x01))
+                elif packet_type == 8:  # SUBSCRIBE
+                    packet_id, pos = body[:2], 2
+                    granted = bytearray()
+                    while pos < len(body):
+                        topic, pos = _string(body, pos)
+                        granted.append(0)
+                        pos += 1
+                        client["topics"].add(topic.decode())
+                        if (payload := self.retained.get(topic.decode(), None)) is not None:
+                            writer.write(_publish_packet(topic.decode(), payload, retain=True))
+                    writer.write(_packet(0x90, packet_id + bytes(granted)))
+                elif packet_type == 12:  # PINGREQ
+                    writer.write(_packet(0xD0, b""))
+                elif packet_type == 14:  # DISCONNECT
+                    client["will"] = None
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._clients[writer]
+            writer.close()
+            if client["will"] is not None:
+                self.publish(*client["will"])
+
+
+class TestMQTTHandler(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.broker = FakeMQTTBroker()
+        await self.broker.start()
+        self.mqtt_handler = JuiceboxMQTTHandler(
+            device_name="JuiceBox",
+            mqtt_settings=Settings.MQTT(host="127.0.0.1", port=self.broker.port),
+            experimental=False,
+            config=JuiceboxConfig(self.tempdir.name),
+            juicebox_id=FAKE_SERIAL,
+        )
+        self.availability_topic = "hmd/JuiceBox/availability"
+
+    async def asyncTearDown(self):
+        await self.mqtt_handler.close()
+        await self.broker.close()
+        self.tempdir.cleanup()
+
+    async def _wait_for(self, predicate, timeout=5):
+        async with asyncio.timeout(timeout):
+            while not predicate():
+                await asyncio.sleep(0.001)
+
+    async def test_birth_message_republish(self):
+        await self.mqtt_handler.start()
+        await self.mqtt_handler._basic_message_publish(
+            {"type": "basic", "status": "Charging", "current": 16, "voltage": 240}
+        )
+        status_topic = "hmd/sensor/JuiceBox/Status/state"
+        status_config = "homeassistant/sensor/JuiceBox/Status/config"
+        await self._wait_for(lambda: status_topic in self.broker.retained)
+        await self._wait_for(lambda: self.broker.subscribed("homeassistant/status"))
+        self.assertEqual(b"online", self.broker.retained[self.availability_topic])
+        self.assertIn(b'"availability_topic": "hmd/JuiceBox/availability"', self.broker.retained[status_config])
+
+        # Home Assistant restarted
+        wrote_config = [
+            e.config_topic for e in self.mqtt_handler._entities.values() if e.wrote_configuration
+        ]
+        self.broker.published.clear()
+        start = time.perf_counter()
+        self.broker.publish("homeassistant/status", b"online")
+
+        def republished():
+            topics = {topic for _, topic, _ in self.broker.published}
+            return status_topic in topics and all(topic in topics for topic in wrote_config)
+
+        await self._wait_for(republished)
+        await asyncio.sleep(0.1)
+        burst = max(when for when, _, _ in self.broker.published) - start
+        self.assertLess(burst, 1, f"{len(wrote_config)} entities republished in {burst * 1000:.1f} ms")
+        self.assertIn((status_topic, b"Charging"), [(t, p) for _, t, p in self.broker.published])
+        # The current setpoint without state was never on Home Assistant and is still not
+        self.assertNotIn("homeassistant/number/JuiceBox/Max-Current-Offline-Wanted-/config", wrote_config)
+
+        # HA going offline does nothing
+        self.broker.published.clear()
+        self.broker.publish("homeassistant/status", b"offline")
+        await asyncio.sleep(0.1)
+        self.assertEqual(1, len(self.broker.published))
+
+    async def test_last_will(self):
+        await self.mqtt_handler.start()
+        await self._wait_for(lambda: self.broker.retained.get(self.availability_topic) == b"online")
+
+        # Connection lost, the broker publishes the Last Will and the reconnection is online again
+        self.broker.kick(self.availability_topic)
+        await self._wait_for(lambda: self.broker.retained.get(self.availability_topic) == b"offline")
+        await self._wait_for(lambda: self.broker.retained.get(self.availability_topic) == b"online")
+
+        await self.mqtt_handler.close()
+        await self._wait_for(lambda: self.broker.retained.get(self.availability_topic) == b"offline")
+
+    async def test_lean_entities(self):
+        tracemalloc.start()
+        start = time.perf_counter()
+        mqtt_handler = JuiceboxMQTTHandler(
+            device_name="JuiceBox2",
+            mqtt_settings=Settings.MQTT(host="127.0.0.1", port=self.broker.port),
+            experimental=True,
+            config=JuiceboxConfig(self.tempdir.name),
+            juicebox_id=FAKE_SERIAL,
+        )
+        await mqtt_handler.start()
+        elapsed = time.perf_counter() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        try:
+            # Was ~1150 KiB and ~190 ms with an ha_mqtt_discoverable object per entity
+            self.assertLess(
+                memory,
+                400 * 1024,
+                f"{len(mqtt_handler._entities)} entities: started in {elapsed * 1000:.1f} ms, {memory / 1024:.0f} KiB",
+            )
+
+            # Same discovery payload as ha_mqtt_discoverable
+            switch_topic = "homeassistant/switch/JuiceBox2/Act-as-Server/config"
+            await self._wait_for(lambda: switch_topic in self.broker.retained)
+            self.assertEqual(
+                {
+                    "component": "switch",
+                    "device": {
+                        "name": "JuiceBox2",
+                        "model": "JuiceBox",
+                        "manufacturer": "EnelX",
+                        "sw_version": VERSION,
+                        "identifiers": [FAKE_SERIAL],
+                        "connections": [["JuiceBox ID", FAKE_SERIAL]],
+                    },
+                    "enabled_by_default": False,
+                    "name": "Act as Server",
+                    "unique_id": f"{FAKE_SERIAL} Act as Server",
+                    "payload_off": "OFF",
+                    "payload_on": "ON",
+                    "state_topic": "hmd/switch/JuiceBox2/Act-as-Server/state",
+                    "json_attributes_topic": "hmd/switch/JuiceBox2/Act-as-Server/attributes",
+                    "availability_topic": "hmd/JuiceBox2/availability",
+                    "command_topic": "hmd/switch/JuiceBox2/Act-as-Server/command",
+                },
+                json.loads(self.broker.retained[switch_topic]),
+            )
+            number = mqtt_handler.get_entity("current_max_online_set")
+            await number.set(32)
+            await self._wait_for(lambda: number.config_topic in self.broker.retained)
+            self.assertEqual(48.0, json.loads(self.broker.retained[number.config_topic])["max"])
+            self.assertEqual(b"32.0", self.broker.retained[number.state_topic])
+
+            # Commands of every entity arrive on the shared connection
+            command_topic = "hmd/switch/JuiceBox2/Act-as-Server/command"
+            await self._wait_for(lambda: self.broker.subscribed(command_topic))
+            # Was a broker connection per entity
+            self.assertEqual(1, len(self.broker._clients))
+            self.broker.publish(command_topic, b"OFF")
+            switch = mqtt_handler.get_entity("act_as_server")
+            await self._wait_for(lambda: switch.state == "OFF")
+            self.assertFalse(switch.is_on())
+        finally:
+            await mqtt_handler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import os
+import pstats
+import signal
+import tempfile
+import time
+import unittest
+
+import asyncio_dgram
+from ha_mqtt_discoverable import Settings
+from paho.mqtt.client import MQTTMessage
+
+from juicebox_config import JuiceboxConfig
+from juicebox_mitm import JuiceboxMITM
+from juicebox_mqtthandler import JuiceboxMQTTHandler
+from juicebox_profiler import JuiceboxProfiler
+from test_message import FAKE_SERIAL
+from test_startup import DEBUG_MESSAGE, FAKE_ENELX_IP, passthrough
+
+
+def busy_checksum(count):
+    total = 0
+    for i in range(count):
+        total += i * i
+    return total
+
+
+class TestProfiler(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    async def test_profile_while_forwarding(self):
+        profiler = JuiceboxProfiler(self.tempdir.name, duration=1, interval=0.001)
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(("127.0.0.1", 0), enelx.sockname, local_mitm_handler=passthrough)
+        mitm_task = asyncio.create_task(mitm.start())
+
+        async def busy():
+            while True:
+                busy_checksum(100000)
+                await asyncio.sleep(0)
+
+        busy_task = asyncio.create_task(busy())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            profile_task = asyncio.create_task(profiler.profile())
+            await asyncio.sleep(0.05)
+            self.assertTrue(profiler.running)
+            self.assertIsNone(await profiler.profile())
+
+            # Forwarding goes on while profiling
+            for _ in range(5):
+                start = time.perf_counter()
+                await juicebox.send(DEBUG_MESSAGE)
+                async with asyncio.timeout(1):
+                    self.assertEqual(DEBUG_MESSAGE, (await enelx.recv())[0])
+                self.assertLess(time.perf_counter() - start, 0.5)
+            self.assertTrue(profiler.running)
+
+            files = await profile_task
+        finally:
+            juicebox.close()
+            busy_task.cancel()
+            mitm_task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+
+        self.assertGreater(files["samples"], 0)
+        with open(files["collapsed"]) as file:
+            collapsed = file.read()
+        self.assertIn("MainThread;", collapsed)
+        self.assertIn("test_profiler.py:busy_checksum", collapsed)
+        stats = pstats.Stats(files["pstats"])
+        self.assertIn("busy_checksum", [func[2] for func in stats.stats])
+
+    async def test_http_route(self):
+        profiler = JuiceboxProfiler(self.tempdir.name, max_duration=0.05)
+        for seconds in ("abc", "0", "-1", "nan"):
+            with self.assertRaises(ValueError):
+                await profiler.http_route({"seconds": seconds})
+        self.assertFalse(profiler.running)
+        # Limited to max_duration
+        async with asyncio.timeout(5):
+            files = json.loads((await profiler.http_route({"seconds": "1e9"}))[1])
+        self.assertTrue(os.path.exists(files["pstats"]))
+
+    async def test_signal_and_button(self):
+        profiler = JuiceboxProfiler(self.tempdir.name, duration=0.05)
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, profiler.start_profile)
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            async with asyncio.timeout(1):
+                while profiler._task is None:
+                    await asyncio.sleep(0.001)
+                await profiler._task
+            self.assertIsNone(profiler._task)
+        finally:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+
+        mqtt_handler = JuiceboxMQTTHandler(
+            device_name="JuiceBox",
+            mqtt_settings=Settings.MQTT(host="127.0.0.1"),
+            experimental=False,
+            config=JuiceboxConfig(self.tempdir.name),
+            juicebox_id=FAKE_SERIAL,
+        )
+        await mqtt_handler.set_profile_handler(profiler.profile)
+        message = MQTTMessage(topic=b"hmd/button/JuiceBox/Profile-JuicePass-Proxy/command")
+        message.payload = b"PRESS"
+        await mqtt_handler.get_entity("profile")._callback_async(None, None, message)
+        # One from the signal, one from the button
+        profiles = [f for f in os.listdir(self.tempdir.name) if f.endswith(".pstats")]
+        self.assertEqual(2, len(profiles))
+
+
+if __name__ == '__main__':
+    unittest.main()
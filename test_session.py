@@ -0,0 +1,128 @@
+import time
+import unittest
+
+import test_message
+from juicebox_crc import JuiceboxCRC
+from juicebox_message import juicebox_message_from_string
+from juicebox_session import (
+    SESSION_CHARGE_START,
+    SESSION_CHARGE_STOP,
+    SESSION_PLUG_IN,
+    SESSION_UNPLUG,
+    JuiceboxSessionTracker,
+)
+from test_interval import FakeMQTTHandler
+
+
+class FakeStatusMessage:
+
+    def __init__(self, status, current=0, voltage=240.0, energy_session=0, energy_lifetime=None, serial="dev"):
+        self.values = {
+            "serial": serial,
+            "status": status,
+            "current": current,
+            "voltage": voltage,
+            "energy_session": energy_session,
+            "energy_lifetime": energy_lifetime,
+        }
+
+    def get_value(self, type):
+        return self.values.get(type, None)
+
+    def get_processed_value(self, type):
+        return self.values.get(type, None)
+
+    def has_value(self, type):
+        return self.values.get(type, None) is not None
+
+
+class TestSessionTracker(unittest.IsolatedAsyncioTestCase):
+
+    def test_session(self):
+        tracker = JuiceboxSessionTracker()
+        ts = 1700000000
+        self.assertEqual(([], None), tracker.process(FakeStatusMessage("Unplugged", energy_lifetime=1000), ts))
+        events, _ = tracker.process(FakeStatusMessage("Plugged In", energy_lifetime=1000), ts + 9)
+        self.assertEqual([SESSION_PLUG_IN], events)
+        lifetime = 1000
+        for i in range(100):
+            lifetime += 50
+            events, _ = tracker.process(
+                FakeStatusMessage("Charging", current=30 + i % 3, voltage=240.0 + i % 2, energy_session=(i + 1) * 50, energy_lifetime=lifetime),
+                ts + 18 + i * 9,
+            )
+            self.assertEqual([SESSION_CHARGE_START] if i == 0 else [], events)
+        events, _ = tracker.process(FakeStatusMessage("Plugged In", energy_session=5000, energy_lifetime=lifetime), ts + 1000)
+        self.assertEqual([SESSION_CHARGE_STOP], events)
+        events, record = tracker.process(FakeStatusMessage("Unplugged", energy_lifetime=lifetime), ts + 1009)
+        self.assertEqual([SESSION_UNPLUG], events)
+        self.assertEqual(5.0, record["energy"])
+        self.assertEqual(5.0, record["energy_session_counter"])
+        self.assertEqual(32, record["peak_current"])
+        self.assertEqual(240.5, record["average_voltage"])
+        self.assertEqual(1000, record["duration"])
+
+    def test_lost_datagrams_and_counter_reset(self):
+        tracker = JuiceboxSessionTracker()
+        ts = 1700000000
+        tracker.process(FakeStatusMessage("Unplugged", energy_lifetime=1000), ts)
+        # Plug in message lost
+        events, _ = tracker.process(FakeStatusMessage("Charging", current=16, energy_session=100, energy_lifetime=1100), ts + 9)
+        self.assertEqual([SESSION_PLUG_IN, SESSION_CHARGE_START], events)
+        # Several messages lost
+        tracker.process(FakeStatusMessage("Charging", current=16, energy_session=1100, energy_lifetime=2100), ts + 90)
+        # Session counter reset by the device
+        tracker.process(FakeStatusMessage("Charging", current=16, energy_session=50, energy_lifetime=2200), ts + 99)
+        # Charging -> Unplugged closes the charge and the session
+        events, record = tracker.process(FakeStatusMessage("Unplugged", energy_lifetime=2200), ts + 108)
+        self.assertEqual([SESSION_CHARGE_STOP, SESSION_UNPLUG], events)
+        # lifetime misses the 100 Wh before the first message, session counter misses 50 Wh on reset
+        self.assertEqual(1.15, record["energy"])
+        self.assertEqual(1.15, record["energy_session_counter"])
+
+    def test_message_without_voltage(self):
+        tracker = JuiceboxSessionTracker()
+        payload = test_message.TestMessage.V07_SAMPLE.split("!")[0].replace(",V2400", "")
+        message = juicebox_message_from_string(f"{payload}!{JuiceboxCRC(payload).base35()}:")
+        events, _ = tracker.process(message, 1700000000)
+        self.assertEqual([SESSION_PLUG_IN, SESSION_CHARGE_START], events)
+        events, record = tracker.process(FakeStatusMessage("Unplugged", serial=message.get_value("serial")), 1700000009)
+        self.assertEqual([SESSION_CHARGE_STOP, SESSION_UNPLUG], events)
+        self.assertIsNone(record["average_voltage"])
+        self.assertEqual(39.4, record["peak_current"])
+
+    async def test_publish(self):
+        tracker = JuiceboxSessionTracker()
+        mqtt = FakeMQTTHandler()
+        await tracker.set_mqtt_handler(mqtt)
+        await tracker.status_listener(FakeStatusMessage("Charging", current=16, energy_lifetime=0))
+        await tracker.status_listener(FakeStatusMessage("Charging", current=16, energy_lifetime=2500))
+        await tracker.status_listener(FakeStatusMessage("Unplugged", energy_lifetime=2500))
+        self.assertEqual(2.5, mqtt.entity.state)
+        self.assertEqual("dev", mqtt.entity.attributes["serial"])
+
+    def test_backfill_speed(self):
+        tracker = JuiceboxSessionTracker()
+        messages = [
+            FakeStatusMessage("Unplugged", energy_lifetime=0),
+            FakeStatusMessage("Plugged In", energy_lifetime=0),
+        ] + [
+            FakeStatusMessage("Charging", current=32, energy_session=i, energy_lifetime=i)
+            for i in range(96)
+        ] + [FakeStatusMessage("Unplugged", energy_lifetime=95)]
+        count = 0
+        sessions = 0
+        start = time.perf_counter()
+        for repeat in range(1000):
+            for message in messages:
+                _, record = tracker.process(message, count * 9)
+                count += 1
+                if record is not None:
+                    sessions += 1
+        elapsed = time.perf_counter() - start
+        self.assertEqual(1000, sessions)
+        self.assertGreater(count / elapsed, 20000, f"{count / elapsed:.0f} messages/s")
+
+
+if __name__ == '__main__':
+    unittest.main()
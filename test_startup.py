@@ -0,0 +1,138 @@
+import argparse
+import asyncio
+import tempfile
+import time
+import unittest
+
+import asyncio_dgram
+
+from juicebox_config import JuiceboxConfig
+from juicebox_mitm import JuiceboxMITM
+from juicebox_telnet import JuiceboxTelnetSession
+from juicepassproxy import apply_discovery, can_warm_start, discover
+from test_message import FAKE_SERIAL
+from test_telnet import FakeJuiceboxTelnetServer
+
+DEBUG_MESSAGE = b"0000000000000000000000000000:DBG,NFO:BOT:EMWERK-JB_1_1-1.4.0.28, 2021-04-27T20:39:50Z, ZentriOS-WZ-3.6.4.0:"
+# Other address on loopback so the MITM can tell the JuiceBox from EnelX
+FAKE_ENELX_IP = "127.0.0.2"
+
+
+def startup_args(telnet_port, **kwargs):
+    args = argparse.Namespace(
+        juicebox_host="127.0.0.1",
+        telnet_port=telnet_port,
+        ignore_enelx=False,
+        juicebox_id=None,
+        local_ip="127.0.0.1",
+        enelx_ip=None,
+        cold_start=False,
+    )
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+async def passthrough(data, decoded_message=None):
+    return data
+
+
+class TestStartup(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.config = JuiceboxConfig(self.tempdir.name)
+        # Slow telnet, like a JuiceBox on a weak wifi
+        self.server = FakeJuiceboxTelnetServer(rtt=0.5)
+        await self.server.start()
+        self.enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        self.enelx_addr = self.enelx.sockname
+
+    async def asyncTearDown(self):
+        await JuiceboxTelnetSession.get("127.0.0.1", self.server.port).close()
+        await self.server.close()
+        self.enelx.close()
+        self.tempdir.cleanup()
+
+    def test_can_warm_start(self):
+        args = startup_args(self.server.port)
+        self.assertFalse(can_warm_start(args, self.config))
+        self.config.update_value("ENELX_SERVER", "juicenet-udp-prod3-usa.enelx.com")
+        self.config.update_value("ENELX_PORT", "8047")
+        self.config.update_value("ENELX_IP", "54.161.185.130")
+        self.assertFalse(can_warm_start(args, self.config))
+        self.config.update_value("JUICEBOX_ID", FAKE_SERIAL)
+        self.assertTrue(can_warm_start(args, self.config))
+        args.cold_start = True
+        self.assertFalse(can_warm_start(args, self.config))
+
+    async def test_apply_discovery(self):
+        for key, value in {
+            "ENELX_SERVER": "juicenet-udp-prod3-usa.enelx.com",
+            "ENELX_PORT": "8047",
+            "ENELX_IP": "54.161.185.130",
+            "LOCAL_IP": "127.0.0.1",
+            "JUICEBOX_ID": FAKE_SERIAL,
+        }.items():
+            self.config.update_value(key, value)
+        mitm = JuiceboxMITM(("127.0.0.1", 0), ("54.161.185.130", 8047))
+        discovery = asyncio.get_running_loop().create_future()
+        discovery.set_result({"enelx_ip": "54.161.185.131", "juicebox_id": FAKE_SERIAL})
+        await apply_discovery(discovery, startup_args(self.server.port), self.config, mitm, ("54.161.185.130", 8047))
+        self.assertEqual(("54.161.185.131", 8047), mitm._enelx_addr)
+        self.assertEqual("54.161.185.131", self.config.get("ENELX_IP", None))
+        self.assertEqual(FAKE_SERIAL, self.config.get("JUICEBOX_ID", None))
+
+    async def _first_forward(self, mitm):
+        mitm_task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            try:
+                await juicebox.send(DEBUG_MESSAGE)
+                async with asyncio.timeout(5):
+                    data, _ = await self.enelx.recv()
+            finally:
+                juicebox.close()
+        finally:
+            mitm_task.cancel()
+            mitm._dgram.close()
+        return data
+
+    async def test_startup_benchmark(self):
+        args = startup_args(self.server.port, enelx_ip=f"{FAKE_ENELX_IP}:{self.enelx_addr[1]}")
+        results = {}
+
+        # Cold start waits for telnet before binding the MITM
+        start = time.perf_counter()
+        discovered = await discover(args, self.config, telnet_timeout=10)
+        self.assertEqual(FAKE_SERIAL, discovered["juicebox_id"])
+        self.assertEqual("juicenet-udp-prod3-usa.enelx.com:8047", discovered["enelx_server_port"])
+        mitm = JuiceboxMITM(("127.0.0.1", 0), self.enelx_addr, local_mitm_handler=passthrough)
+        self.assertEqual(DEBUG_MESSAGE, await self._first_forward(mitm))
+        results["cold"] = time.perf_counter() - start
+
+        self.config.update_value("ENELX_SERVER", "juicenet-udp-prod3-usa.enelx.com")
+        self.config.update_value("ENELX_PORT", "8047")
+        self.config.update_value("JUICEBOX_ID", FAKE_SERIAL)
+        self.assertTrue(can_warm_start(args, self.config))
+        await JuiceboxTelnetSession.get("127.0.0.1", self.server.port).close()
+        JuiceboxTelnetSession.get("127.0.0.1", self.server.port).invalidate()
+
+        # Warm start forwards while discovery runs in background
+        start = time.perf_counter()
+        discovery_task = asyncio.create_task(discover(args, self.config, telnet_timeout=10))
+        mitm = JuiceboxMITM(("127.0.0.1", 0), self.enelx_addr, local_mitm_handler=passthrough)
+        self.assertEqual(DEBUG_MESSAGE, await self._first_forward(mitm))
+        results["warm"] = time.perf_counter() - start
+        self.assertFalse(discovery_task.done())
+        self.assertEqual(FAKE_SERIAL, (await discovery_task)["juicebox_id"])
+
+        report = f"first forwarded datagram: cold {results['cold'] * 1000:.0f} ms, warm {results['warm'] * 1000:.0f} ms"
+        self.assertLess(results["warm"], 1, report)
+        self.assertLess(results["warm"], results["cold"] / 10, report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import tempfile
+import unittest
+
+from ha_mqtt_discoverable import Settings
+
+from juicebox_config import JuiceboxConfig
+from juicebox_message import JuiceboxCommand, juicebox_message_from_string
+from juicebox_mitm import JuiceboxMITM
+from juicebox_mqtthandler import JuiceboxMQTTHandler
+from juicebox_state import JuiceboxStateSnapshot
+from test_errorbudget import FakeClock
+from test_interval import FakeEntity
+from test_message import FAKE_SERIAL
+
+V07_SAMPLE = "0910000000000000000000000000:v07,s0001,u30048,V2400,L0024880114,S2,T62,M40,m40,t09,i78,e-001,f6001,X0,Y0,E006804,A0394,p0992!KKD:"
+V07_SERIAL = "0910000000000000000000000000"
+
+
+class FakeSetpointsMQTTHandler:
+
+    def __init__(self, online=None, offline=None):
+        self.entities = {
+            "current_max_online_set": FakeEntity(),
+            "current_max_offline_set": FakeEntity(),
+        }
+        self.entities["current_max_online_set"].state = online
+        self.entities["current_max_offline_set"].state = offline
+
+    def get_entity(self, name):
+        return self.entities[name]
+
+    def set_initial_state(self, key, state):
+        # Like the real entities once started
+        self.entities[key].state = state
+
+
+class TestStateSnapshot(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def _snapshot(self, online=None, offline=None):
+        snapshot = JuiceboxStateSnapshot(self.tmpdir.name, clock=self.clock)
+        mqtt = FakeSetpointsMQTTHandler(online, offline)
+        mitm = JuiceboxMITM(("127.0.0.1", 0), ("54.161.185.130", 8047), mqtt_handler=mqtt)
+        await snapshot.set_mitm_handler(mitm)
+        await snapshot.set_mqtt_handler(mqtt)
+        return snapshot, mitm, mqtt
+
+    async def _save_running_proxy(self):
+        snapshot, mitm, _ = await self._snapshot(online=32, offline=16)
+        command = JuiceboxCommand()
+        command.counter = 41
+        command.offline_amperage = 16
+        command.instant_amperage = 32
+        await mitm.restore_state(juicebox_message_from_string(V07_SAMPLE), command)
+        await snapshot.save()
+
+    async def test_restart_resumes_state(self):
+        await self._save_running_proxy()
+
+        # Restarted proxy, nothing received from the device yet
+        self.clock.now += 30
+        snapshot, mitm, mqtt = await self._snapshot()
+        self.assertEqual("07", snapshot.get(V07_SERIAL)["protocol"])
+        self.assertTrue(await snapshot.restore(V07_SERIAL))
+        # Offline setpoint is known without the 6 minutes wait of v07
+        self.assertTrue(mitm.is_mqtt_numeric_entity_defined("current_max_offline_set"))
+        self.assertEqual(16, mqtt.entities["current_max_offline_set"].state)
+        self.assertEqual(32, mqtt.entities["current_max_online_set"].state)
+        self.assertEqual(V07_SAMPLE, str(mitm.last_status_message))
+        # Next command continues the counter
+        command = JuiceboxCommand(previous=mitm.last_command)
+        self.assertEqual(42, command.counter)
+        self.assertEqual(16, command.offline_amperage)
+        self.assertEqual(32, command.instant_amperage)
+
+        self.assertFalse(await snapshot.restore("unknown"))
+
+    async def test_old_state_only_restores_setpoints(self):
+        await self._save_running_proxy()
+        self.clock.now += 2 * 24 * 60 * 60
+        snapshot, mitm, mqtt = await self._snapshot()
+        self.assertTrue(await snapshot.restore(V07_SERIAL))
+        self.assertEqual(16, mqtt.entities["current_max_offline_set"].state)
+        self.assertIsNone(mitm.last_command)
+        self.assertIsNone(mitm.last_status_message)
+
+    async def test_config_initial_state_wins(self):
+        config = JuiceboxConfig(self.tmpdir.name)
+        config.update_device_value(FAKE_SERIAL, "current_max_offline_set_initial_state", 20)
+        mqtt_handler = JuiceboxMQTTHandler(
+            device_name="JuiceBox",
+            mqtt_settings=Settings.MQTT(host="127.0.0.1"),
+            experimental=False,
+            config=config,
+            juicebox_id=FAKE_SERIAL,
+        )
+        mqtt_handler.set_initial_state("current_max_offline_set", 16)
+        mqtt_handler.set_initial_state("current_max_online_set", 32)
+        self.assertEqual(20, mqtt_handler.get_entity("current_max_offline_set")._kwargs["initial_state"])
+        self.assertEqual(32, mqtt_handler.get_entity("current_max_online_set")._kwargs["initial_state"])
+
+
+if __name__ == '__main__':
+    unittest.main()
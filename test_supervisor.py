@@ -0,0 +1,130 @@
+import asyncio
+import tempfile
+import time
+import unittest
+
+import asyncio_dgram
+from ha_mqtt_discoverable import Settings
+
+from juicebox_config import JuiceboxConfig
+from juicebox_mitm import JuiceboxMITM
+from juicebox_mqtthandler import JuiceboxMQTTHandler
+from juicebox_supervisor import (
+    CHILD_DONE,
+    CHILD_FAILED,
+    CHILD_RUNNING,
+    JuiceboxSupervisor,
+)
+from test_message import FAKE_SERIAL
+from test_mqtthandler import FakeMQTTBroker
+from test_startup import DEBUG_MESSAGE, FAKE_ENELX_IP, passthrough
+
+
+class FakeComponent:
+    """Counts starts (connections) and fails when told to"""
+
+    def __init__(self, run_forever=True):
+        self.run_forever = run_forever
+        self.connections = 0
+        self.closes = 0
+        self.started = asyncio.Event()
+        self._fail = None
+
+    async def start(self):
+        self._fail = asyncio.get_running_loop().create_future()
+        self.connections += 1
+        self.started.set()
+        if self.run_forever:
+            await self._fail
+
+    async def close(self):
+        self.closes += 1
+
+    def inject_fault(self, e=None):
+        self.started.clear()
+        self._fail.set_exception(e or ConnectionResetError("telnet connection lost"))
+
+
+class TestSupervisor(unittest.IsolatedAsyncioTestCase):
+
+    async def test_backoff_and_give_up(self):
+        supervisor = JuiceboxSupervisor(restart_delay=0.01, max_restart_delay=0.04, max_restarts=4)
+        failing = FakeComponent()
+        supervisor.add("failing", failing.start, failing.close)
+        task = asyncio.create_task(supervisor.start())
+        delays = []
+        for _ in range(4):
+            await failing.started.wait()
+            failing.inject_fault()
+            await asyncio.sleep(0)
+            delays.append(supervisor._children["failing"].delay)
+        await failing.started.wait()
+        failing.inject_fault()
+        with self.assertRaises(ChildProcessError):
+            await asyncio.wait_for(task, 1)
+        self.assertEqual([0.01, 0.02, 0.04, 0.04], delays)
+        self.assertEqual(CHILD_FAILED, supervisor.inspect()["failing"]["state"])
+        # closed after each failure and on exit
+        self.assertEqual(6, failing.closes)
+
+    async def test_fault_injection(self):
+        tempdir = tempfile.TemporaryDirectory()
+        broker = FakeMQTTBroker()
+        await broker.start()
+        mqtt_handler = JuiceboxMQTTHandler(
+            device_name="JuiceBox",
+            mqtt_settings=Settings.MQTT(host="127.0.0.1", port=broker.port),
+            experimental=False,
+            config=JuiceboxConfig(tempdir.name),
+            juicebox_id=FAKE_SERIAL,
+        )
+        udpc_updater = FakeComponent()
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(("127.0.0.1", 0), enelx.sockname, local_mitm_handler=passthrough)
+
+        restart_delay = 0.05
+        supervisor = JuiceboxSupervisor(restart_delay=restart_delay)
+        supervisor.add("mqtt_handler", mqtt_handler.start, mqtt_handler.close)
+        supervisor.add("mitm_handler", mitm.start, mitm.close)
+        supervisor.add("udpc_updater", udpc_updater.start, udpc_updater.close)
+        task = asyncio.create_task(supervisor.start())
+        try:
+            await udpc_updater.started.wait()
+            while mitm._dgram is None or broker.retained.get("hmd/JuiceBox/availability") != b"online":
+                await asyncio.sleep(0.001)
+            dgram = mitm._dgram
+            juicebox = await asyncio_dgram.connect(dgram.sockname)
+
+            start = time.perf_counter()
+            udpc_updater.inject_fault()
+            # Forwarding goes on while the updater is down
+            await juicebox.send(DEBUG_MESSAGE)
+            async with asyncio.timeout(1):
+                self.assertEqual(DEBUG_MESSAGE, (await enelx.recv())[0])
+            await udpc_updater.started.wait()
+            recovery = time.perf_counter() - start
+
+            self.assertEqual(2, udpc_updater.connections)
+            # All entities of the MQTT handler share one broker connection, kept by the telnet fault
+            await asyncio.sleep(0.1)
+            self.assertEqual(1, broker.connects)
+            self.assertEqual(1, len(broker._clients))
+            self.assertIs(dgram, mitm._dgram)
+            states = supervisor.inspect()
+            self.assertEqual(CHILD_DONE, states["mqtt_handler"]["state"])
+            self.assertEqual(CHILD_RUNNING, states["mitm_handler"]["state"])
+            self.assertEqual(1, states["udpc_updater"]["restarts"])
+            # Restarted after its delay, not after a full restart loop
+            self.assertLess(recovery, restart_delay * 20, f"recovery {recovery * 1000:.0f} ms")
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+            await mqtt_handler.close()
+            await broker.close()
+            tempdir.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import asyncio
+import time
+import unittest
+
+from juicebox_telnet import (
+    JuiceboxTelnet,
+    JuiceboxTelnetResponseParser,
+    JuiceboxTelnetSession,
+)
+from test_errorbudget import FakeClock
+from test_message import FAKE_SERIAL
+
+
+class FakeJuiceboxTelnetServer:
+    """
+    Minimal telnet server answering like the JuiceBox (Gecko OS) command line:
+    echo of each command line, output lines and a "> " prompt.
+
+    rtt delays the processing of each chunk received and line_delay each line
+    sent, like a slow device on wifi.
+    """
+
+    def __init__(self, rtt=0, line_delay=0):
+        self.rtt = rtt
+        self.line_delay = line_delay
+        self.variables = {
+            "bus.mode": "command",
+            "email.name_address": FAKE_SERIAL,
+            "system.version": "4.2.0",
+        }
+        self.streams = {0: ("FILE", "webapp/index.html-1.4.0.24 (1995, 0)")}
+        self.streams[1] = ("UDPC", "juicenet-udp-prod3-usa.enelx.com:8047 (26674)")
+        self.connections = 0
+        self.commands = []
+        self._server = None
+        self._writers = []
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.drop_clients()
+        self._server.close()
+        await self._server.wait_closed()
+
+    def drop_clients(self):
+        for writer in self._writers:
+            writer.close()
+        self._writers = []
+
+    def _run(self, command):
+        if command == "list":
+            lines = ["! # Type  Info"]
+            for id, (type, info) in sorted(self.streams.items()):
+                lines.append(f"# {id} {type}  {info}")
+            return lines
+        if command == "get all":
+            return [f"{name}: {value}" for name, value in sorted(self.variables.items())]
+        if command.startswith("get "):
+            return [self.variables.get(command[4:], "Unknown variable")]
+        if command.startswith("udpc "):
+            _, host, port = command.split(" ")
+            id = max(self.streams) + 1
+            self.streams[id] = ("UDPC", f"{host}:{port} (1234)")
+            return [f"[Opened: {id}]", str(id)]
+        if command.startswith("stream_close "):
+            self.streams.pop(int(command.split(" ")[1]), None)
+            return ["Success"]
+        if command == "save":
+            return ["Success"]
+        return []
+
+    async def _send_line(self, writer, line):
+        if self.line_delay:
+            await asyncio.sleep(self.line_delay)
+        writer.write(line)
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.append(writer)
+        writer.write(b"Gecko OS\r\n> ")
+        buffer = b""
+        try:
+            while data := await reader.read(1024):
+                if self.rtt:
+                    await asyncio.sleep(self.rtt)
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    command = line.decode("ascii").strip()
+                    await self._send_line(writer, line.rstrip(b"\r") + b"\r\n")
+                    if command:
+                        self.commands.append(command)
+                        for output in self._run(command):
+                            await self._send_line(writer, output.encode("ascii") + b"\r\n")
+                    writer.write(b"> ")
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+class TestTelnetResponseParser(unittest.TestCase):
+
+    def test_pipelined_responses(self):
+        stream = (
+            b"Gecko OS\r\n> list\r\n! # Type  Info\r\n# 1 UDPC  host:8047 (1)\r\n> "
+            b"get email.name_address\r\n" + FAKE_SERIAL.encode() + b"\r\n> "
+            b"udpc 10.0.0.2 8047\r\n> "
+        )
+        parser = JuiceboxTelnetResponseParser(["list", "get email.name_address", "udpc 10.0.0.2 8047"])
+        # Byte by byte so echo and prompt are split between chunks
+        for i in range(len(stream)):
+            parser.feed(stream[i:i + 1])
+        self.assertTrue(parser.done)
+        self.assertEqual(b"! # Type  Info\r\n# 1 UDPC  host:8047 (1)\r\n", parser.responses[0])
+        self.assertEqual(FAKE_SERIAL.encode() + b"\r\n", parser.responses[1])
+        self.assertEqual(b"", parser.responses[2])
+
+
+class TestTelnetSession(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeJuiceboxTelnetServer()
+        await self.server.start()
+        self.clock = FakeClock()
+        self.session = JuiceboxTelnetSession(
+            "127.0.0.1", self.server.port, timeout=5, snapshot_ttl=30, clock=self.clock
+        )
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.server.close()
+
+    async def test_startup_lookups_use_one_snapshot(self):
+        connections = await self.session.get_udpc_list()
+        self.assertEqual("juicenet-udp-prod3-usa.enelx.com:8047", connections[1]["dest"])
+        self.assertEqual(FAKE_SERIAL, await self.session.get_variable("email.name_address"))
+        # Updater check right after startup
+        self.assertEqual(connections, await self.session.get_udpc_list())
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(["list", "get all"], self.server.commands)
+
+    async def test_ttl_and_invalidate(self):
+        await self.session.snapshot()
+        self.clock.now += 31
+        await self.session.snapshot()
+        self.assertEqual(["list", "get all"] * 2, self.server.commands)
+
+        await self.session.write_udpc_stream("10.0.0.2", 8047)
+        connections = await self.session.get_udpc_list()
+        self.assertEqual("10.0.0.2:8047", connections[-1]["dest"])
+        self.assertEqual(1, self.server.connections)
+
+    async def test_concurrent_commands_are_serialized(self):
+        results = await asyncio.gather(
+            self.session.get_udpc_list(max_age=0),
+            self.session.get_variable("system.version"),
+            self.session.get_udpc_list(max_age=0),
+        )
+        self.assertEqual("4.2.0", results[1])
+        self.assertEqual(results[0], results[2])
+
+    async def test_reconnect(self):
+        await self.session.snapshot()
+        self.server.drop_clients()
+        await asyncio.sleep(0.1)
+        with self.assertRaises(ConnectionResetError):
+            await self.session.get_udpc_list(max_age=0)
+        connections = await self.session.get_udpc_list(max_age=0)
+        self.assertEqual(2, len(connections))
+        self.assertEqual(2, self.server.connections)
+
+
+class TestTelnetPipelineBenchmark(unittest.IsolatedAsyncioTestCase):
+
+    COMMANDS = ["list", "get email.name_address", "get all", "udpc 10.0.0.2 8047"]
+
+    async def _legacy(self, telnet):
+        # One command at a time, with a bare newline and prompt before each one
+        for command in self.COMMANDS:
+            await telnet.write(b"\n")
+            await telnet.readuntil(b"> ")
+            cmd = f"{command}\n".encode("ascii")
+            await telnet.write(cmd)
+            await telnet.readuntil(cmd.replace(b"\n", b"\r\n"))
+            await telnet.readuntil(b"\r\n> ")
+
+    async def test_pipeline_benchmark(self):
+        results = {}
+        for name in ("legacy", "pipelined"):
+            server = FakeJuiceboxTelnetServer(rtt=0.02, line_delay=0.001)
+            await server.start()
+            telnet = JuiceboxTelnet("127.0.0.1", server.port, timeout=10)
+            try:
+                await telnet.open()
+                start = time.perf_counter()
+                if name == "legacy":
+                    await self._legacy(telnet)
+                else:
+                    responses = await telnet.run_commands(self.COMMANDS)
+                    self.assertEqual(FAKE_SERIAL.encode(), responses[1].strip())
+                results[name] = time.perf_counter() - start
+                self.assertEqual(self.COMMANDS, server.commands)
+            finally:
+                await telnet.close()
+                await server.close()
+        # 8 round trips against 1
+        self.assertLess(
+            results["pipelined"],
+            results["legacy"] / 2,
+            f"legacy {results['legacy'] * 1000:.0f} ms, pipelined {results['pipelined'] * 1000:.0f} ms",
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import time
+import unittest
+
+import asyncio_dgram
+
+from juicebox_mitm import JuiceboxMITM
+from juicebox_tracing import TRACER, JuiceboxTracer, trace_mark
+from test_startup import DEBUG_MESSAGE, FAKE_ENELX_IP, passthrough
+
+
+class TestTracing(unittest.IsolatedAsyncioTestCase):
+
+    def tearDown(self):
+        TRACER.set_size(0)
+
+    async def test_ring_buffers(self):
+        tracer = JuiceboxTracer(3)
+        durations = [0.5, 9.0, 0.1, 2.0, 0.2, 0.3, 4.0, 0.4]
+        for duration in durations:
+            trace = tracer.start(time.perf_counter() - duration)
+            trace_mark("decode")
+            tracer.finish(trace)
+        # Nothing left as current trace
+        trace_mark("decode")
+
+        self.assertEqual([2, 7, 4], [t["trace_id"] for t in tracer.slowest()])
+        self.assertEqual([8, 7, 6], [t["trace_id"] for t in tracer.recent()])
+        slowest = tracer.slowest()[0]
+        self.assertGreaterEqual(slowest["duration_ms"], 9000)
+        self.assertEqual(["recv", "decode"], [s["stage"] for s in slowest["stages"]])
+
+        _, body = await tracer.http_route({"kind": "recent"})
+        self.assertEqual(["recent"], list(json.loads(body)))
+
+    async def test_datagram_trace(self):
+        TRACER.set_size(10)
+        enelx = await asyncio_dgram.bind((FAKE_ENELX_IP, 0))
+        mitm = JuiceboxMITM(("127.0.0.1", 0), enelx.sockname, local_mitm_handler=passthrough)
+        task = asyncio.create_task(mitm.start())
+        try:
+            while mitm._dgram is None:
+                await asyncio.sleep(0.001)
+            juicebox = await asyncio_dgram.connect(mitm._dgram.sockname)
+            await juicebox.send(DEBUG_MESSAGE)
+            async with asyncio.timeout(1):
+                await enelx.recv()
+            while not TRACER.recent():
+                await asyncio.sleep(0.001)
+            trace = TRACER.recent()[0]
+            self.assertEqual("juicebox", trace["kind"])
+            self.assertEqual(
+                ["recv", "classify juicebox", "decode", "local_handler", f"send {enelx.sockname}"],
+                [s["stage"] for s in trace["stages"]],
+            )
+            juicebox.close()
+        finally:
+            task.cancel()
+            mitm._dgram.close()
+            enelx.close()
+
+    async def test_disabled_overhead(self):
+        count = 100000
+        start = time.perf_counter()
+        for _ in range(count):
+            trace = TRACER.start(start)
+            for stage in ("classify", "decode", "publish", "publish", "publish", "config_write", "send"):
+                trace_mark(stage)
+            if trace is not None:
+                TRACER.finish(trace)
+        per_datagram = (time.perf_counter() - start) / count
+        self.assertLess(per_datagram, 0.00005, f"{per_datagram * 1e9:.0f} ns per datagram")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import asyncio
+import unittest
+
+import juicebox_udpcfleet
+from juicebox_udpcfleet import (
+    HOST_ERROR,
+    HOST_OK,
+    HOST_PENDING,
+    HOST_UPDATED,
+    JuiceboxUDPCFleet,
+    parse_host,
+)
+from test_telnet import FakeJuiceboxTelnetServer
+
+
+class CountingServers:
+    """Many fake JuiceBoxes sharing one count of open telnet connections"""
+
+    def __init__(self, count, **kwargs):
+        self.servers = [FakeJuiceboxTelnetServer(**kwargs) for _ in range(count)]
+        self.active = 0
+        self.max_active = 0
+        for server in self.servers:
+            handle = server._handle
+
+            async def counting_handle(reader, writer, handle=handle):
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+                try:
+                    await handle(reader, writer)
+                finally:
+                    self.active -= 1
+
+            server._handle = counting_handle
+
+    async def start(self):
+        for server in self.servers:
+            await server.start()
+
+    async def close(self):
+        for server in self.servers:
+            await server.close()
+
+
+class TestUDPCFleet(unittest.IsolatedAsyncioTestCase):
+
+    def test_parse_host(self):
+        self.assertEqual(("10.0.0.5", 2000), parse_host("10.0.0.5\n"))
+        self.assertEqual(("juicebox", 2001), parse_host("juicebox:2001"))
+
+    async def _wait(self, fleet, done, timeout=10):
+        for _ in range(int(timeout / 0.02)):
+            if done(fleet.inspect()):
+                return
+            await asyncio.sleep(0.02)
+        self.fail(f"Fleet did not finish: {fleet.inspect()}")
+
+    async def test_fleet_bounded_workers(self):
+        servers = CountingServers(60, rtt=0.02)
+        await servers.start()
+        # One JuiceBox already points to JuicePass Proxy
+        servers.servers[0].streams[1] = ("UDPC", "10.0.0.2:8047 (1)")
+        fleet = JuiceboxUDPCFleet("10.0.0.2", udpc_port=8047, telnet_timeout=5, workers=8, check_interval=60, jitter=0.001)
+        for server in servers.servers:
+            fleet.add_host("127.0.0.1", server.port)
+        task = asyncio.create_task(fleet.start())
+        try:
+            await self._wait(fleet, lambda hosts: all(h["state"] != HOST_PENDING for h in hosts))
+            states = [h["state"] for h in fleet.inspect()]
+            self.assertEqual([HOST_OK] + [HOST_UPDATED] * 59, states)
+            self.assertTrue(all(h["latency"] is not None for h in fleet.inspect()))
+            self.assertLessEqual(servers.max_active, 8)
+            self.assertGreater(servers.max_active, 1)
+            for server in servers.servers:
+                self.assertEqual("UDPC", server.streams[max(server.streams)][0])
+                self.assertTrue(server.streams[max(server.streams)][1].startswith("10.0.0.2:8047"))
+                # Checked once, the host interval is not over yet
+                self.assertEqual(1, server.connections)
+        finally:
+            task.cancel()
+            await fleet.close()
+            await servers.close()
+
+    async def test_unreachable_host_backs_off(self):
+        server = FakeJuiceboxTelnetServer()
+        await server.start()
+        port = server.port
+        await server.close()
+        fleet = JuiceboxUDPCFleet("10.0.0.2", telnet_timeout=1, workers=2, check_interval=60, jitter=0.001)
+        fleet.add_host("127.0.0.1", port)
+        task = asyncio.create_task(fleet.start())
+        try:
+            await self._wait(fleet, lambda hosts: hosts[0]["state"] == HOST_ERROR)
+            host = fleet.inspect()[0]
+            self.assertEqual(1, host["failures"])
+            self.assertIsNotNone(host["last_error"])
+            entry = next(iter(fleet._hosts.values()))
+            self.assertGreater(entry.next_check - fleet._clock(), 50)
+        finally:
+            task.cancel()
+            await fleet.close()
+
+    async def test_unexpected_error_keeps_worker(self):
+        async def broken_check_udpc(*args):
+            raise ValueError("invalid literal for int() with base 10: 'x'")
+
+        check_udpc = juicebox_udpcfleet.check_udpc
+        juicebox_udpcfleet.check_udpc = broken_check_udpc
+        fleet = JuiceboxUDPCFleet("10.0.0.2", telnet_timeout=1, workers=1, check_interval=60, jitter=0.001)
+        fleet.add_host("127.0.0.1", 1)
+        fleet.add_host("127.0.0.1", 2)
+        task = asyncio.create_task(fleet.start())
+        try:
+            # The single worker goes on with the second host
+            await self._wait(fleet, lambda hosts: all(h["state"] == HOST_ERROR for h in hosts))
+            self.assertFalse(task.done())
+            for host in fleet.inspect():
+                self.assertEqual(1, host["failures"])
+                self.assertTrue(host["last_error"].startswith("ValueError"))
+            entry = next(iter(fleet._hosts.values()))
+            self.assertGreater(entry.next_check - fleet._clock(), 50)
+        finally:
+            juicebox_udpcfleet.check_udpc = check_udpc
+            task.cancel()
+            await fleet.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+
+from const import UDPC_CHECK_MAX_INTERVAL, UDPC_TRAFFIC_GAP_MIN
+from juicebox_udpcupdater import JuiceboxUDPCUpdater
+from test_errorbudget import FakeClock
+from test_telnet import FakeJuiceboxTelnetServer
+
+
+class TestUDPCUpdater(unittest.IsolatedAsyncioTestCase):
+
+    def test_traffic_gap_schedule(self):
+        clock = FakeClock()
+        updater = JuiceboxUDPCUpdater("127.0.0.1", "10.0.0.2", 2000, clock=clock)
+        # No traffic yet, check at start
+        self.assertEqual(0, updater._time_until_check())
+
+        # Device reporting every 9 seconds, telnet is left alone
+        for _ in range(10):
+            updater.notify_traffic()
+            clock.now += 9
+        self.assertAlmostEqual(9, updater._report_interval)
+        self.assertAlmostEqual(3 * 9 - 9, updater._time_until_check())
+
+        # Traffic stopped for more than 3 report intervals
+        clock.now += 20
+        self.assertEqual(0, updater._time_until_check())
+        # Checks back off while there is no traffic
+        updater._next_check = clock.now + updater._backoff
+        self.assertEqual(30, updater._time_until_check())
+
+        # Traffic is back
+        updater.notify_traffic()
+        self.assertGreaterEqual(updater._time_until_check(), UDPC_TRAFFIC_GAP_MIN)
+
+    def test_outage_does_not_stretch_traffic_gap(self):
+        clock = FakeClock()
+        updater = JuiceboxUDPCUpdater("127.0.0.1", "10.0.0.2", 2000, clock=clock)
+        for _ in range(10):
+            updater.notify_traffic()
+            clock.now += 9
+        # 30 minute outage counts as one traffic gap at most
+        clock.now += 30 * 60
+        updater.notify_traffic()
+        self.assertLess(updater._report_interval, 12)
+        self.assertLess(updater._traffic_gap(), 3 * 12)
+
+        # Device switched to a 60 second report interval
+        for _ in range(40):
+            clock.now += 60
+            updater.notify_traffic()
+        self.assertAlmostEqual(60, updater._report_interval, delta=1)
+
+    async def test_checks_only_after_traffic_gap(self):
+        server = FakeJuiceboxTelnetServer()
+        await server.start()
+        clock = FakeClock()
+        updater = JuiceboxUDPCUpdater("127.0.0.1", "10.0.0.2", server.port, udpc_port=8047, telnet_timeout=5, clock=clock)
+        task = asyncio.create_task(updater.start())
+        try:
+            # First check redirects the UDPC to JuicePass Proxy
+            for _ in range(50):
+                await asyncio.sleep(0.01)
+                if "udpc 10.0.0.2 8047" in server.commands:
+                    break
+            self.assertEqual(["list", "get all", "stream_close 1", "udpc 10.0.0.2 8047"], server.commands)
+            # Telnet is released after the check
+            await asyncio.sleep(0.05)
+            self.assertIsNone(updater._telnet)
+
+            # Datagrams keep coming, no telnet
+            for _ in range(5):
+                updater.notify_traffic()
+                clock.now += 9
+                await asyncio.sleep(0.01)
+            self.assertEqual(4, len(server.commands))
+            self.assertLessEqual(updater._backoff, UDPC_CHECK_MAX_INTERVAL)
+        finally:
+            task.cancel()
+            await updater.close()
+            await server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()